@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import logging
+from hashlib import blake2b
 
 from pycardano import Address
 from pycardano import Network
@@ -9,7 +10,7 @@ from pycardano import VerificationKeyHash
 logger = logging.getLogger('pantasia-db-sync')
 
 
-def get_staking_address(address: str) -> str | None:
+def _get_staking_address(address: str) -> Address | None:
     # Check if address is from Shelley Era
     if address.startswith('addr'):
         # Instantiate Address object
@@ -20,8 +21,30 @@ def get_staking_address(address: str) -> str | None:
             return Address(
                 staking_part=address_obj.staking_part,
                 network=Network.MAINNET,
-            ).encode()
+            )
         else:
             return None
     else:
         return None
+
+
+def get_staking_address(address: str) -> str | None:
+    staking_address = _get_staking_address(address)
+    if staking_address is not None:
+        return staking_address.encode()
+    else:
+        return None
+
+
+def get_staking_address_raw(address: str) -> tuple[str, bytes] | None:
+    # Same as get_staking_address, with the raw bytes of the staking address
+    staking_address = _get_staking_address(address)
+    if staking_address is not None:
+        return staking_address.encode(), staking_address.to_primitive()
+    else:
+        return None
+
+
+def get_fingerprint_raw(policy_id: bytes, asset_name: bytes) -> bytes:
+    # CIP-14 asset fingerprint before bech32 encoding
+    return blake2b(policy_id + asset_name, digest_size=20).digest()
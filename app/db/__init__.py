@@ -1,7 +1,13 @@
 from __future__ import annotations
 
+from .id_index import IdCounter
 from .id_index import IdIndex
+from .parquet import ParquetSink
 from .postgres import Db
+from .replicas import RecordFetcher
 
+IdCounter = IdCounter
 IdIndex = IdIndex
 Db = Db
+ParquetSink = ParquetSink
+RecordFetcher = RecordFetcher
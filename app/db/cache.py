@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from datetime import datetime
+from hashlib import blake2b
+from threading import Lock
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+logger = logging.getLogger('pantasia-db-sync')
+
+# Columns of the extraction query, JSON columns are stored as text
+RECORD_SCHEMA = (
+    ('policy_id', 'string'),
+    ('asset_fingerprint', 'string'),
+    ('asset_name', 'string'),
+    ('asset_name_hash', 'string'),
+    ('tx_hash', 'string'),
+    ('quantity', 'quantity'),
+    ('address', 'string'),
+    ('address_raw', 'binary'),
+    ('stake_address', 'string'),
+    ('is_mint_tx', 'bool'),
+    ('is_spent', 'bool'),
+    ('tx_time', 'timestamp'),
+    ('block_no', 'int64'),
+    ('image', 'string'),
+    ('files', 'json'),
+    ('metadata', 'json'),
+    ('metadata_hash', 'binary'),
+)
+JSON_COLUMNS = ('files', 'metadata')
+
+FILE_TIME_FORMAT = '%Y%m%dT%H%M%S%f'
+
+
+def _arrow_schema() -> pa.Schema:
+    types = {
+        'string': pa.string(),
+        'json': pa.string(),
+        'binary': pa.binary(),
+        'bool': pa.bool_(),
+        'int64': pa.int64(),
+        'timestamp': pa.timestamp('us'),
+        # numeric (20,0) of ma_tx_out and ma_tx_mint
+        'quantity': pa.decimal128(38, 0),
+    }
+    return pa.schema(
+        [(name, types[column_type]) for name, column_type in RECORD_SCHEMA],
+    )
+
+
+# Extracted records of each period kept as Arrow IPC files on local disk,
+# so that a resync can replay them without querying cardano-db-sync.
+# A period is served from every file that overlaps it, so periods do not
+# have to match the ones that were cached
+class RecordCache:
+    def __init__(self, config, query: str) -> None:
+        if pa is None:
+            raise RuntimeError(
+                'record_cache_dir requires the pyarrow package, '
+                'install the parquet extra',
+            )
+        self.json_passthrough = config.json_passthrough
+        # Records depend on the query text (filters, spent inputs, JSON mode)
+        query_hash = blake2b(query.encode(), digest_size=8).hexdigest()
+        self.path = os.path.join(config.record_cache_dir, query_hash)
+        os.makedirs(self.path, exist_ok=True)
+        self.schema = _arrow_schema()
+
+        # Periods of the cached files, put() may run in a prefetch thread
+        self._lock = Lock()
+        self._periods = []
+        for file_name in os.listdir(self.path):
+            if file_name.endswith('.arrow'):
+                cached_from, _, cached_to = file_name[:-len('.arrow')].partition('_')
+                self._periods.append((
+                    datetime.strptime(cached_from, FILE_TIME_FORMAT),
+                    datetime.strptime(cached_to, FILE_TIME_FORMAT),
+                ))
+
+    def _file_path(self, from_datetime: datetime, to_datetime: datetime) -> str:
+        return os.path.join(
+            self.path,
+            f'{from_datetime:{FILE_TIME_FORMAT}}_{to_datetime:{FILE_TIME_FORMAT}}'
+            f'.arrow',
+        )
+
+    def _cover(self, from_datetime: datetime, to_datetime: datetime) -> list | None:
+        # Cached periods and the part of the period (start, end] taken from
+        # each, in order and without overlaps. None if there is a gap
+        with self._lock:
+            periods = sorted(
+                period for period in self._periods
+                if period[0] < to_datetime and period[1] > from_datetime
+            )
+        cover = []
+        covered_to = from_datetime
+        for cached_from, cached_to in periods:
+            if covered_to >= to_datetime:
+                break
+            if cached_from > covered_to:
+                return None
+            if cached_to > covered_to:
+                end = min(cached_to, to_datetime)
+                cover.append(((cached_from, cached_to), covered_to, end))
+                covered_to = end
+        if covered_to < to_datetime:
+            return None
+        return cover
+
+    def get(self, from_datetime: datetime, to_datetime: datetime) -> list | None:
+        # Records of this period from the files that overlap it, None if a
+        # part of the period is not cached
+        cover = self._cover(from_datetime, to_datetime)
+        if cover is None:
+            return None
+        records = []
+        for (cached_from, cached_to), start, end in cover:
+            with pa.memory_map(self._file_path(cached_from, cached_to)) as source:
+                table = pa.ipc.open_file(source).read_all()
+            if start > cached_from or end < cached_to:
+                tx_time = table.column('tx_time')
+                table = table.filter(
+                    pc.and_(
+                        pc.greater(tx_time, pa.scalar(start, tx_time.type)),
+                        pc.less_equal(tx_time, pa.scalar(end, tx_time.type)),
+                    ),
+                )
+            records.extend(table.to_pylist())
+
+        if not self.json_passthrough:
+            for record in records:
+                for column in JSON_COLUMNS:
+                    if record[column] is not None:
+                        record[column] = json.loads(record[column])
+        return records
+
+    def put(
+            self,
+            from_datetime: datetime,
+            to_datetime: datetime,
+            records: list,
+    ) -> None:
+        columns = {name: [] for name, _ in RECORD_SCHEMA}
+        for record in records:
+            for name, column_type in RECORD_SCHEMA:
+                value = record[name]
+                if value is not None:
+                    if column_type == 'json' and not self.json_passthrough:
+                        value = json.dumps(value)
+                    elif column_type == 'binary':
+                        value = bytes(value)
+                columns[name].append(value)
+        table = pa.table(columns, schema=self.schema)
+
+        # Write to a temporary file first so that a crash leaves no partial file
+        file_path = self._file_path(from_datetime, to_datetime)
+        temp_path = file_path + '.tmp'
+        options = pa.ipc.IpcWriteOptions(compression='zstd')
+        with pa.OSFile(temp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, self.schema, options=options) as writer:
+                writer.write_table(table)
+        os.replace(temp_path, file_path)
+        with self._lock:
+            self._periods.append((from_datetime, to_datetime))
+        logger.debug(f'Cached {len(records)} records in {file_path}')
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import json
+import logging
+import random
+from datetime import datetime
+from threading import Lock
+
+logger = logging.getLogger('pantasia-db-sync')
+
+EXPLAIN_OPTIONS = '(ANALYZE, BUFFERS, FORMAT JSON)'
+
+
+# Writes plans of slow extraction and load statements to a JSONL file
+class PlanCapture:
+    def __init__(self, config) -> None:
+        self.threshold = config.slow_query_threshold
+        self.sample_rate = config.slow_query_sample_rate
+        self.path = config.slow_query_log
+        # Extraction may run in several fetcher threads
+        self._lock = Lock()
+
+    def sampled(self) -> bool:
+        return random.random() < self.sample_rate
+
+    def record(
+            self,
+            statement: str,
+            period: tuple | None,
+            rows: int,
+            elapsed: float,
+            plan: list,
+    ) -> None:
+        from_datetime, to_datetime = period or (None, None)
+        entry = {
+            'time': datetime.now().isoformat(),
+            'statement': statement,
+            'from': from_datetime.isoformat() if from_datetime else None,
+            'to': to_datetime.isoformat() if to_datetime else None,
+            'rows': rows,
+            'seconds': round(elapsed, 4),
+            'plan': plan,
+        }
+        with self._lock, open(self.path, 'a') as log_file:
+            log_file.write(json.dumps(entry, default=str) + '\n')
+        logger.warning(
+            f'Slow statement {statement} took {elapsed:.2f} seconds '
+            f'for {rows} rows, plan saved to {self.path}',
+        )
@@ -3,9 +3,13 @@ from __future__ import annotations
 import logging
 
 from db.postgres import Db
+from db.statements import PreparedStatement
 
 logger = logging.getLogger('pantasia-db-sync')
 
+# Sentinel for journal entries of reference keys that were not in the index
+_MISSING = object()
+
 
 # Class to maintain an index of reference_keys (natural keys) to primary keys
 class IdIndex:
@@ -15,6 +19,11 @@ class IdIndex:
         self.table_name = table_name
         self.reference_key = reference_key
         self.db = database
+        # Lookup of a single key, used when the full index is not in memory
+        self._get_statement = PreparedStatement(
+            f'id_index_get_{table_name}',
+            f'SELECT id FROM {table_name} WHERE {reference_key} = %s',
+        )
         if self.config is True:
             # Load full index of keys from the database
             self.id_index = self._pantasia_load_id_map()
@@ -24,6 +33,13 @@ class IdIndex:
             # get duplicate error within the same bulk transaction
             self.id_index = {}
 
+        # Journal of set() operations since the last commit, used for rollback
+        self._journal = []
+
+        # Lookups found and not found in the index, for metrics
+        self.hits = 0
+        self.misses = 0
+
     def _pantasia_load_id_map(self) -> dict:
         # Load all IDs and reference key values from the database
         d_result = {}
@@ -37,7 +53,11 @@ class IdIndex:
         results = self.db.pantasia_cur.fetchall()
 
         for result in results:
-            d_result[result[self.reference_key]] = result['id']
+            reference_value = result[self.reference_key]
+            # bytea keys are returned as memoryview, index them as bytes
+            if isinstance(reference_value, memoryview):
+                reference_value = reference_value.tobytes()
+            d_result[reference_value] = result['id']
 
         logger.info(
             f'Load {self.table_name} data, '
@@ -50,19 +70,20 @@ class IdIndex:
     def clear_index(self) -> None:
         # Reset the index to empty dict
         self.id_index = {}
+        self._journal = []
 
     def get(self, reference_value: any) -> int | None:
         # Get ID from index, returns None if not found
         index_id = self.id_index.get(reference_value)
+        if index_id is None:
+            self.misses = self.misses + 1
+        else:
+            self.hits = self.hits + 1
 
         # If full in-memory index is turned off, and ID not found, try to get from DB
         if self.config is False and index_id is None:
-            if type(reference_value) is str:
-                reference_value = f"'{reference_value}'"
-            self.db.pantasia_cur.execute(
-                f'SELECT id FROM {self.table_name} '
-                f'WHERE {self.reference_key} '
-                f'IN ({reference_value})',
+            self._get_statement.execute(
+                self.db.pantasia_cur, (reference_value,),
             )
             result = self.db.pantasia_cur.fetchone()
             if result is not None:
@@ -73,5 +94,43 @@ class IdIndex:
             return index_id
 
     def set(self, index_id: int, reference_value: any) -> None:
+        # Record the previous mapping so that it can be restored on rollback
+        self._journal.append(
+            (reference_value, self.id_index.get(reference_value, _MISSING)),
+        )
         # Set the ID mapped to reference key value in the index
         self.id_index[reference_value] = index_id
+
+    def commit(self) -> None:
+        # Entries set since the last commit are now persisted in the database
+        self._journal = []
+
+    def rollback(self) -> None:
+        # Undo every set() since the last commit, most recent first
+        for reference_value, index_id in reversed(self._journal):
+            if index_id is _MISSING:
+                self.id_index.pop(reference_value, None)
+            else:
+                self.id_index[reference_value] = index_id
+        self._journal = []
+
+
+# Class to hand out new primary keys for a table, with rollback to the last commit
+class IdCounter:
+    def __init__(self, table_name: str, database: Db) -> None:
+        self.table_name = table_name
+        self.value = database.pantasia_get_last_index(table_name)
+        self._committed_value = self.value
+
+    def next(self) -> int:
+        # Return the next free ID and move the counter forward
+        index_id = self.value
+        self.value = self.value + 1
+        return index_id
+
+    def commit(self) -> None:
+        self._committed_value = self.value
+
+    def rollback(self) -> None:
+        # Reset the counter to the value it had at the last commit
+        self.value = self._committed_value
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import logging
+import os
+from datetime import datetime
+
+from .rows import INSERT_TABLES
+from .rows import RowLayout
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger('pantasia-db-sync')
+
+# Tables written to files, asset_ext only points to the latest rows of
+# asset_tx and asset_mint_tx and is left out
+EXPORTED_TABLES = (
+    'wallet', 'collection', 'tx', 'mint_metadata', 'asset', 'asset_mint_tx',
+    'asset_tx',
+)
+
+# Position of the tx time in the values of a row, other tables are
+# partitioned by the end of the period
+TIME_POSITIONS = {'tx': 2, 'asset_mint_tx': 5, 'asset_tx': 5}
+
+INT_COLUMNS = {
+    'id', 'collection_id', 'current_wallet_id', 'asset_id', 'wallet_id', 'tx_id',
+    'metadata_id', 'block_no',
+}
+TIME_COLUMNS = {'time', 'tx_time'}
+JSON_COLUMNS = {'image', 'metadata', 'files', 'document'}
+
+
+def _arrow_type(column: str, values: list) -> pa.DataType:
+    if column in INT_COLUMNS:
+        return pa.int64()
+    if column in TIME_COLUMNS:
+        return pa.timestamp('us')
+    if column in JSON_COLUMNS:
+        return pa.string()
+    if column == 'quantity':
+        # numeric (20,0) of cardano-db-sync
+        return pa.decimal128(38, 0)
+    # Keys are text or raw bytes depending on binary_keys
+    for value in values:
+        if value is not None:
+            return pa.binary() if isinstance(value, bytes) else pa.string()
+    return pa.string()
+
+
+# Rows of each committed period as Parquet (or Arrow IPC) files partitioned
+# by date, with the ids of the Pantasia DB, for analytics outside Postgres
+class ParquetSink:
+    def __init__(self, database, config) -> None:
+        if pa is None:
+            raise RuntimeError(
+                'The parquet sink requires the pyarrow package, '
+                'install the parquet extra',
+            )
+        self.path = config.parquet_dir
+        self.format = config.parquet_format
+        if self.format not in ('parquet', 'arrow'):
+            raise RuntimeError(f'Unknown parquet_format {self.format}')
+        self.layout = RowLayout(database)
+        # Files of the running period, renamed once the period is committed
+        self._pending = []
+        self.recover(database.pantasia_tip)
+
+    def _file_path(
+            self,
+            table_name: str,
+            date: datetime,
+            from_datetime: datetime,
+            to_datetime: datetime,
+    ) -> str:
+        return os.path.join(
+            self.path,
+            table_name,
+            f'date={date:%Y-%m-%d}',
+            f'{from_datetime:%Y%m%dT%H%M%S%f}_{to_datetime:%Y%m%dT%H%M%S%f}'
+            f'.{self.format}',
+        )
+
+    def recover(self, tip: datetime) -> None:
+        # Files left by a stop between commit and rename belong to committed
+        # periods if they end at or before the checkpoint
+        for directory, _, file_names in os.walk(self.path):
+            for file_name in file_names:
+                if not file_name.endswith('.tmp'):
+                    continue
+                temp_path = os.path.join(directory, file_name)
+                to_datetime = datetime.strptime(
+                    file_name.split('.')[0].split('_')[1], '%Y%m%dT%H%M%S%f',
+                )
+                if to_datetime <= tip:
+                    os.replace(temp_path, temp_path[:-len('.tmp')])
+                else:
+                    os.remove(temp_path)
+
+    def _write(self, file_path: str, columns: tuple, rows: list) -> None:
+        table = pa.table(
+            {
+                column: pa.array(
+                    [row[i] for row in rows],
+                    type=_arrow_type(column, [row[i] for row in rows]),
+                )
+                for i, column in enumerate(columns)
+            },
+        )
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        temp_path = file_path + '.tmp'
+        if self.format == 'parquet':
+            pq.write_table(table, temp_path, compression='zstd')
+        else:
+            options = pa.ipc.IpcWriteOptions(compression='zstd')
+            with pa.OSFile(temp_path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                    writer.write_table(table)
+        self._pending.append(file_path)
+        logger.debug(f'Exported {len(rows)} rows to {file_path}')
+
+    def stage(
+            self,
+            from_datetime: datetime,
+            to_datetime: datetime,
+            values: dict,
+    ) -> None:
+        # Runs before the commit, files stay temporary until publish()
+        for table_name, key in INSERT_TABLES:
+            columns = self.layout.columns.get(table_name)
+            if table_name not in EXPORTED_TABLES or columns is None \
+                    or len(values[key]) == 0:
+                continue
+            rows_per_date = {}
+            time_position = TIME_POSITIONS.get(table_name)
+            for value in values[key]:
+                tx_time = to_datetime if time_position is None \
+                    else value[time_position]
+                rows_per_date.setdefault(tx_time.date(), []).append(
+                    self.layout.row(table_name, value),
+                )
+            for date, rows in rows_per_date.items():
+                self._write(
+                    self._file_path(table_name, date, from_datetime, to_datetime),
+                    columns,
+                    rows,
+                )
+
+    def publish(self) -> None:
+        for file_path in self._pending:
+            os.replace(file_path + '.tmp', file_path)
+        self._pending = []
+
+    def discard(self) -> None:
+        for file_path in self._pending:
+            if os.path.exists(file_path + '.tmp'):
+                os.remove(file_path + '.tmp')
+        self._pending = []
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from concurrent.futures import Future
+from threading import Thread
+
+import psycopg2
+
+try:
+    import psycopg
+    from psycopg.rows import dict_row
+except ImportError:
+    psycopg = None
+
+logger = logging.getLogger('pantasia-db-sync')
+
+# DB-API error classes that the sync loop tells apart
+ERROR_NAMES = {
+    'IntegrityError', 'DataError', 'InternalError', 'OperationalError',
+    'InterfaceError', 'ProgrammingError', 'NotSupportedError', 'DatabaseError',
+    'Error',
+}
+
+
+def _translate(exc: Exception) -> Exception:
+    # A psycopg 3 error as the psycopg2 error of the same DB-API class
+    for error_class in type(exc).__mro__:
+        if error_class.__name__ in ERROR_NAMES:
+            return getattr(psycopg2, error_class.__name__)(str(exc))
+    return exc
+
+
+# Loads periods with psycopg 3 pipeline mode and extracts upcoming periods
+# at the same time, both on one event loop running in a background thread
+class PipelineEngine:
+    def __init__(self, config) -> None:
+        if psycopg is None:
+            raise RuntimeError(
+                'db_engine pipeline requires the psycopg (3) package, '
+                'install the pipeline extra',
+            )
+        self.config = config
+        self.loop = asyncio.new_event_loop()
+        self._thread = Thread(
+            target=self.loop.run_forever, name='pantasia-pipeline', daemon=True,
+        )
+        self._thread.start()
+        self.pantasia_conn = None
+        self.cardano_conn = None
+        # Statements of the running period that have not been sent yet
+        self._pending = []
+        self.connect()
+
+    def _connect_kwargs(self, prefix: str) -> dict:
+        config = self.config
+        return {
+            'dbname': getattr(config, f'{prefix}_name'),
+            'user': getattr(config, f'{prefix}_user'),
+            'password': getattr(config, f'{prefix}_pass'),
+            'host': getattr(config, f'{prefix}_host'),
+            'port': getattr(config, f'{prefix}_port'),
+            'connect_timeout': config.db_connect_timeout,
+            'keepalives': 1,
+            'keepalives_idle': config.db_keepalives_idle,
+            'keepalives_interval': config.db_keepalives_interval,
+            'keepalives_count': config.db_keepalives_count,
+            'row_factory': dict_row,
+        }
+
+    async def _translated(self, coroutine: any) -> any:
+        try:
+            return await coroutine
+        except psycopg.Error as exc:
+            raise _translate(exc) from exc
+
+    def _submit(self, coroutine: any) -> Future:
+        return asyncio.run_coroutine_threadsafe(self._translated(coroutine), self.loop)
+
+    def _run(self, coroutine: any) -> any:
+        return self._submit(coroutine).result()
+
+    def connect(self) -> None:
+        # (Re)open both connections, statements not sent yet are dropped
+        self.close_connections()
+        self._pending = []
+        self.pantasia_conn = self._run(
+            psycopg.AsyncConnection.connect(**self._connect_kwargs('db')),
+        )
+        self.cardano_conn = self._run(
+            psycopg.AsyncConnection.connect(**self._connect_kwargs('cdb')),
+        )
+        logger.debug('Pipeline engine connections are open')
+
+    def send(self, query: str, params: tuple | None = None) -> None:
+        # Queued until the next fetch() or commit() of the period
+        self._pending.append((query, params))
+
+    async def _flush(
+            self,
+            query: str | None = None,
+            params: tuple | None = None,
+            commit: bool = False,
+    ) -> list | None:
+        # Send the queued statements back to back in one pipeline, followed by
+        # the given statement whose rows are returned, or by the commit
+        statements = self._pending
+        self._pending = []
+        conn = self.pantasia_conn
+        async with conn.pipeline():
+            for pending_query, pending_params in statements:
+                await conn.execute(pending_query, pending_params)
+            if commit:
+                await conn.commit()
+                return None
+            if query is None:
+                return None
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                return await cur.fetchall()
+
+    def fetch(self, query: str, params: tuple | None = None) -> list:
+        return self._run(self._flush(query, params))
+
+    def commit(self) -> None:
+        self._run(self._flush(commit=True))
+
+    def rollback(self) -> None:
+        self._pending = []
+        if self.pantasia_conn is not None and not self.pantasia_conn.closed:
+            self._run(self.pantasia_conn.rollback())
+
+    async def _extract(self, query: str, params: tuple) -> list:
+        async with self.cardano_conn.cursor() as cur:
+            await cur.execute(query, params)
+            records = await cur.fetchall()
+        await self.cardano_conn.commit()
+        return records
+
+    def extract(self, query: str, params: tuple) -> Future:
+        # Returns at once, the query runs on the loop while periods are loaded
+        return self._submit(self._extract(query, params))
+
+    def close_connections(self) -> None:
+        for conn in (self.pantasia_conn, self.cardano_conn):
+            if conn is not None and not conn.closed:
+                conn.cancel()
+                try:
+                    self._run(conn.close())
+                except psycopg2.Error:
+                    pass
+        self.pantasia_conn = None
+        self.cardano_conn = None
+
+    def close(self) -> None:
+        self.close_connections()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import logging
+from threading import Lock
+from time import sleep
+from time import time
+
+import psycopg2
+from psycopg2 import InterfaceError
+from psycopg2 import OperationalError
+from psycopg2.extensions import connection
+
+from .statements import SyncConnection
+
+logger = logging.getLogger('pantasia-db-sync')
+
+
+# Small pool of connections to one database with health checks and reconnect
+class ConnectionPool:
+    def __init__(
+            self,
+            name: str,
+            host: str,
+            port: int,
+            dbname: str,
+            user: str,
+            password: str,
+            config,
+            size: int = 1,
+            plan_cache_mode: str = 'auto',
+    ) -> None:
+        self.name = name
+        self.host = host
+        self.port = port
+        self.config = config
+        self.size = size
+        self.connect_kwargs = {
+            'dbname': dbname,
+            'user': user,
+            'password': password,
+            'host': host,
+            'port': port,
+            'connect_timeout': config.db_connect_timeout,
+            # TCP keepalives so that dead peers are detected on idle connections
+            'keepalives': 1,
+            'keepalives_idle': config.db_keepalives_idle,
+            'keepalives_interval': config.db_keepalives_interval,
+            'keepalives_count': config.db_keepalives_count,
+            'connection_factory': SyncConnection,
+        }
+        if plan_cache_mode != 'auto':
+            # Session-wide choice between custom and generic plans (Postgres 12+)
+            self.connect_kwargs['options'] = f'-c plan_cache_mode={plan_cache_mode}'
+        self._lock = Lock()
+        self._idle = []
+        self._used = {}
+
+    def _connect(self, retry: bool = True) -> connection:
+        # Connect to the database, retrying with exponential backoff
+        attempt = 0
+        while True:
+            attempt = attempt + 1
+            try:
+                logger.debug(
+                    f'Connecting to {self.connect_kwargs["dbname"]} '
+                    f'at {self.host}:{self.port}',
+                )
+                conn = psycopg2.connect(**self.connect_kwargs)
+                if not self.config.prepared_statements:
+                    conn.prepared_statements = None
+                logger.debug('Connection successful')
+                return conn
+            except OperationalError:
+                if not retry or 0 < self.config.db_reconnect_attempts <= attempt:
+                    raise
+                delay = min(
+                    2 ** (attempt - 1),
+                    self.config.db_reconnect_backoff_max,
+                )
+                logger.warning(
+                    f'Could not connect to {self.name} DB '
+                    f'at {self.host}:{self.port} (attempt {attempt}), '
+                    f'retrying in {delay} seconds',
+                )
+                sleep(delay)
+
+    @staticmethod
+    def is_healthy(conn: connection) -> bool:
+        # Run a trivial query to check that the connection is still usable
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, retry: bool = True) -> connection:
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                # Only ping connections that have been idle for a while
+                idle_time = time() - last_used
+                if idle_time < self.config.db_health_check_interval \
+                        or self.is_healthy(conn):
+                    self._used[id(conn)] = conn
+                    return conn
+                logger.warning(f'Discarding broken {self.name} DB connection')
+                self._close(conn)
+
+            if len(self._used) >= self.size:
+                raise RuntimeError(
+                    f'Connection pool {self.name} exhausted ({self.size})',
+                )
+
+        conn = self._connect(retry)
+        with self._lock:
+            self._used[id(conn)] = conn
+        return conn
+
+    def putconn(self, conn: connection, close: bool = False) -> None:
+        with self._lock:
+            self._used.pop(id(conn), None)
+            if close or conn.closed:
+                self._close(conn)
+            else:
+                self._idle.append((conn, time()))
+
+    def reconnect(self, conn: connection, retry: bool = True) -> connection:
+        # Replace a broken connection with a new one
+        self.putconn(conn, close=True)
+        return self.getconn(retry)
+
+    def closeall(self) -> None:
+        with self._lock:
+            for conn in list(self._used.values()):
+                self._close(conn)
+            for conn, _ in self._idle:
+                self._close(conn)
+            self._used = {}
+            self._idle = []
+
+    @staticmethod
+    def _close(conn: connection) -> None:
+        try:
+            conn.close()
+        except (OperationalError, InterfaceError):
+            pass
@@ -1,54 +1,320 @@
 from __future__ import annotations
 
+import json
 import logging
+from concurrent.futures import Future
 from datetime import datetime
 from datetime import timedelta
 from time import time
 from typing import Callable
 
-import psycopg2
+from psycopg2.extensions import connection
+from psycopg2.extras import Json
 from psycopg2.extras import RealDictCursor
 
+from .cache import RecordCache
+from .explain import EXPLAIN_OPTIONS
+from .explain import PlanCapture
+from .pipeline import PipelineEngine
+from .pool import ConnectionPool
+from .replicas import CardanoReplica
+from .staging import StagingLoader
+from .statements import PreparedStatement
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger('pantasia-db-sync')
 
+# Fact tables that can be partitioned by tx_time
+PARTITIONED_TABLES = ('asset_tx', 'asset_mint_tx')
+
+GET_CARDANO_TIP = PreparedStatement(
+    'get_latest_cardano_tip',
+    """SELECT b.time AS cardano_tip, b.block_no
+    FROM block b
+    ORDER BY b.time DESC
+    LIMIT 1
+    OFFSET 3""",
+)
+
+GET_PANTASIA_TIP = PreparedStatement(
+    'get_latest_pantasia_tip',
+    """WITH at_tip AS (
+        SELECT at2.tx_time
+        FROM asset_tx at2
+        ORDER BY at2.id DESC
+        LIMIT 1
+        ),
+    amt_tip AS (
+        SELECT amt.tx_time
+        FROM asset_mint_tx amt
+        ORDER BY amt.id DESC
+        LIMIT 1
+    )
+    SELECT att.tx_time AS pantasia_tip FROM at_tip att
+    UNION ALL
+    SELECT amtt.tx_time AS pantasia_tip FROM amt_tip amtt
+    ORDER BY pantasia_tip DESC
+    LIMIT 1""",
+)
+
+# Pantasia tip of a normalized tx schema, tx ids follow tx_time order
+GET_PANTASIA_TX_TIP = PreparedStatement(
+    'get_latest_pantasia_tx_tip',
+    'SELECT t.time AS pantasia_tip FROM tx t ORDER BY t.id DESC LIMIT 1',
+)
+
+GET_CHECKPOINT = PreparedStatement(
+    'get_sync_checkpoint',
+    'SELECT tip, next_ids FROM sync_checkpoint WHERE id = 1',
+)
+
+SAVE_CHECKPOINT = PreparedStatement(
+    'save_sync_checkpoint',
+    """INSERT INTO sync_checkpoint (id, tip, next_ids, modified)
+    VALUES (1, %s, %s, now())
+    ON CONFLICT (id) DO UPDATE
+    SET tip = EXCLUDED.tip,
+    next_ids = EXCLUDED.next_ids,
+    modified = EXCLUDED.modified""",
+)
+
+# {json_cast} turns the metadata columns into text for the pass-through mode,
+# {metadata_hash} hashes the jsonb text of the metadata for dedup_metadata,
+# {mint_filter} and {out_filter} restrict the policies of both branches,
+# {spent_branch} adds the spent inputs for wallet balances
+GET_RECORDS_QUERY = """
+        WITH all_ma_tx AS
+        (SELECT mtm.ident AS ma_id,
+              encode(ma.policy::bytea, 'hex'::text) AS policy_id,
+              encode(ma.name::bytea, 'escape'::text) AS asset_name,
+              encode(ma.name::bytea, 'hex'::text) AS asset_name_hash,
+              ma.fingerprint AS asset_fingerprint,
+              mtm.quantity,
+              mtm.tx_id,
+              NULL AS address,
+              NULL::bytea AS address_raw,
+              NULL AS stake_address,
+              false AS is_spent
+        FROM ma_tx_mint mtm
+        JOIN tx t ON t.id = mtm.tx_id
+        JOIN block b ON b.id = t.block_id
+        JOIN multi_asset ma ON ma.id = mtm.ident
+        WHERE mtm.quantity < 0
+         AND b."time" > %s
+         AND b."time" <= %s{mint_filter}
+        UNION ALL SELECT mto.ident AS ma_id,
+                        encode(ma2.policy::bytea, 'hex'::text) AS policy_id,
+                        encode(ma2.name::bytea, 'escape'::text) AS asset_name,
+                        encode(ma2.name::bytea, 'hex'::text) AS asset_name_hash,
+                        ma2.fingerprint,
+                        mto.quantity,
+                        to2.tx_id,
+                        to2.address,
+                        to2.address_raw,
+                        sa."view" AS stake_address,
+                        false AS is_spent
+        FROM ma_tx_out mto
+        JOIN tx_out to2 ON mto.tx_out_id = to2.id
+        JOIN tx t2 ON to2.tx_id = t2.id
+        JOIN block b2 ON t2.block_id = b2.id
+        JOIN multi_asset ma2 ON ma2.id = mto.ident
+        LEFT OUTER JOIN stake_address sa ON to2.stake_address_id = sa.id
+        WHERE b2."time" > %s
+         AND b2."time" <= %s{out_filter}{spent_branch} )
+        SELECT policy_id,
+           asset_fingerprint,
+           asset_name,
+           asset_name_hash,
+           encode(t3.hash, 'hex') AS tx_hash,
+           quantity,
+           address,
+           address_raw,
+           stake_address,
+           is_mint_tx,
+           is_spent,
+           b3."time" AS tx_time,
+           b3.block_no,
+           image,
+           files{json_cast} AS files,
+           metadata{json_cast} AS metadata,
+           {metadata_hash} AS metadata_hash
+        FROM all_ma_tx amt
+        LEFT JOIN LATERAL
+        (SELECT true AS is_mint_tx,
+            tm."key",
+            tm.json -> amt.policy_id -> amt.asset_name ->> 'image' AS image,
+            tm.json -> amt.policy_id -> amt.asset_name AS metadata,
+            tm.json -> amt.policy_id -> amt.asset_name -> 'files' AS files
+        FROM ma_tx_mint mtm2
+        LEFT OUTER JOIN tx_metadata tm ON tm.tx_id = amt.tx_id
+        AND tm."key" = 721
+        WHERE (mtm2.ident = amt.ma_id
+         AND mtm2.tx_id = amt.tx_id
+         AND NOT amt.is_spent)) label_mint_tx ON true
+        JOIN tx t3 ON amt.tx_id = t3.id
+        JOIN block b3 ON t3.block_id = b3.id
+        ORDER BY b3.time asc, is_spent
+        """
+
+# Content hash of a metadata document, over the canonical jsonb text that is
+# the same whether the document is passed through or parsed
+METADATA_HASH = "sha256(convert_to(metadata::text, 'UTF8'))"
+
+# Assets leaving wallets as inputs of valid transactions,
+# ordered after the outputs of the same block so that chained txs resolve
+SPENT_BRANCH_QUERY = """
+        UNION ALL SELECT mto3.ident AS ma_id,
+                        encode(ma3.policy::bytea, 'hex'::text) AS policy_id,
+                        encode(ma3.name::bytea, 'escape'::text) AS asset_name,
+                        encode(ma3.name::bytea, 'hex'::text) AS asset_name_hash,
+                        ma3.fingerprint,
+                        mto3.quantity,
+                        ti.tx_in_id AS tx_id,
+                        to3.address,
+                        to3.address_raw,
+                        sa3."view" AS stake_address,
+                        true AS is_spent
+        FROM tx_in ti
+        JOIN tx t4 ON ti.tx_in_id = t4.id
+        JOIN block b4 ON t4.block_id = b4.id
+        JOIN tx_out to3 ON to3.tx_id = ti.tx_out_id
+         AND to3.index = ti.tx_out_index
+        JOIN ma_tx_out mto3 ON mto3.tx_out_id = to3.id
+        JOIN multi_asset ma3 ON ma3.id = mto3.ident
+        LEFT OUTER JOIN stake_address sa3 ON to3.stake_address_id = sa3.id
+        WHERE t4.valid_contract
+         AND b4."time" > %s
+         AND b4."time" <= %s{spent_filter}"""
+
+
+def _policy_filter(config, alias: str) -> str:
+    # Conditions on multi_asset.policy, policy ids are validated as hex
+    def policy_list(policies: list) -> str:
+        return ', '.join(
+            f"'\\x{bytes.fromhex(policy).hex()}'::bytea" for policy in policies
+        )
+
+    conditions = []
+    if config.policy_include:
+        conditions.append(
+            f'{alias}.policy IN ({policy_list(config.policy_include)})',
+        )
+    if config.policy_exclude:
+        conditions.append(
+            f'{alias}.policy NOT IN ({policy_list(config.policy_exclude)})',
+        )
+    if config.nft_only:
+        # Assets minted one at a time with CIP-25 metadata
+        conditions.append(
+            f"""EXISTS (SELECT 1 FROM ma_tx_mint nft
+            JOIN tx_metadata nft_tm ON nft_tm.tx_id = nft.tx_id
+            AND nft_tm."key" = 721
+            WHERE nft.ident = {alias}.id
+            AND nft.quantity = 1)""",
+        )
+    return ''.join(f'\n         AND {condition}' for condition in conditions)
+
+
+def _key_literal(value: str | bytes) -> str:
+    # SQL literal of a natural key, raw bytes are written as hex bytea input
+    if isinstance(value, bytes):
+        return f"'\\x{value.hex()}'"
+    return f"'{value}'"
+
 
 class Db:
-    def __init__(self, config) -> None:
+    def __init__(self, config, metrics=None) -> None:
         self.config = config
-        # Connect to Cardano and Pantasia postgres DB
-        logger.debug(
-            f'Connecting to {config.cdb_name} '
-            f'at {config.cdb_host}:{config.cdb_port}',
-        )
-        self.cardano_conn = psycopg2.connect(
-            dbname=config.cdb_name,
-            user=config.cdb_user,
-            password=config.cdb_pass,
-            host=config.cdb_host,
-            port=config.cdb_port,
-        )
-        logger.debug('Connection successful')
-        logger.debug(
-            f'Connecting to {config.db_name} '
-            f'at {config.db_host}:{config.db_port}',
-        )
-        self.pantasia_conn = psycopg2.connect(
+        # Registry for per-operation load metrics, None to skip recording
+        self.metrics = metrics
+        # Connection pools to Cardano and Pantasia postgres DB
+        self.cardano_pool = self._cardano_pool(config.cdb_host, config.cdb_port)
+        self.pantasia_pool = ConnectionPool(
+            'pantasia',
             dbname=config.db_name,
             user=config.db_user,
             password=config.db_pass,
             host=config.db_host,
             port=config.db_port,
+            config=config,
+            plan_cache_mode=config.db_plan_cache_mode,
         )
-        logger.debug('Connection successful')
 
-        # Open cursors to perform database operations
-        self.cardano_cur = self.cardano_conn.cursor(
-            cursor_factory=RealDictCursor,
-        )
-        self.pantasia_cur = self.pantasia_conn.cursor(
-            cursor_factory=RealDictCursor,
+        # Cardano DB read replicas, the first one is the primary
+        # used to determine the Cardano tip
+        self.cardano_replicas = [CardanoReplica(self.cardano_pool, required=True)]
+        for endpoint in config.cdb_replicas:
+            host, _, port = endpoint.partition(':')
+            self.cardano_replicas.append(
+                CardanoReplica(
+                    self._cardano_pool(host, int(port or config.cdb_port)),
+                ),
+            )
+        self.cardano_tip_block_no = None
+        self.pantasia_checkpoint = None
+        self.partitioned = False
+        # Months for which partitions have been created in this run
+        self.partitions = set()
+
+        # Encoder for metadata that is not passed through as text
+        if config.json_encoder == 'orjson':
+            if orjson is None:
+                raise RuntimeError(
+                    'json_encoder orjson requires the orjson package, '
+                    'install the orjson extra',
+                )
+            self._json_dumps = lambda value: orjson.dumps(value).decode()
+        else:
+            self._json_dumps = json.dumps
+
+        # Extraction query for the configured metadata and policy filters
+        self.get_records_statement = PreparedStatement(
+            'pantasia_get_records',
+            GET_RECORDS_QUERY.format(
+                json_cast='::text' if config.json_passthrough else '',
+                metadata_hash=METADATA_HASH if config.dedup_metadata
+                else 'NULL::bytea',
+                mint_filter=_policy_filter(config, 'ma'),
+                out_filter=_policy_filter(config, 'ma2'),
+                spent_branch=SPENT_BRANCH_QUERY.format(
+                    spent_filter=_policy_filter(config, 'ma3'),
+                ) if config.wallet_balances else '',
+            ),
         )
 
+        # Plans of slow statements, None if turned off
+        self.plan_capture = None
+        if config.slow_query_threshold > 0:
+            self.plan_capture = PlanCapture(config)
+        # Period being synced and load operation running, for captured plans
+        self.period = None
+        self.operation = None
+
+        # Local cache of extracted records, None if turned off
+        self.record_cache = None
+        if config.record_cache_dir:
+            self.record_cache = RecordCache(
+                config, self.get_records_statement.query,
+            )
+
+        # Engine that loads periods, None for the blocking psycopg2 connection
+        if config.db_engine not in ('psycopg2', 'pipeline'):
+            raise RuntimeError(f'Unknown db_engine {config.db_engine}')
+        self.pipeline = None
+
+        # Connect and open cursors to perform database operations
+        self.cardano_replicas[0].connect()
+        for replica in self.cardano_replicas[1:]:
+            replica.connect(retry=False)
+        self.pantasia_conn = self.pantasia_pool.getconn()
+        self._open_cursors()
+        if config.db_engine == 'pipeline':
+            self.pipeline = PipelineEngine(config)
+
         # Get Cardano DB tip in datetime
         self.cardano_tip = self.get_latest_cardano_tip()
         self.old_cardano_tip = None
@@ -56,18 +322,48 @@ class Db:
         # Create tables if not yet existing
         self.pantasia_create()
 
+        # Without the postgres sink, the fact tables are only written to files.
+        # The other tables keep the ids that the files refer to
+        unknown = set(config.sinks) - {'postgres', 'parquet'}
+        if unknown or not config.sinks:
+            raise RuntimeError(f'Invalid sinks {sorted(config.sinks)}')
+        self.file_only_tables = set()
+        if 'postgres' not in config.sinks:
+            self.file_only_tables = {'asset_tx', 'asset_mint_tx', 'asset_ext'}
+
+        # Parallel load through staging tables, None to insert directly
+        if config.load_mode not in ('direct', 'staging'):
+            raise RuntimeError(f'Unknown load_mode {config.load_mode}')
+        self.staging = None
+        if config.load_mode == 'staging':
+            self.staging = StagingLoader(self)
+
         # Get Pantasia DB tip in datetime
         self.pantasia_tip = self.get_latest_pantasia_tip()
 
     @staticmethod
     def _measure_time(func: Callable) -> Callable:
-        def time_it(*args: any, **kwargs: any) -> None:
+        def time_it(*args: any, **kwargs: any) -> any:
+            values = kwargs.get('values')
+            # Name and size of the running operation, for slow plan capture
+            args[0].operation = (func.__name__, len(values or ()))
             time_started = time()
-            func(*args, **kwargs)
+            result = func(*args, **kwargs)
             time_elapsed = time()
-            values = kwargs.get('values')
 
             if values is not None:
+                metrics = args[0].metrics
+                if metrics is not None:
+                    metrics.observe(
+                        'pantasia_load_seconds',
+                        time_elapsed - time_started,
+                        operation=func.__name__,
+                    )
+                    metrics.inc(
+                        'pantasia_load_rows_total',
+                        len(values),
+                        operation=func.__name__,
+                    )
                 logger.debug(
                     '{execute} running time is {s} seconds for inserting {rows} rows.'
                     .format(
@@ -78,21 +374,119 @@ class Db:
                         rows=len(values),
                     ),
                 )
+            return result
 
         return time_it
 
+    def _cardano_pool(self, host: str, port: int) -> ConnectionPool:
+        return ConnectionPool(
+            'cardano',
+            dbname=self.config.cdb_name,
+            user=self.config.cdb_user,
+            password=self.config.cdb_pass,
+            host=host,
+            port=port,
+            config=self.config,
+            plan_cache_mode=self.config.cdb_plan_cache_mode,
+        )
+
+    @property
+    def cardano_conn(self) -> connection:
+        return self.cardano_replicas[0].conn
+
+    @property
+    def cardano_cur(self) -> RealDictCursor:
+        return self.cardano_replicas[0].cur
+
+    def _open_cursors(self) -> None:
+        self.pantasia_cur = self.pantasia_conn.cursor(
+            cursor_factory=RealDictCursor,
+        )
+
+    def check_connections(self) -> None:
+        # Reconnect if any of the connections is no longer usable
+        if not ConnectionPool.is_healthy(self.cardano_conn) \
+                or not ConnectionPool.is_healthy(self.pantasia_conn):
+            self.reconnect()
+
+    def reconnect(self) -> None:
+        # Replace broken connections and cursors, pending transactions are lost
+        logger.warning('Reconnecting to databases......')
+        for replica in self.cardano_replicas:
+            if replica.available and ConnectionPool.is_healthy(replica.conn):
+                replica.conn.rollback()
+            else:
+                # Only the primary is required, replicas may stay down
+                replica.connect(retry=replica.required)
+        if ConnectionPool.is_healthy(self.pantasia_conn):
+            self.pantasia_conn.rollback()
+        else:
+            self.pantasia_conn = self.pantasia_pool.reconnect(self.pantasia_conn)
+        self._open_cursors()
+        if self.pipeline is not None:
+            self.pipeline.connect()
+        logger.info('Database connections have been re-established.')
+
     def close_connections(self) -> None:
         logger.info('Canceling pending transactions and closing connections......')
-        self.cardano_conn.cancel()
-        self.cardano_cur.close()
-        self.cardano_conn.close()
-        self.pantasia_conn.cancel()
-        self.pantasia_cur.close()
-        self.pantasia_conn.close()
+        connections = [
+            (replica.conn, replica.cur)
+            for replica in self.cardano_replicas if replica.available
+        ]
+        connections.append((self.pantasia_conn, self.pantasia_cur))
+        if self.pipeline is not None:
+            self.pipeline.close()
+        if self.staging is not None:
+            self.staging.close()
+        for conn, cur in connections:
+            if not conn.closed:
+                conn.cancel()
+                cur.close()
+        for replica in self.cardano_replicas:
+            replica.pool.closeall()
+        self.pantasia_pool.closeall()
         logger.info('Database connections have been closed.')
 
     def pantasia_create_tables(self) -> None:
-        query = """
+        if self.config.partitioned_tables:
+            # Partition key must be part of the primary key
+            tx_primary_key = 'id, tx_time'
+            tx_partition_by = ' PARTITION BY RANGE (tx_time)'
+        else:
+            tx_primary_key = 'id'
+            tx_partition_by = ''
+
+        if self.config.binary_keys:
+            # Unique keys as raw bytes, bech32 text forms are kept unindexed
+            key_type = 'bytea'
+            wallet_address = (
+                'address varchar NOT NULL, '
+                'address_raw bytea UNIQUE NOT NULL,'
+            )
+            asset_fingerprint = (
+                'fingerprint varchar NOT NULL, '
+                'fingerprint_raw bytea UNIQUE NOT NULL,'
+            )
+        else:
+            key_type = 'varchar'
+            wallet_address = 'address varchar UNIQUE NOT NULL,'
+            asset_fingerprint = 'fingerprint varchar UNIQUE NOT NULL,'
+
+        if self.config.normalized_tx:
+            # Reference the tx table, tx_time is kept only as partition key
+            tx_columns = 'tx_id int8 NOT NULL,'
+            if self.config.partitioned_tables:
+                tx_columns = tx_columns + ' tx_time timestamp NOT NULL,'
+        else:
+            tx_columns = f'tx_hash {key_type} NOT NULL, tx_time timestamp NOT NULL,'
+
+        if self.config.dedup_metadata:
+            # Reference a unique document, image and files are derived from it
+            metadata_columns = 'metadata_id int8,'
+        else:
+            metadata_columns = 'image varchar, metadata jsonb, files jsonb,'
+
+        query = f"""
                 CREATE TABLE IF NOT EXISTS "user" (
                 id serial4 PRIMARY KEY,
                 pfp_asset_id int8,
@@ -104,46 +498,44 @@ class Db:
 
                 CREATE TABLE IF NOT EXISTS wallet (
                 id serial8 PRIMARY KEY,
-                address varchar UNIQUE NOT NULL,
+                {wallet_address}
                 address_type varchar (16) NOT NULL,
                 user_id int4
                 );
 
                 CREATE TABLE IF NOT EXISTS collection (
                 id serial4 PRIMARY KEY,
-                policy_id varchar UNIQUE NOT NULL,
+                policy_id {key_type} UNIQUE NOT NULL,
                 name varchar UNIQUE
                 );
 
                 CREATE TABLE IF NOT EXISTS asset (
                 id serial8 PRIMARY KEY,
                 collection_id int4 NOT NULL,
-                hash varchar UNIQUE NOT NULL,
+                hash {key_type} UNIQUE NOT NULL,
                 name varchar NOT NULL,
-                fingerprint varchar UNIQUE NOT NULL,
+                {asset_fingerprint}
                 current_wallet_id int8
                 );
 
                 CREATE TABLE IF NOT EXISTS asset_tx (
-                id serial8 PRIMARY KEY,
+                id serial8,
                 asset_id int8 NOT NULL,
                 wallet_id int8 NOT NULL,
                 quantity numeric (20,0) NOT NULL,
-                tx_hash varchar NOT NULL,
-                tx_time timestamp NOT NULL
-                );
+                {tx_columns}
+                PRIMARY KEY ({tx_primary_key})
+                ){tx_partition_by};
 
                 CREATE TABLE IF NOT EXISTS asset_mint_tx (
-                id serial8 PRIMARY KEY,
+                id serial8,
                 asset_id int8 NOT NULL,
                 wallet_id int8,
                 quantity numeric (20,0) NOT NULL,
-                tx_hash varchar NOT NULL,
-                tx_time timestamp NOT NULL,
-                image varchar,
-                metadata jsonb,
-                files jsonb
-                );
+                {tx_columns}
+                {metadata_columns}
+                PRIMARY KEY ({tx_primary_key})
+                ){tx_partition_by};
 
                 CREATE TABLE IF NOT EXISTS asset_ext (
                 id serial8 PRIMARY KEY,
@@ -151,10 +543,360 @@ class Db:
                 latest_mint_tx_id int8,
                 latest_tx_id int8
                 );
+
+                CREATE TABLE IF NOT EXISTS sync_checkpoint (
+                id int4 PRIMARY KEY,
+                tip timestamp NOT NULL,
+                next_ids jsonb NOT NULL,
+                modified timestamp NOT NULL
+                );
+                """
+
+        # Tables of optional features, only created when they are turned on
+        if self.config.normalized_tx:
+            query = query + f"""
+                CREATE TABLE IF NOT EXISTS tx (
+                id serial8 PRIMARY KEY,
+                hash {key_type} UNIQUE NOT NULL,
+                time timestamp NOT NULL,
+                block_no int4
+                );
+                """
+
+        if self.config.dedup_metadata:
+            query = query + """
+                CREATE TABLE IF NOT EXISTS mint_metadata (
+                id serial8 PRIMARY KEY,
+                hash bytea UNIQUE NOT NULL,
+                document jsonb NOT NULL
+                );
+                """
+
+        if self.config.wallet_balances:
+            query = query + """
+                CREATE TABLE IF NOT EXISTS wallet_asset_balance (
+                wallet_id int8 NOT NULL,
+                asset_id int8 NOT NULL,
+                quantity numeric (20,0) NOT NULL,
+                PRIMARY KEY (wallet_id, asset_id)
+                );
+
+                CREATE INDEX IF NOT EXISTS wallet_asset_balance_asset_id_idx
+                ON wallet_asset_balance (asset_id);
+                """
+
+        if self.config.collection_stats:
+            query = query + """
+                CREATE TABLE IF NOT EXISTS collection_holder (
+                collection_id int8 NOT NULL,
+                wallet_id int8 NOT NULL,
+                asset_count int8 NOT NULL,
+                PRIMARY KEY (collection_id, wallet_id)
+                );
+
+                CREATE TABLE IF NOT EXISTS collection_stats (
+                collection_id int8 PRIMARY KEY,
+                asset_count int8 NOT NULL,
+                mint_count int8 NOT NULL,
+                transfer_count int8 NOT NULL,
+                holder_count int8 NOT NULL,
+                first_activity timestamp,
+                last_activity timestamp
+                );
+                """
+
+        if 'table' in self.config.change_feed:
+            query = query + """
+                CREATE TABLE IF NOT EXISTS sync_changes (
+                id serial8 PRIMARY KEY,
+                tip timestamp NOT NULL,
+                changes jsonb NOT NULL,
+                created timestamp NOT NULL DEFAULT now()
+                );
                 """
         self.pantasia_cur.execute(query)
         self.pantasia_conn.commit()
 
+        # Tables may have been created before in another schema mode
+        for mode, table_name, column_name in (
+                ('binary_keys', 'wallet', 'address_raw'),
+                ('normalized_tx', 'asset_tx', 'tx_id'),
+                ('dedup_metadata', 'asset_mint_tx', 'metadata_id'),
+        ):
+            enabled = getattr(self.config, mode)
+            if self._pantasia_has_column(table_name, column_name) != enabled:
+                raise RuntimeError(
+                    f'Pantasia DB was created with {mode}={not enabled}, '
+                    f'the setting cannot be changed on an existing database',
+                )
+
+        if self.config.dedup_metadata:
+            self.pantasia_update_metadata_hashes()
+
+        self.pantasia_cur.execute(
+            """SELECT relname, relkind FROM pg_class
+            WHERE relname IN ('asset_tx', 'asset_mint_tx')
+            AND relnamespace = 'public'::regnamespace""",
+        )
+        self.pantasia_conn.commit()
+        relkinds = {
+            result['relname']: result['relkind']
+            for result in self.pantasia_cur.fetchall()
+        }
+        self.partitioned = all(
+            relkinds.get(table_name) == 'p'
+            for table_name in PARTITIONED_TABLES
+        )
+        if self.config.partitioned_tables and not self.partitioned:
+            logger.warning(
+                'asset_tx and asset_mint_tx already exist without partitions, '
+                'partitioned_tables only applies to a new database',
+            )
+
+        if self.partitioned:
+            # Small block range index for time range queries on each partition
+            for table_name in PARTITIONED_TABLES:
+                self.pantasia_cur.execute(
+                    f'CREATE INDEX IF NOT EXISTS {table_name}_tx_time_idx '
+                    f'ON {table_name} USING brin (tx_time)',
+                )
+            self.pantasia_conn.commit()
+
+        if self.config.normalized_tx:
+            # Per-transaction lookups on the fact tables
+            for table_name in PARTITIONED_TABLES:
+                self.pantasia_cur.execute(
+                    f'CREATE INDEX IF NOT EXISTS {table_name}_tx_id_idx '
+                    f'ON {table_name} (tx_id)',
+                )
+            self.pantasia_conn.commit()
+
+        # Balances are deltas, they cannot be derived for an already synced DB.
+        # Every sink mode saves the checkpoint, asset_tx stays empty without
+        # the postgres sink and is only checked for databases from before it.
+        # The table may be left from a run with wallet_balances turned on
+        self.pantasia_cur.execute(
+            """SELECT (EXISTS (SELECT 1 FROM sync_checkpoint)
+            OR EXISTS (SELECT 1 FROM asset_tx)) AS synced,
+            to_regclass('wallet_asset_balance') IS NOT NULL AS has_balances""",
+        )
+        result = self.pantasia_cur.fetchone()
+        synced = result['synced']
+        balances = False
+        if result['has_balances']:
+            self.pantasia_cur.execute(
+                'SELECT EXISTS (SELECT 1 FROM wallet_asset_balance) AS balances',
+            )
+            balances = self.pantasia_cur.fetchone()['balances']
+        self.pantasia_conn.commit()
+        if self.config.wallet_balances and synced and not balances:
+            raise RuntimeError(
+                'wallet_balances must be turned on before the first sync, '
+                'wallet_asset_balance is empty on a synced Pantasia DB',
+            )
+        if not self.config.wallet_balances and balances:
+            logger.warning(
+                'wallet_balances is turned off, '
+                'wallet_asset_balance will not be kept up to date',
+            )
+
+        # Holder counts are derived from the wallet balances
+        if self.config.collection_stats:
+            if not self.config.wallet_balances:
+                raise RuntimeError('collection_stats requires wallet_balances')
+            self.pantasia_cur.execute(
+                'SELECT EXISTS (SELECT 1 FROM collection_stats) AS stats',
+            )
+            self.pantasia_conn.commit()
+            if synced and not self.pantasia_cur.fetchone()['stats']:
+                logger.info('Building collection_stats from synced data')
+                self.pantasia_rebuild_collection_stats()
+
+        if self.config.binary_keys or self.config.normalized_tx \
+                or self.config.dedup_metadata:
+            self.pantasia_create_views()
+
+    def pantasia_update_metadata_hashes(self) -> None:
+        # Documents stored before hashes were taken in the extraction query
+        # were hashed in Python, hash them again once. The column comment
+        # records the hash in use
+        self.pantasia_cur.execute(
+            """SELECT col_description(a.attrelid, a.attnum)
+            IS NOT DISTINCT FROM 'sha256' AS current
+            FROM pg_attribute a
+            WHERE a.attrelid = 'mint_metadata'::regclass
+            AND a.attname = 'hash'""",
+        )
+        if not self.pantasia_cur.fetchone()['current']:
+            logger.info('Hashing mint_metadata documents again......')
+            self.pantasia_cur.execute(
+                """UPDATE mint_metadata
+                SET hash = sha256(convert_to(document::text, 'UTF8'))""",
+            )
+            self.pantasia_cur.execute(
+                "COMMENT ON COLUMN mint_metadata.hash IS 'sha256'",
+            )
+        self.pantasia_conn.commit()
+
+    def _pantasia_has_column(self, table_name: str, column_name: str) -> bool:
+        self.pantasia_cur.execute(
+            """SELECT count(*) AS found FROM information_schema.columns
+            WHERE table_schema = 'public'
+            AND table_name = %s
+            AND column_name = %s""",
+            (table_name, column_name),
+        )
+        self.pantasia_conn.commit()
+        return self.pantasia_cur.fetchone()['found'] > 0
+
+    def _fact_tx_columns(self) -> tuple:
+        # Text tx hash, tx time and the join needed for them, of a fact table f
+        tx_hash = 't.hash' if self.config.normalized_tx else 'f.tx_hash'
+        if self.config.binary_keys:
+            tx_hash = f"encode({tx_hash}, 'hex')"
+        if self.config.normalized_tx:
+            return tx_hash, 't.time', 'JOIN tx t ON t.id = f.tx_id'
+        return tx_hash, 'f.tx_time', ''
+
+    def pantasia_create_views(self) -> None:
+        # Text forms of binary keys, tx and metadata columns of the fact tables
+        tx_hash, tx_time, tx_join = self._fact_tx_columns()
+        tx_columns = f'{tx_hash} AS tx_hash, {tx_time} AS tx_time'
+
+        if self.config.dedup_metadata:
+            metadata_columns = (
+                "m.document ->> 'image' AS image, m.document AS metadata, "
+                "m.document -> 'files' AS files"
+            )
+            metadata_join = 'LEFT JOIN mint_metadata m ON m.id = f.metadata_id'
+        else:
+            metadata_columns = 'f.image, f.metadata, f.files'
+            metadata_join = ''
+
+        query = f"""
+                CREATE OR REPLACE VIEW asset_tx_text AS
+                SELECT f.id, f.asset_id, f.wallet_id, f.quantity, {tx_columns}
+                FROM asset_tx f
+                {tx_join};
+
+                CREATE OR REPLACE VIEW asset_mint_tx_text AS
+                SELECT f.id, f.asset_id, f.wallet_id, f.quantity, {tx_columns},
+                {metadata_columns}
+                FROM asset_mint_tx f
+                {tx_join}
+                {metadata_join};
+                """
+        if self.config.binary_keys:
+            query = query + """
+                CREATE OR REPLACE VIEW collection_text AS
+                SELECT id, encode(policy_id, 'hex') AS policy_id, name
+                FROM collection;
+
+                CREATE OR REPLACE VIEW asset_text AS
+                SELECT id,
+                collection_id,
+                encode(substring(hash FROM 1 FOR 28), 'hex')
+                || '.' || encode(substring(hash FROM 29), 'hex') AS hash,
+                name,
+                fingerprint,
+                current_wallet_id
+                FROM asset;
+                """
+        self.pantasia_cur.execute(query)
+        self.pantasia_conn.commit()
+
+    def pantasia_delete_period(
+            self,
+            from_datetime: datetime,
+            to_datetime: datetime,
+    ) -> set:
+        # Remove the fact rows of a period so that it can be synced again,
+        # returns the ids of the assets they belonged to
+        _, tx_time, tx_join = self._fact_tx_columns()
+        asset_ids = set()
+        for table_name, pointer in (
+            ('asset_tx', 'latest_tx_id'),
+            ('asset_mint_tx', 'latest_mint_tx_id'),
+        ):
+            period_rows = f"""SELECT f.id FROM {table_name} f {tx_join}
+            WHERE {tx_time} > %s AND {tx_time} <= %s"""
+            self.pantasia_cur.execute(
+                f'UPDATE asset_ext SET {pointer} = NULL '
+                f'WHERE {pointer} IN ({period_rows})',
+                (from_datetime, to_datetime),
+            )
+            self.pantasia_cur.execute(
+                f'DELETE FROM {table_name} WHERE id IN ({period_rows}) '
+                f'RETURNING asset_id',
+                (from_datetime, to_datetime),
+            )
+            asset_ids.update(row['asset_id'] for row in self.pantasia_cur.fetchall())
+        if self.config.normalized_tx:
+            self.pantasia_cur.execute(
+                'DELETE FROM tx WHERE time > %s AND time <= %s',
+                (from_datetime, to_datetime),
+            )
+        return asset_ids
+
+    def pantasia_update_latest(self, asset_ids: set) -> None:
+        # Point asset_ext and asset.current_wallet_id of the assets to their
+        # latest rows again, after a period has been synced out of order
+        _, tx_time, tx_join = self._fact_tx_columns()
+        for table_name, pointer, condition in (
+            ('asset_tx', 'latest_tx_id', ''),
+            ('asset_mint_tx', 'latest_mint_tx_id', ' AND f.quantity > 0'),
+        ):
+            self.pantasia_cur.execute(
+                f"""UPDATE asset_ext ae
+                SET {pointer} = (
+                    SELECT f.id FROM {table_name} f {tx_join}
+                    WHERE f.asset_id = ae.asset_id{condition}
+                    ORDER BY {tx_time} DESC, f.id DESC
+                    LIMIT 1
+                )
+                WHERE ae.asset_id = ANY(%s)""",
+                (list(asset_ids),),
+            )
+        self.pantasia_cur.execute(
+            """UPDATE asset a
+            SET current_wallet_id = f.wallet_id
+            FROM asset_ext ae
+            JOIN asset_tx f ON f.id = ae.latest_tx_id
+            WHERE ae.asset_id = a.id
+            AND a.id = ANY(%s)""",
+            (list(asset_ids),),
+        )
+
+    def pantasia_create_partitions(
+            self,
+            from_datetime: datetime,
+            to_datetime: datetime,
+    ) -> None:
+        # Create the monthly partitions covering a period, if not existing yet
+        if not self.partitioned:
+            return
+
+        month = datetime(from_datetime.year, from_datetime.month, 1)
+        while month <= to_datetime:
+            if month.month == 12:
+                next_month = datetime(month.year + 1, 1, 1)
+            else:
+                next_month = datetime(month.year, month.month + 1, 1)
+
+            if month not in self.partitions:
+                for table_name in PARTITIONED_TABLES:
+                    partition_name = f'{table_name}_y{month:%Y}m{month:%m}'
+                    logger.debug(f'Creating partition {partition_name}')
+                    self.pantasia_cur.execute(
+                        f"""CREATE TABLE IF NOT EXISTS {partition_name}
+                        PARTITION OF {table_name}
+                        FOR VALUES FROM ('{month}') TO ('{next_month}')""",
+                    )
+                self.pantasia_conn.commit()
+                self.partitions.add(month)
+
+            month = next_month
+
     def pantasia_add_foreign_key(
             self,
             table_name: str,
@@ -233,22 +975,126 @@ class Db:
         self.pantasia_add_foreign_key(
             'asset_ext', 'asset_id', 'asset', 'id',
         )
-        self.pantasia_add_foreign_key(
-            'asset_ext', 'latest_mint_tx_id', 'asset_mint_tx', 'id',
-        )
-        self.pantasia_add_foreign_key(
-            'asset_ext', 'latest_tx_id', 'asset_tx', 'id',
-        )
+        # Partitioned tables have no unique index on id alone to reference
+        if not self.partitioned:
+            self.pantasia_add_foreign_key(
+                'asset_ext', 'latest_mint_tx_id', 'asset_mint_tx', 'id',
+            )
+            self.pantasia_add_foreign_key(
+                'asset_ext', 'latest_tx_id', 'asset_tx', 'id',
+            )
+
+        if self.config.dedup_metadata:
+            self.pantasia_add_foreign_key(
+                'asset_mint_tx', 'metadata_id', 'mint_metadata', 'id',
+            )
+
+        if self.config.normalized_tx:
+            self.pantasia_add_foreign_key('asset_tx', 'tx_id', 'tx', 'id')
+            self.pantasia_add_foreign_key('asset_mint_tx', 'tx_id', 'tx', 'id')
+
+        if self.config.wallet_balances:
+            self.pantasia_add_foreign_key(
+                'wallet_asset_balance', 'wallet_id', 'wallet', 'id',
+            )
+            self.pantasia_add_foreign_key(
+                'wallet_asset_balance', 'asset_id', 'asset', 'id',
+            )
+
+        if self.config.collection_stats:
+            self.pantasia_add_foreign_key(
+                'collection_holder', 'collection_id', 'collection', 'id',
+            )
+            self.pantasia_add_foreign_key(
+                'collection_holder', 'wallet_id', 'wallet', 'id',
+            )
+            self.pantasia_add_foreign_key(
+                'collection_stats', 'collection_id', 'collection', 'id',
+            )
 
         self.pantasia_add_foreign_key('wallet', 'user_id', 'user', 'id')
         self.pantasia_conn.commit()
 
+    def pantasia_rebuild_collection_stats(self) -> None:
+        # Recompute collection_holder and collection_stats from the synced tables
+        if self.config.normalized_tx:
+            tx_time = 't.time'
+            tx_join = 'JOIN tx t ON t.id = f.tx_id'
+        else:
+            tx_time = 'f.tx_time'
+            tx_join = ''
+
+        query = f"""
+                TRUNCATE collection_holder, collection_stats;
+
+                INSERT INTO collection_holder (collection_id, wallet_id, asset_count)
+                SELECT a.collection_id, wab.wallet_id, count(*)
+                FROM wallet_asset_balance wab
+                JOIN asset a ON a.id = wab.asset_id
+                WHERE wab.quantity > 0
+                GROUP BY a.collection_id, wab.wallet_id;
+
+                WITH assets AS (
+                    SELECT collection_id, count(*) AS asset_count
+                    FROM asset
+                    GROUP BY collection_id
+                ),
+                mints AS (
+                    SELECT a.collection_id,
+                    count(*) FILTER (WHERE f.quantity > 0) AS mint_count,
+                    min({tx_time}) AS first_activity,
+                    max({tx_time}) AS last_activity
+                    FROM asset_mint_tx f
+                    {tx_join}
+                    JOIN asset a ON a.id = f.asset_id
+                    GROUP BY a.collection_id
+                ),
+                transfers AS (
+                    SELECT a.collection_id,
+                    count(*) AS transfer_count,
+                    min({tx_time}) AS first_activity,
+                    max({tx_time}) AS last_activity
+                    FROM asset_tx f
+                    {tx_join}
+                    JOIN asset a ON a.id = f.asset_id
+                    GROUP BY a.collection_id
+                ),
+                holders AS (
+                    SELECT collection_id, count(*) AS holder_count
+                    FROM collection_holder
+                    GROUP BY collection_id
+                )
+                INSERT INTO collection_stats
+                (collection_id, asset_count, mint_count, transfer_count,
+                holder_count, first_activity, last_activity)
+                SELECT assets.collection_id,
+                assets.asset_count,
+                coalesce(mints.mint_count, 0),
+                coalesce(transfers.transfer_count, 0),
+                coalesce(holders.holder_count, 0),
+                LEAST(mints.first_activity, transfers.first_activity),
+                GREATEST(mints.last_activity, transfers.last_activity)
+                FROM assets
+                LEFT JOIN mints ON mints.collection_id = assets.collection_id
+                LEFT JOIN transfers
+                ON transfers.collection_id = assets.collection_id
+                LEFT JOIN holders ON holders.collection_id = assets.collection_id;
+                """
+        self.pantasia_cur.execute(query)
+        self.pantasia_conn.commit()
+
     def pantasia_create(self) -> None:
         # Create Pantasia DB if not exist
         self.pantasia_create_tables()
         self.pantasia_create_fk()
 
     def pantasia_get_last_index(self, table_name: str) -> int:
+        # Read the next id from the checkpoint if it has been saved before
+        if self.pantasia_checkpoint is not None:
+            next_id = self.pantasia_checkpoint['next_ids'].get(table_name)
+            if next_id is not None:
+                return next_id
+
         self.pantasia_cur.execute(
             f'SELECT id FROM {table_name} ORDER BY id DESC LIMIT 1',
         )
@@ -261,51 +1107,97 @@ class Db:
 
     def get_latest_cardano_tip(self) -> datetime:
         # Get latest block time
-        self.cardano_cur.execute("""SELECT b.time AS cardano_tip
-            FROM block b
-            ORDER BY b.time DESC
-            LIMIT 1
-            OFFSET 3""")
-        self.pantasia_conn.commit()
+        GET_CARDANO_TIP.execute(self.cardano_cur)
+        result = self.cardano_cur.fetchone()
+        self.cardano_conn.commit()
 
         # cardano_tip delayed 2 minutes as a buffer
         # to allow cardano_db_sync to complete insertions
-        cardano_tip = self.cardano_cur.fetchone(
-        )['cardano_tip']
+        cardano_tip = result['cardano_tip']
         logger.info(f'Cardano DB Tip is at {cardano_tip}')
 
         self.cardano_tip = cardano_tip
+        self.cardano_tip_block_no = result['block_no']
         return cardano_tip
 
-    def get_latest_pantasia_tip(self) -> datetime:
-        # Get latest Pantasia tx time
-        self.pantasia_cur.execute("""WITH at_tip AS (
-            SELECT at2.tx_time
-            FROM asset_tx at2
-            ORDER BY at2.id DESC
-            LIMIT 1
-            ),
-        amt_tip AS (
-            SELECT amt.tx_time
-            FROM asset_mint_tx amt
-            ORDER BY amt.id DESC
-            LIMIT 1
-        )
-        SELECT att.tx_time AS pantasia_tip FROM at_tip att
-        UNION ALL
-        SELECT amtt.tx_time AS pantasia_tip FROM amt_tip amtt
-        ORDER BY pantasia_tip DESC
-        LIMIT 1""")
+    def get_replicas_at_tip(self) -> list:
+        # Get the Cardano DB replicas that have synced up to the Cardano tip
+        replicas = [self.cardano_replicas[0]]
+        for replica in self.cardano_replicas[1:]:
+            if not replica.available and not replica.connect(retry=False):
+                continue
+            block_no = replica.get_block_no()
+            if block_no is not None and block_no >= self.cardano_tip_block_no:
+                replicas.append(replica)
+            else:
+                logger.warning(
+                    f'Skipping Cardano DB replica {replica.name}, '
+                    f'block {block_no} is behind tip {self.cardano_tip_block_no}',
+                )
+        return replicas
+
+    def pantasia_get_checkpoint(self) -> dict | None:
+        GET_CHECKPOINT.execute(self.pantasia_cur)
         self.pantasia_conn.commit()
+        self.pantasia_checkpoint = self.pantasia_cur.fetchone()
+        return self.pantasia_checkpoint
+
+    def pantasia_save_checkpoint(self, tip: datetime, next_ids: dict) -> None:
+        # Must run in the same transaction as the batch it checkpoints
+        if self.pipeline is not None:
+            self.pipeline.send(SAVE_CHECKPOINT.query, (tip, json.dumps(next_ids)))
+            return
+        SAVE_CHECKPOINT.execute(self.pantasia_cur, (tip, Json(next_ids)))
+
+    def pantasia_insert_sync_changes(self, tip: datetime, changes: str) -> None:
+        query_str = 'INSERT INTO sync_changes (tip, changes) VALUES (%s, %s)'
+        if self.pipeline is not None:
+            self.pipeline.send(query_str, (tip, changes))
+            return
+        self.pantasia_cur.execute(query_str, (tip, changes))
+
+    def pantasia_notify(self, channel: str, payload: str) -> None:
+        # Delivered to listeners when the transaction commits
+        query_str = 'SELECT pg_notify(%s, %s)'
+        if self.pipeline is not None:
+            self.pipeline.send(query_str, (channel, payload))
+            return
+        self.pantasia_cur.execute(query_str, (channel, payload))
+
+    def pantasia_commit(self) -> None:
+        # Commit the period, sending the statements still queued by the pipeline
+        if self.pipeline is not None:
+            self.pipeline.commit()
+        else:
+            self.pantasia_conn.commit()
+
+    def pantasia_rollback(self) -> None:
+        if self.pipeline is not None:
+            self.pipeline.rollback()
+        self.pantasia_conn.rollback()
 
-        pantasia_tip = self.pantasia_cur.fetchone()
+    def get_latest_pantasia_tip(self) -> datetime:
+        # Get the sync position from the checkpoint
+        checkpoint = self.pantasia_get_checkpoint()
 
-        if pantasia_tip is not None:
-            pantasia_tip = pantasia_tip['pantasia_tip']
+        if checkpoint is not None:
+            pantasia_tip = checkpoint['tip']
         else:
-            # Genesis - First block containing native assets
-            logger.info('pantasia_tip not found, starting from Genesis')
-            pantasia_tip = datetime.fromisoformat('2021-03-01 21:47:00.000')
+            # No checkpoint saved yet, get latest Pantasia tx time
+            if self.config.normalized_tx:
+                GET_PANTASIA_TX_TIP.execute(self.pantasia_cur)
+            else:
+                GET_PANTASIA_TIP.execute(self.pantasia_cur)
+            self.pantasia_conn.commit()
+
+            pantasia_tip = self.pantasia_cur.fetchone()
+
+            if pantasia_tip is not None:
+                pantasia_tip = pantasia_tip['pantasia_tip']
+            else:
+                # Genesis - First block containing native assets
+                logger.info('pantasia_tip not found, starting from Genesis')
+                pantasia_tip = datetime.fromisoformat('2021-03-01 21:47:00.000')
 
         logger.info(f'Pantasia DB Tip is at {pantasia_tip}')
         self.pantasia_tip = pantasia_tip
@@ -328,134 +1220,228 @@ class Db:
             self,
             target_datetime: datetime,
             from_datetime: datetime,
+            cursor: RealDictCursor | None = None,
     ) -> list:
-        query = """
-                WITH all_ma_tx AS
-                (SELECT mtm.ident AS ma_id,
-                      encode(ma.policy::bytea, 'hex'::text) AS policy_id,
-                      encode(ma.name::bytea, 'escape'::text) AS asset_name,
-                      encode(ma.name::bytea, 'hex'::text) AS asset_name_hash,
-                      ma.fingerprint AS asset_fingerprint,
-                      mtm.quantity,
-                      mtm.tx_id,
-                      NULL AS address,
-                      NULL AS stake_address
-                FROM ma_tx_mint mtm
-                JOIN tx t ON t.id = mtm.tx_id
-                JOIN block b ON b.id = t.block_id
-                JOIN multi_asset ma ON ma.id = mtm.ident
-                WHERE mtm.quantity < 0
-                 AND b."time" > %s
-                 AND b."time" <= %s
-                UNION ALL SELECT mto.ident AS ma_id,
-                                encode(ma2.policy::bytea, 'hex'::text) AS policy_id,
-                                encode(ma2.name::bytea, 'escape'::text) AS asset_name,
-                                encode(ma2.name::bytea, 'hex'::text) AS asset_name_hash,
-                                ma2.fingerprint,
-                                mto.quantity,
-                                to2.tx_id,
-                                to2.address,
-                                sa."view" AS stake_address
-                FROM ma_tx_out mto
-                JOIN tx_out to2 ON mto.tx_out_id = to2.id
-                JOIN tx t2 ON to2.tx_id = t2.id
-                JOIN block b2 ON t2.block_id = b2.id
-                JOIN multi_asset ma2 ON ma2.id = mto.ident
-                LEFT OUTER JOIN stake_address sa ON to2.stake_address_id = sa.id
-                WHERE b2."time" > %s
-                 AND b2."time" <= %s )
-                SELECT policy_id,
-                   asset_fingerprint,
-                   asset_name,
-                   asset_name_hash,
-                   encode(t3.hash, 'hex') AS tx_hash,
-                   quantity,
-                   address,
-                   stake_address,
-                   is_mint_tx,
-                   b3."time" AS tx_time,
-                   image,
-                   files,
-                   metadata
-                FROM all_ma_tx amt
-                LEFT JOIN LATERAL
-                (SELECT true AS is_mint_tx,
-                    tm."key",
-                    tm.json -> amt.policy_id -> amt.asset_name ->> 'image' AS image,
-                    tm.json -> amt.policy_id -> amt.asset_name AS metadata,
-                    tm.json -> amt.policy_id -> amt.asset_name -> 'files' AS files
-                FROM ma_tx_mint mtm2
-                LEFT OUTER JOIN tx_metadata tm ON tm.tx_id = amt.tx_id
-                AND tm."key" = 721
-                WHERE (mtm2.ident = amt.ma_id
-                 AND mtm2.tx_id = amt.tx_id)) label_mint_tx ON true
-                JOIN tx t3 ON amt.tx_id = t3.id
-                JOIN block b3 ON t3.block_id = b3.id
-                ORDER BY b3.time asc
-                """
-        values = (
-            from_datetime, target_datetime,
-            from_datetime, target_datetime,
+        # Replay the period from the local cache if it has been extracted before
+        if self.record_cache is not None:
+            records = self.record_cache.get(from_datetime, target_datetime)
+            if records is not None:
+                return records
+
+        # Use the primary Cardano DB unless a replica cursor is given
+        if cursor is None:
+            cursor = self.cardano_cur
+        branches = 3 if self.config.wallet_balances else 2
+        values = (from_datetime, target_datetime) * branches
+        time_started = time()
+        self.get_records_statement.execute(cursor, values)
+        records = cursor.fetchall()
+        cursor.connection.commit()
+        time_elapsed = time() - time_started
+
+        # Re-run a sample of slow extractions under EXPLAIN ANALYZE
+        plan_capture = self.plan_capture
+        if plan_capture is not None and time_elapsed >= plan_capture.threshold \
+                and plan_capture.sampled():
+            self.get_records_statement.explain(cursor, values, EXPLAIN_OPTIONS)
+            plan = cursor.fetchone()['QUERY PLAN']
+            cursor.connection.commit()
+            plan_capture.record(
+                'pantasia_get_records', (from_datetime, target_datetime),
+                len(records), time_elapsed, plan,
+            )
+
+        if self.record_cache is not None:
+            self.record_cache.put(from_datetime, target_datetime, records)
+        return records
+
+    def pantasia_prefetch_records(
+            self,
+            target_datetime: datetime,
+            from_datetime: datetime,
+    ) -> Future:
+        # Extract on the pipeline engine while the running period is loaded,
+        # plans of slow prefetched extractions are not captured
+        if self.record_cache is not None:
+            records = self.record_cache.get(from_datetime, target_datetime)
+            if records is not None:
+                future = Future()
+                future.set_result(records)
+                return future
+
+        branches = 3 if self.config.wallet_balances else 2
+        future = self.pipeline.extract(
+            self.get_records_statement.query,
+            (from_datetime, target_datetime) * branches,
         )
-        self.cardano_cur.execute(query, values)
-        self.cardano_conn.commit()
-        return self.cardano_cur.fetchall()
+        if self.record_cache is not None:
+            def put(done: Future) -> None:
+                if not done.cancelled() and done.exception() is None:
+                    self.record_cache.put(
+                        from_datetime, target_datetime, done.result(),
+                    )
+            future.add_done_callback(put)
+        return future
 
     @_measure_time
     def pantasia_insert_wallet(self, values: list) -> None:
-        argument_string = ','.join(
-            f"({a}, '{b}', '{c}')" for (a, b, c) in values
-        )
-        query_str = 'INSERT INTO wallet (id, address, address_type) VALUES' + \
-                    argument_string
-        self.pantasia_cur.execute(query_str)
+        if self.config.binary_keys:
+            argument_string = ','.join(
+                f"({a}, '{b}', {_key_literal(c)}, '{d}')" for (a, b, c, d) in values
+            )
+            query_str = 'INSERT INTO wallet ' \
+                        '(id, address, address_raw, address_type) VALUES' + \
+                        argument_string
+        else:
+            argument_string = ','.join(
+                f"({a}, '{b}', '{d}')" for (a, b, _, d) in values
+            )
+            query_str = 'INSERT INTO wallet (id, address, address_type) VALUES' + \
+                        argument_string
+        self._execute_load(query_str)
 
     @_measure_time
     def pantasia_insert_collection(self, values: list) -> None:
         argument_string = ','.join(
-            f"({a}, '{b}')"
+            f'({a}, {_key_literal(b)})'
             for (a, b) in values
         )
         query_str = 'INSERT INTO collection (id, policy_id) VALUES' + \
                     argument_string
+        self._execute_load(query_str)
+
+    @_measure_time
+    def pantasia_insert_tx(self, values: list) -> None:
+        argument_string = ','.join(
+            f"({a}, {_key_literal(b)}, TIMESTAMP '{c}', {d})"
+            for (a, b, c, d) in values
+        )
+        query_str = 'INSERT INTO tx (id, hash, time, block_no) VALUES' + \
+                    argument_string
+        self._execute_load(query_str)
+
+    def _execute_load(self, query_str: str) -> None:
+        # The pipeline engine sends the statement later with the rest of the
+        # period, its timings only cover building the statement
+        if self.pipeline is not None:
+            self.pipeline.send(query_str)
+            return
+
+        # A sample of load statements runs under EXPLAIN ANALYZE, which still
+        # performs the write, and the plan is kept if the statement was slow
+        plan_capture = self.plan_capture
+        if plan_capture is None or not plan_capture.sampled():
+            self.pantasia_cur.execute(query_str)
+            return
+
+        time_started = time()
+        self.pantasia_cur.execute(f'EXPLAIN {EXPLAIN_OPTIONS} {query_str}')
+        plan = self.pantasia_cur.fetchone()['QUERY PLAN']
+        time_elapsed = time() - time_started
+        if time_elapsed >= plan_capture.threshold:
+            operation, rows = self.operation or ('load', 0)
+            plan_capture.record(operation, self.period, rows, time_elapsed, plan)
+
+    def _fetch_load(self, query_str: str) -> list:
+        # Load statement whose returned rows are needed right away
+        if self.pipeline is not None:
+            return self.pipeline.fetch(query_str)
         self.pantasia_cur.execute(query_str)
+        return self.pantasia_cur.fetchall()
+
+    def _tx_columns(self) -> str:
+        # Columns referencing the tx of an asset_tx/asset_mint_tx row
+        if not self.config.normalized_tx:
+            return 'tx_hash, tx_time'
+        if self.partitioned:
+            return 'tx_id, tx_time'
+        return 'tx_id'
+
+    def _tx_values(self, tx_ref: str | bytes | int, tx_time: datetime) -> str:
+        # tx_ref is the tx hash, or the tx id if the tx table is normalized
+        if not self.config.normalized_tx:
+            return f"{_key_literal(tx_ref)}, TIMESTAMP '{tx_time}'"
+        if self.partitioned:
+            return f"{tx_ref}, TIMESTAMP '{tx_time}'"
+        return f'{tx_ref}'
+
+    def _json_literal(self, value: any) -> str:
+        # SQL literal of a metadata column, pass-through text is written as is
+        if not self.config.json_passthrough:
+            value = self._json_dumps(value)
+        elif value is None:
+            value = 'null'
+        return "'" + value.replace("'", "''") + "'"
 
     @_measure_time
-    def pantasia_insert_asset_mint_tx(self, values: list) -> None:
+    def pantasia_insert_mint_metadata(self, values: list) -> None:
         argument_string = ','.join(
-            f"({a}, {b}, {c}, {d}, '{e}', TIMESTAMP '{f}', $${g}$$, {h}, {i})" for
-            (a, b, c, d, e, f, g, h, i) in
-            values
+            f'({a}, {_key_literal(b)}, {self._json_literal(c)})'
+            for (a, b, c) in values
         )
+        query_str = 'INSERT INTO mint_metadata (id, hash, document) VALUES' + \
+                    argument_string
+        self._execute_load(query_str)
+
+    @_measure_time
+    def pantasia_insert_asset_mint_tx(self, values: list) -> None:
+        tx_columns = self._tx_columns()
+        if self.config.dedup_metadata:
+            # Metadata is the mint_metadata id, image and files are not stored
+            argument_string = ','.join(
+                f'({a}, {b}, {c}, {d}, {self._tx_values(e, f)}, {h})' for
+                (a, b, c, d, e, f, _, h, _) in
+                values
+            )
+            metadata_columns = 'metadata_id'
+        else:
+            argument_string = ','.join(
+                f'({a}, {b}, {c}, {d}, {self._tx_values(e, f)}, '
+                f'$${g}$$, {self._json_literal(h)}, {self._json_literal(i)})' for
+                (a, b, c, d, e, f, g, h, i) in
+                values
+            )
+            metadata_columns = 'image, metadata, files'
         query_str = 'INSERT INTO asset_mint_tx ' \
                     '(id, asset_id, wallet_id, quantity, ' \
-                    'tx_hash, tx_time, image, metadata, files) ' \
+                    f'{tx_columns}, {metadata_columns}) ' \
                     'VALUES' + argument_string
-        self.pantasia_cur.execute(query_str)
+        self._execute_load(query_str)
 
     @_measure_time
     def pantasia_insert_asset_tx(self, values: list) -> None:
+        tx_columns = self._tx_columns()
         argument_string = ','.join(
-            f"({a}, {b}, {c}, {d}, '{e}', TIMESTAMP '{f}')" for (a, b, c, d, e, f) in
-            values
+            f'({a}, {b}, {c}, {d}, {self._tx_values(e, f)})'
+            for (a, b, c, d, e, f) in values
         )
         query_str = 'INSERT INTO asset_tx ' \
                     '(id, asset_id, wallet_id, ' \
-                    'quantity, tx_hash, tx_time) ' \
+                    f'quantity, {tx_columns}) ' \
                     'VALUES' + argument_string
-        self.pantasia_cur.execute(query_str)
+        self._execute_load(query_str)
 
     @_measure_time
     def pantasia_insert_asset(self, values: list) -> None:
-        argument_string = ','.join(
-            f"({a}, {b}, '{c}', '{d}', '{e}', {f})" for (a, b, c, d, e, f)
-            in values
-        )
-        query_str = 'INSERT INTO asset ' \
-                    '(id, collection_id, hash, name, ' \
-                    'fingerprint, current_wallet_id) ' \
-                    'VALUES' + argument_string
-        self.pantasia_cur.execute(query_str)
+        if self.config.binary_keys:
+            argument_string = ','.join(
+                f"({a}, {b}, {_key_literal(c)}, '{d}', '{e}', {_key_literal(f)}, {g})"
+                for (a, b, c, d, e, f, g) in values
+            )
+            query_str = 'INSERT INTO asset ' \
+                        '(id, collection_id, hash, name, ' \
+                        'fingerprint, fingerprint_raw, current_wallet_id) ' \
+                        'VALUES' + argument_string
+        else:
+            argument_string = ','.join(
+                f"({a}, {b}, '{c}', '{d}', '{e}', {g})" for (a, b, c, d, e, _, g)
+                in values
+            )
+            query_str = 'INSERT INTO asset ' \
+                        '(id, collection_id, hash, name, ' \
+                        'fingerprint, current_wallet_id) ' \
+                        'VALUES' + argument_string
+        self._execute_load(query_str)
 
     @_measure_time
     def pantasia_insert_asset_ext(self, values: list) -> None:
@@ -466,7 +1452,7 @@ class Db:
         query_str = 'INSERT INTO asset_ext ' \
                     '(id, asset_id, latest_mint_tx_id, latest_tx_id) ' \
                     'VALUES' + argument_string
-        self.pantasia_cur.execute(query_str)
+        self._execute_load(query_str)
 
     @_measure_time
     def pantasia_update_asset_ext_latest_mint_tx_id(self, values: list) -> None:
@@ -477,7 +1463,7 @@ class Db:
         SET latest_mint_tx_id = v.latest_mint_tx_id
         FROM (VALUES{argument_string}) AS v(asset_id, latest_mint_tx_id)
         WHERE ae.asset_id = v.asset_id"""
-        self.pantasia_cur.execute(query_str)
+        self._execute_load(query_str)
 
     @_measure_time
     def pantasia_update_asset_ext_latest_tx_id(self, values: list) -> None:
@@ -488,7 +1474,7 @@ class Db:
         SET latest_tx_id = v.latest_tx_id
         FROM (VALUES{argument_string}) AS v(asset_id, latest_tx_id)
         WHERE ae.asset_id = v.asset_id"""
-        self.pantasia_cur.execute(query_str)
+        self._execute_load(query_str)
 
     @_measure_time
     def pantasia_update_asset_current_wallet_id(self, values: list) -> None:
@@ -499,4 +1485,82 @@ class Db:
         SET current_wallet_id = v.current_wallet_id
         FROM (VALUES{argument_string}) AS v(id, current_wallet_id)
         WHERE a.id = v.id"""
-        self.pantasia_cur.execute(query_str)
+        self._execute_load(query_str)
+
+    @_measure_time
+    def pantasia_upsert_wallet_asset_balance(self, values: list) -> list:
+        # Apply the net quantity deltas of a period, dropping emptied balances.
+        # Returns the new quantity per (wallet_id, asset_id)
+        argument_string = ','.join(
+            f'({a}, {b}, {c})' for (a, b, c, _) in values
+        )
+        query_str = f"""INSERT INTO wallet_asset_balance
+        (wallet_id, asset_id, quantity)
+        VALUES{argument_string}
+        ON CONFLICT (wallet_id, asset_id) DO UPDATE
+        SET quantity = wallet_asset_balance.quantity + EXCLUDED.quantity
+        RETURNING wallet_id, asset_id, quantity"""
+        balances = [
+            ((row['wallet_id'], row['asset_id']), row['quantity'])
+            for row in self._fetch_load(query_str)
+        ]
+
+        query_str = f"""DELETE FROM wallet_asset_balance AS wab
+        USING (VALUES{argument_string}) AS v(wallet_id, asset_id, quantity)
+        WHERE wab.wallet_id = v.wallet_id
+        AND wab.asset_id = v.asset_id
+        AND wab.quantity = 0"""
+        self._execute_load(query_str)
+        return balances
+
+    @_measure_time
+    def pantasia_upsert_collection_holder(self, values: list) -> list:
+        # Apply the changes in held assets per collection and wallet.
+        # Returns the new asset count per (collection_id, wallet_id)
+        argument_string = ','.join(
+            f'({a}, {b}, {c})' for (a, b, c) in values
+        )
+        query_str = f"""INSERT INTO collection_holder
+        (collection_id, wallet_id, asset_count)
+        VALUES{argument_string}
+        ON CONFLICT (collection_id, wallet_id) DO UPDATE
+        SET asset_count = collection_holder.asset_count + EXCLUDED.asset_count
+        RETURNING collection_id, wallet_id, asset_count"""
+        holders = [
+            ((row['collection_id'], row['wallet_id']), row['asset_count'])
+            for row in self._fetch_load(query_str)
+        ]
+
+        query_str = f"""DELETE FROM collection_holder AS ch
+        USING (VALUES{argument_string}) AS v(collection_id, wallet_id, asset_count)
+        WHERE ch.collection_id = v.collection_id
+        AND ch.wallet_id = v.wallet_id
+        AND ch.asset_count = 0"""
+        self._execute_load(query_str)
+        return holders
+
+    @_measure_time
+    def pantasia_upsert_collection_stats(self, values: list) -> None:
+        def timestamp(value: datetime | None) -> str:
+            return 'NULL' if value is None else f"TIMESTAMP '{value}'"
+
+        argument_string = ','.join(
+            f'({a}, {b}, {c}, {d}, {e}, {timestamp(f)}, {timestamp(g)})'
+            for (a, b, c, d, e, f, g) in values
+        )
+        query_str = f"""INSERT INTO collection_stats
+        (collection_id, asset_count, mint_count, transfer_count,
+        holder_count, first_activity, last_activity)
+        VALUES{argument_string}
+        ON CONFLICT (collection_id) DO UPDATE
+        SET asset_count = collection_stats.asset_count + EXCLUDED.asset_count,
+        mint_count = collection_stats.mint_count + EXCLUDED.mint_count,
+        transfer_count = collection_stats.transfer_count + EXCLUDED.transfer_count,
+        holder_count = collection_stats.holder_count + EXCLUDED.holder_count,
+        first_activity = LEAST(
+            collection_stats.first_activity, EXCLUDED.first_activity
+        ),
+        last_activity = GREATEST(
+            collection_stats.last_activity, EXCLUDED.last_activity
+        )"""
+        self._execute_load(query_str)
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+
+from psycopg2 import InterfaceError
+from psycopg2 import OperationalError
+from psycopg2.extras import RealDictCursor
+
+from .pool import ConnectionPool
+
+logger = logging.getLogger('pantasia-db-sync')
+
+# Aggregates of the rows that become asset_mint_tx (is_mint) and asset_tx rows,
+# over the extraction query itself so that the same filters apply
+SOURCE_AGGREGATES_QUERY = """
+        SELECT r.is_mint_tx IS TRUE AS is_mint,
+           count(*) AS row_count,
+           coalesce(sum(r.quantity), 0) AS quantity,
+           md5(string_agg(DISTINCT r.tx_hash, ',' ORDER BY r.tx_hash)) AS tx_checksum
+        FROM ({records_query}) r
+        WHERE NOT r.is_spent
+        GROUP BY 1
+        """
+
+PANTASIA_AGGREGATES_QUERY = """
+        SELECT {is_mint} AS is_mint,
+           count(*) AS row_count,
+           coalesce(sum(f.quantity), 0) AS quantity,
+           md5(string_agg(DISTINCT {tx_hash}, ',' ORDER BY {tx_hash})) AS tx_checksum
+        FROM {table_name} f
+        {tx_join}
+        WHERE {tx_time} > %s
+         AND {tx_time} <= %s
+        """
+
+# Aggregates of a side without rows
+EMPTY = (0, 0, None)
+
+
+def split_windows(from_datetime: datetime, to_datetime: datetime, minutes: int) -> list:
+    windows = []
+    while from_datetime < to_datetime:
+        window_end = min(from_datetime + timedelta(minutes=minutes), to_datetime)
+        windows.append((from_datetime, window_end))
+        from_datetime = window_end
+    return windows
+
+
+# Compares per-window aggregates of cardano-db-sync and of the Pantasia fact
+# tables, with windows spread across a pool of connections to each database
+class Reconciler:
+    def __init__(self, database, workers: int) -> None:
+        config = database.config
+        if database.file_only_tables:
+            raise RuntimeError('Verification requires the postgres sink')
+        self.db = database
+        self.cardano_pool = ConnectionPool(
+            'cardano-verify',
+            dbname=config.cdb_name,
+            user=config.cdb_user,
+            password=config.cdb_pass,
+            host=config.cdb_host,
+            port=config.cdb_port,
+            config=config,
+            size=workers,
+            plan_cache_mode=config.cdb_plan_cache_mode,
+        )
+        self.pantasia_pool = ConnectionPool(
+            'pantasia-verify',
+            dbname=config.db_name,
+            user=config.db_user,
+            password=config.db_pass,
+            host=config.db_host,
+            port=config.db_port,
+            config=config,
+            size=workers,
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='pantasia-verify',
+        )
+        self.branches = 3 if config.wallet_balances else 2
+        self.source_query = SOURCE_AGGREGATES_QUERY.format(
+            records_query=database.get_records_statement.query,
+        )
+        tx_hash, tx_time, tx_join = database._fact_tx_columns()
+        self.pantasia_query = 'UNION ALL'.join(
+            PANTASIA_AGGREGATES_QUERY.format(
+                is_mint=is_mint, table_name=table_name, tx_hash=tx_hash,
+                tx_time=tx_time, tx_join=tx_join,
+            )
+            for is_mint, table_name in (
+                ('true', 'asset_mint_tx'), ('false', 'asset_tx'),
+            )
+        )
+
+    @staticmethod
+    def _aggregates(pool: ConnectionPool, query: str, params: tuple) -> dict:
+        conn = pool.getconn()
+        close = False
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, params)
+                rows = cur.fetchall()
+            conn.commit()
+        except (OperationalError, InterfaceError):
+            close = True
+            raise
+        finally:
+            pool.putconn(conn, close=close)
+        return {
+            row['is_mint']: (row['row_count'], row['quantity'], row['tx_checksum'])
+            for row in rows
+            if row['row_count'] > 0
+        }
+
+    def compare(self, from_datetime: datetime, to_datetime: datetime) -> dict | None:
+        # Differences of one window, None if both sides match
+        source = self._aggregates(
+            self.cardano_pool,
+            self.source_query,
+            (from_datetime, to_datetime) * self.branches,
+        )
+        pantasia = self._aggregates(
+            self.pantasia_pool,
+            self.pantasia_query,
+            (from_datetime, to_datetime) * 2,
+        )
+        differences = {}
+        for is_mint, table_name in ((True, 'asset_mint_tx'), (False, 'asset_tx')):
+            expected = source.get(is_mint, EMPTY)
+            found = pantasia.get(is_mint, EMPTY)
+            if expected != found:
+                differences[table_name] = {
+                    'source': {
+                        'rows': expected[0],
+                        'quantity': str(expected[1]),
+                        'tx_checksum': expected[2],
+                    },
+                    'pantasia': {
+                        'rows': found[0],
+                        'quantity': str(found[1]),
+                        'tx_checksum': found[2],
+                    },
+                }
+        if not differences:
+            return None
+        return {
+            'from': from_datetime.isoformat(),
+            'to': to_datetime.isoformat(),
+            'tables': differences,
+        }
+
+    def verify(self, windows: list) -> list:
+        # Windows that differ, in order
+        results = self.executor.map(lambda window: self.compare(*window), windows)
+        return [result for result in results if result is not None]
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.cardano_pool.closeall()
+        self.pantasia_pool.closeall()
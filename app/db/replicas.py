@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import logging
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from queue import Queue
+
+from psycopg2 import InterfaceError
+from psycopg2 import OperationalError
+from psycopg2.extras import RealDictCursor
+
+from .pool import ConnectionPool
+from .statements import PreparedStatement
+
+logger = logging.getLogger('pantasia-db-sync')
+
+GET_BLOCK_NO = PreparedStatement(
+    'get_replica_block_no',
+    'SELECT max(b.block_no) AS block_no FROM block b',
+)
+
+
+# A cardano-db-sync instance that extraction queries can be sent to
+class CardanoReplica:
+    def __init__(self, pool: ConnectionPool, required: bool = False) -> None:
+        self.pool = pool
+        # The primary is required, its connection errors are raised
+        self.required = required
+        self.conn = None
+        self.cur = None
+        # Latest block_no seen on this replica, None if unknown
+        self.block_no = None
+
+    @property
+    def name(self) -> str:
+        return f'{self.pool.host}:{self.pool.port}'
+
+    @property
+    def available(self) -> bool:
+        return self.conn is not None and not self.conn.closed
+
+    def connect(self, retry: bool = True) -> bool:
+        # Open (or re-open) the connection, returns False if replica is down
+        try:
+            if self.conn is None:
+                self.conn = self.pool.getconn(retry=retry)
+            else:
+                self.conn = self.pool.reconnect(self.conn, retry=retry)
+        except OperationalError:
+            self.conn = None
+            self.cur = None
+            if self.required:
+                raise
+            logger.warning(f'Cardano DB replica {self.name} is unavailable')
+            return False
+        self.cur = self.conn.cursor(cursor_factory=RealDictCursor)
+        return True
+
+    def get_block_no(self) -> int | None:
+        # Get the latest block number synced by this replica
+        try:
+            GET_BLOCK_NO.execute(self.cur)
+            self.block_no = self.cur.fetchone()['block_no']
+            self.conn.commit()
+        except (OperationalError, InterfaceError):
+            logger.warning(f'Lost connection to Cardano DB replica {self.name}')
+            self.pool.putconn(self.conn, close=True)
+            self.conn = None
+            self.cur = None
+            self.block_no = None
+        return self.block_no
+
+
+# Fetches records of upcoming periods ahead of time, spread across replicas
+class RecordFetcher:
+    def __init__(self, database) -> None:
+        self.db = database
+        self._replicas = Queue()
+        self._futures = {}
+        self._executor = None
+        self.size = 0
+
+    def start_round(self) -> None:
+        # Use only the replicas that have synced up to the chosen Cardano tip
+        self.reset()
+        replicas = self.db.get_replicas_at_tip()
+        for replica in replicas:
+            self._replicas.put(replica)
+        self.size = len(replicas)
+        if self.size > 1 and self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=len(self.db.cardano_replicas),
+                thread_name_prefix='cardano-extract',
+            )
+
+    def _fetch(self, to_datetime: datetime, from_datetime: datetime) -> list:
+        replica = self._replicas.get()
+        try:
+            logger.debug(
+                f'Retrieving FROM: {from_datetime} TO: {to_datetime} '
+                f'from Cardano DB {replica.name}',
+            )
+            return self.db.pantasia_get_records(
+                to_datetime, from_datetime, cursor=replica.cur,
+            )
+        finally:
+            self._replicas.put(replica)
+
+    @property
+    def window(self) -> int:
+        # Number of upcoming periods that prefetch() keeps in flight
+        if self.size <= 1 and self.db.pipeline is not None:
+            return 2
+        return max(self.size, 1)
+
+    def scheduled(self, from_datetime: datetime, to_datetime: datetime) -> bool:
+        return (from_datetime, to_datetime) in self._futures
+
+    def prefetch(self, period_list: list) -> None:
+        # Schedule extraction of the next periods, one in flight per replica.
+        # The pipeline engine extracts the next period while this one loads
+        if self.size <= 1 and self.db.pipeline is not None:
+            for from_datetime, to_datetime in list(
+                zip(period_list, period_list[1:]),
+            )[:2]:
+                if (from_datetime, to_datetime) not in self._futures:
+                    self._futures[(from_datetime, to_datetime)] = \
+                        self.db.pantasia_prefetch_records(to_datetime, from_datetime)
+            return
+        if self.size <= 1:
+            return
+        periods = list(zip(period_list, period_list[1:]))[:self.size]
+        for from_datetime, to_datetime in periods:
+            if (from_datetime, to_datetime) not in self._futures:
+                self._futures[(from_datetime, to_datetime)] = \
+                    self._executor.submit(self._fetch, to_datetime, from_datetime)
+
+    def get(self, to_datetime: datetime, from_datetime: datetime) -> list:
+        future: Future | None = self._futures.pop(
+            (from_datetime, to_datetime), None,
+        )
+        if future is not None:
+            return future.result()
+        return self._fetch(to_datetime, from_datetime)
+
+    def reset(self) -> None:
+        # Drop pending prefetches, waiting for running queries to finish
+        for future in self._futures.values():
+            future.cancel()
+        for future in self._futures.values():
+            if not future.cancelled():
+                try:
+                    future.result()
+                except Exception:
+                    pass
+        self._futures = {}
+        self._replicas = Queue()
+        self.size = 0
+
+    def close(self) -> None:
+        self.reset()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
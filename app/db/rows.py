@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+# Insert batches in the values of a period, in FK order
+INSERT_TABLES = (
+    ('wallet', 'insert_wallet'),
+    ('collection', 'insert_collection'),
+    ('tx', 'insert_tx'),
+    ('mint_metadata', 'insert_mint_metadata'),
+    ('asset', 'insert_asset'),
+    ('asset_mint_tx', 'insert_asset_mint_tx'),
+    ('asset_tx', 'insert_asset_tx'),
+    ('asset_ext', 'insert_asset_ext'),
+)
+
+
+def _id(value: any) -> any:
+    # Ids that are not known are 'Null' in the values of a period
+    return None if value == 'Null' else value
+
+
+# Columns of each insert table and plain column values of its rows,
+# the same as written by the SQL literals of the direct inserts
+class RowLayout:
+    def __init__(self, database) -> None:
+        self.db = database
+        self.config = database.config
+        # Number of tx columns, the tx hash or id and possibly the tx time
+        self.tx_count = len(database._tx_columns().split(', '))
+        self.columns = {}
+        for table_name, _ in INSERT_TABLES:
+            columns = self._table_columns(table_name)
+            if columns is not None:
+                self.columns[table_name] = columns
+
+    def _table_columns(self, table_name: str) -> tuple | None:
+        # Same columns as the direct insert of the table, None if not synced
+        config = self.config
+        tx_columns = tuple(self.db._tx_columns().split(', '))
+        if table_name == 'wallet':
+            if config.binary_keys:
+                return 'id', 'address', 'address_raw', 'address_type'
+            return 'id', 'address', 'address_type'
+        if table_name == 'collection':
+            return 'id', 'policy_id'
+        if table_name == 'tx':
+            return ('id', 'hash', 'time', 'block_no') if config.normalized_tx else None
+        if table_name == 'mint_metadata':
+            return ('id', 'hash', 'document') if config.dedup_metadata else None
+        if table_name == 'asset':
+            if config.binary_keys:
+                return (
+                    'id', 'collection_id', 'hash', 'name', 'fingerprint',
+                    'fingerprint_raw', 'current_wallet_id',
+                )
+            return (
+                'id', 'collection_id', 'hash', 'name', 'fingerprint',
+                'current_wallet_id',
+            )
+        if table_name == 'asset_mint_tx':
+            if config.dedup_metadata:
+                metadata_columns = ('metadata_id',)
+            else:
+                metadata_columns = ('image', 'metadata', 'files')
+            return (
+                ('id', 'asset_id', 'wallet_id', 'quantity')
+                + tx_columns + metadata_columns
+            )
+        if table_name == 'asset_tx':
+            return ('id', 'asset_id', 'wallet_id', 'quantity') + tx_columns
+        if table_name == 'asset_ext':
+            return 'id', 'asset_id', 'latest_mint_tx_id', 'latest_tx_id'
+        return None
+
+    def json(self, value: any) -> str:
+        # Metadata column as written by the direct insert
+        if not self.config.json_passthrough:
+            return self.db._json_dumps(value)
+        return 'null' if value is None else value
+
+    def row(self, table_name: str, value: tuple) -> tuple:
+        # Column values of a row of the period's values, in columns order
+        config = self.config
+        tx_count = self.tx_count
+        if table_name == 'wallet':
+            a, b, c, d = value
+            return (a, b, c, d) if config.binary_keys else (a, b, d)
+        if table_name == 'mint_metadata':
+            a, b, c = value
+            return a, b, self.json(c)
+        if table_name == 'asset':
+            # Names are escaped for SQL literals in the values of a period
+            a, b, c, d, e, f, g = value
+            d = d.replace("''", "'")
+            if config.binary_keys:
+                return a, b, c, d, e, f, _id(g)
+            return a, b, c, d, e, _id(g)
+        if table_name == 'asset_mint_tx':
+            a, b, c, d, e, f, g, h, i = value
+            row = (a, b, _id(c), d) + (e, f)[:tx_count]
+            if config.dedup_metadata:
+                return row + (_id(h),)
+            return row + (g, self.json(h), self.json(i))
+        if table_name == 'asset_tx':
+            a, b, c, d, e, f = value
+            return (a, b, _id(c), d) + (e, f)[:tx_count]
+        if table_name == 'asset_ext':
+            a, b, c, d = value
+            return a, b, _id(c), _id(d)
+        return value
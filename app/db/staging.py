@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from datetime import datetime
+from time import time
+
+import psycopg2
+from psycopg2 import InterfaceError
+from psycopg2 import OperationalError
+
+from .pool import ConnectionPool
+from .rows import INSERT_TABLES
+from .rows import RowLayout
+
+logger = logging.getLogger('pantasia-db-sync')
+
+
+def _copy_value(value: any) -> str:
+    # A value in the text format of COPY
+    if value is None:
+        return '\\N'
+    if isinstance(value, (bytes, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return str(value).replace('\\', '\\\\') \
+        .replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+# Ships the insert batches of a period to unlogged staging tables in parallel,
+# the period's transaction then publishes them with one INSERT ... SELECT each
+class StagingLoader:
+    def __init__(self, database) -> None:
+        config = database.config
+        self.db = database
+        self.pool = ConnectionPool(
+            'staging',
+            dbname=config.db_name,
+            user=config.db_user,
+            password=config.db_pass,
+            host=config.db_host,
+            port=config.db_port,
+            config=config,
+            size=config.staging_connections,
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.staging_connections,
+            thread_name_prefix='pantasia-staging',
+        )
+        self.layout = RowLayout(database)
+        self.columns = self.layout.columns
+        self.create_tables()
+
+    def create_tables(self) -> None:
+        # Unlogged copies of the synced columns, without constraints
+        cur = self.db.pantasia_cur
+        for table_name, columns in self.columns.items():
+            cur.execute(f'DROP TABLE IF EXISTS staging_{table_name}')
+            cur.execute(
+                f'CREATE UNLOGGED TABLE staging_{table_name} AS '
+                f'SELECT {", ".join(columns)} FROM {table_name} WITH NO DATA',
+            )
+        self.db.pantasia_conn.commit()
+
+    def _copy(self, table_name: str, values: list) -> None:
+        time_started = time()
+        columns = ', '.join(self.columns[table_name])
+        buffer = io.StringIO(
+            ''.join(
+                '\t'.join(
+                    _copy_value(column) for column in self.layout.row(table_name, value)
+                ) + '\n'
+                for value in values
+            ),
+        )
+        conn = self.pool.getconn()
+        close = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f'TRUNCATE staging_{table_name}')
+                cur.copy_expert(
+                    f'COPY staging_{table_name} ({columns}) FROM STDIN', buffer,
+                )
+            conn.commit()
+        except (OperationalError, InterfaceError):
+            close = True
+            raise
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn, close=close)
+        self._record(f'copy_{table_name}', time() - time_started, len(values))
+
+    def _record(self, operation: str, seconds: float, rows: int) -> None:
+        metrics = self.db.metrics
+        if metrics is not None:
+            metrics.observe('pantasia_load_seconds', seconds, operation=operation)
+            metrics.inc('pantasia_load_rows_total', rows, operation=operation)
+        logger.debug(
+            f'{operation} running time is {round(seconds, 4)} seconds '
+            f'for inserting {rows} rows.',
+        )
+
+    def load(self, values: dict) -> None:
+        staged = [
+            (table_name, values[key]) for table_name, key in INSERT_TABLES
+            if table_name in self.columns and len(values[key]) > 0
+            and table_name not in self.db.file_only_tables
+        ]
+        futures = [
+            self.executor.submit(self._copy, table_name, rows)
+            for table_name, rows in staged
+        ]
+        # Let every copy finish before raising, staging tables are truncated
+        # by the next load of the same table
+        wait(futures)
+        for future in futures:
+            future.result()
+
+        # Publish in FK order within the period's transaction
+        for table_name, rows in staged:
+            columns = ', '.join(self.columns[table_name])
+            time_started = time()
+            self.db._execute_load(
+                f'INSERT INTO {table_name} ({columns}) '
+                f'SELECT {columns} FROM staging_{table_name}',
+            )
+            self._record(f'publish_{table_name}', time() - time_started, len(rows))
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.pool.closeall()
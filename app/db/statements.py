@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import re
+
+from psycopg2.extensions import connection
+from psycopg2.extensions import cursor
+
+
+# psycopg2 connection that keeps track of its server-side prepared statements
+class SyncConnection(connection):
+    def __init__(self, *args: any, **kwargs: any) -> None:
+        super().__init__(*args, **kwargs)
+        # Names of statements prepared on this connection,
+        # None if prepared statements are turned off
+        self.prepared_statements = set()
+
+
+# Statement that is prepared once per connection and then executed by name
+class PreparedStatement:
+    def __init__(self, name: str, query: str) -> None:
+        self.name = name
+        self.query = query
+        self.param_count = query.count('%s')
+
+        # PREPARE uses $n placeholders instead of psycopg2 %s placeholders
+        counter = iter(range(1, self.param_count + 1))
+        self.prepare_query = re.sub(
+            r'%s', lambda _: f'${next(counter)}', query,
+        )
+        if self.param_count > 0:
+            placeholders = ', '.join(['%s'] * self.param_count)
+            self.execute_query = f'EXECUTE {name} ({placeholders})'
+        else:
+            self.execute_query = f'EXECUTE {name}'
+
+    def explain(self, cur: cursor, params: tuple = (), options: str = '') -> None:
+        # Run the statement under EXPLAIN, by name if it is prepared already
+        prepared = getattr(cur.connection, 'prepared_statements', None)
+        if prepared is not None and self.name in prepared:
+            cur.execute(f'EXPLAIN {options} {self.execute_query}', params)
+        else:
+            cur.execute(f'EXPLAIN {options} {self.query}', params)
+
+    def execute(self, cur: cursor, params: tuple = ()) -> None:
+        prepared = getattr(cur.connection, 'prepared_statements', None)
+
+        # Fall back to sending the query text if prepared statements are off
+        if prepared is None:
+            cur.execute(self.query, params)
+            return
+
+        # Statements are per connection, so a new connection prepares again
+        if self.name not in prepared:
+            cur.execute(f'PREPARE {self.name} AS {self.prepare_query}')
+            prepared.add(self.name)
+        cur.execute(self.execute_query, params)
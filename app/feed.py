@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import json
+import logging
+from datetime import datetime
+
+from db import Db
+
+logger = logging.getLogger('pantasia-db-sync')
+
+# Largest NOTIFY payload accepted by Postgres is 8000 bytes
+MAX_NOTIFY_PAYLOAD = 7900
+
+
+def get_changes(to_datetime: datetime, values: dict) -> dict:
+    # Compact summary of the ids a period created or updated
+    def ids(rows: list, position: int = 0) -> set:
+        return {row[position] for row in rows if row[position] != 'Null'}
+
+    new_assets = ids(values['insert_asset'])
+    updated_assets = (
+        ids(values['update_asset_current_wallet_id'])
+        | ids(values['update_asset_ext_latest_mint_tx_id'])
+        | ids(values['update_asset_ext_latest_tx_id'])
+    ) - new_assets
+
+    new_wallets = ids(values['insert_wallet'])
+    updated_wallets = (
+        ids(values['insert_asset_tx'], 2)
+        | ids(values['insert_asset_mint_tx'], 2)
+        | ids(values['upsert_wallet_asset_balance'])
+    ) - new_wallets
+
+    new_collections = ids(values['insert_collection'])
+    updated_collections = (
+        ids(values['insert_asset'], 1)
+        | set(values['upsert_collection_stats'].keys())
+    ) - new_collections
+
+    return {
+        'tip': to_datetime.isoformat(),
+        'asset': {
+            'new': sorted(new_assets),
+            'updated': sorted(updated_assets),
+        },
+        'wallet': {
+            'new': sorted(new_wallets),
+            'updated': sorted(updated_wallets),
+        },
+        'collection': {
+            'new': sorted(new_collections),
+            'updated': sorted(updated_collections),
+        },
+    }
+
+
+# Change feed for downstream consumers, written once per synced period
+class ChangeFeed:
+    def __init__(self, database: Db, config) -> None:
+        self.db = database
+        self.sinks = set(config.change_feed)
+        self.channel = config.change_feed_channel
+        self.path = config.change_feed_path
+        self._pending = None
+
+        unknown = self.sinks - {'notify', 'table', 'jsonl'}
+        if unknown:
+            raise RuntimeError(f'Unknown change_feed sinks {sorted(unknown)}')
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.sinks) > 0
+
+    def stage(self, to_datetime: datetime, values: dict) -> None:
+        # Runs in the period's transaction, so the table row and the
+        # notification only become visible if the period is committed
+        if not self.enabled:
+            return
+        changes = get_changes(to_datetime, values)
+        payload = json.dumps(changes, separators=(',', ':'))
+
+        if 'table' in self.sinks:
+            self.db.pantasia_insert_sync_changes(to_datetime, payload)
+        if 'notify' in self.sinks:
+            notify_payload = payload
+            if len(notify_payload.encode()) > MAX_NOTIFY_PAYLOAD:
+                # Too large for NOTIFY, consumers read the ids elsewhere
+                notify_payload = json.dumps(
+                    {'tip': changes['tip'], 'truncated': True},
+                    separators=(',', ':'),
+                )
+            self.db.pantasia_notify(self.channel, notify_payload)
+        self._pending = payload if 'jsonl' in self.sinks else None
+
+    def publish(self) -> None:
+        # Runs after the commit, the file only ever holds committed periods
+        if self._pending is None:
+            return
+        with open(self.path, 'a') as feed_file:
+            feed_file.write(self._pending + '\n')
+        self._pending = None
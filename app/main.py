@@ -3,46 +3,667 @@ from __future__ import annotations
 import logging.config
 import os
 import traceback
+from datetime import datetime
+from datetime import timedelta
 from pathlib import PurePath
 from signal import SIGINT
 from signal import signal
 from signal import SIGTERM
-from time import sleep
+from threading import Event
+from threading import Timer
 from time import time
 from typing import Callable
 
+from cardano import get_fingerprint_raw
 from cardano import get_staking_address
+from cardano import get_staking_address_raw
 from db import Db
+from db import IdCounter
 from db import IdIndex
+from db import ParquetSink
+from db import RecordFetcher
+from feed import ChangeFeed
+from memory import MemoryReport
+from metrics import metrics
+from metrics import MetricsServer
 from misc import hex_to_string
 from misc import read_yaml
+from profiler import Profiler
 from psycopg2 import DataError
 from psycopg2 import IntegrityError
+from psycopg2 import InterfaceError
 from psycopg2 import InternalError
-from psycopg2.extras import Json
+from psycopg2 import OperationalError
 from settings import settings
 
+logger = logging.getLogger('pantasia-db-sync')
+
+
+def transform_records(records: list, indexes: dict, counters: dict) -> dict:
+    d_asset_id_x_fingerprint = indexes['asset']
+    d_wallet_id_x_address = indexes['wallet']
+    d_collection_id_x_policy_id = indexes['collection']
+    d_asset_id_x_asset_ext = indexes['asset_ext']
+    d_metadata_id_x_hash = indexes.get('mint_metadata')
+
+    index_asset = counters['asset']
+    index_asset_mint_tx = counters['asset_mint_tx']
+    index_asset_tx = counters['asset_tx']
+    index_collection = counters['collection']
+    index_wallet = counters['wallet']
+    index_tx = counters.get('tx')
+    index_metadata = counters.get('mint_metadata')
+
+    # Init lists as containers for data values to be inserted to Pantasia DB
+    values_insert_wallet = []
+    values_insert_collection = []
+    values_insert_asset_mint_tx = []
+    values_insert_asset_tx = []
+    values_insert_asset = []
+    values_insert_asset_ext = []
+    values_update_asset_ext_latest_mint_tx_id = []
+    values_update_asset_ext_latest_tx_id = []
+    values_update_asset_current_wallet_id = []
+    values_insert_tx = []
+    values_insert_mint_metadata = []
+
+    # Net quantity deltas per (wallet id, asset id) of this period,
+    # None if wallet balances are not kept
+    d_balance_delta = {} if settings.wallet_balances else None
+    d_collection_x_asset = {}
+
+    # Asset, mint and transfer counts and first/last activity per collection
+    # of this period, None if collection stats are not kept
+    d_collection_stats = {} if settings.collection_stats else None
+
+    # Natural keys are indexed as raw bytes when binary_keys is turned on
+    binary_keys = settings.binary_keys
+
+    # Ids of the transactions of this period, a transaction belongs to
+    # exactly one block so it never shows up again in a later period
+    d_tx_id_x_tx_hash = {}
+
+    # Loop through records and process them
+    for record in records:
+        if binary_keys:
+            r_policy_key = bytes.fromhex(record['policy_id'])
+            r_asset_name = bytes.fromhex(record['asset_name_hash'])
+            r_asset_hash = r_policy_key + r_asset_name
+            r_fingerprint_key = get_fingerprint_raw(r_policy_key, r_asset_name)
+            r_tx_hash = bytes.fromhex(record['tx_hash'])
+        else:
+            r_policy_key = record['policy_id']
+            r_asset_hash = f"{record['policy_id']}.{record['asset_name_hash']}"
+            r_fingerprint_key = record['asset_fingerprint']
+            r_tx_hash = record['tx_hash']
+
+        # Reference the row of the tx table instead of the hash if normalized
+        if index_tx is not None:
+            r_tx_ref = d_tx_id_x_tx_hash.get(r_tx_hash)
+            if r_tx_ref is None:
+                r_tx_ref = index_tx.next()
+                d_tx_id_x_tx_hash[r_tx_hash] = r_tx_ref
+                values_insert_tx.append(
+                    (r_tx_ref, r_tx_hash, record['tx_time'], record['block_no']),
+                )
+        else:
+            r_tx_ref = r_tx_hash
+
+        # Add address to wallet table
+        r_address = record['address']
+
+        if r_address is not None:
+            # Get staking address from payment address if not return None
+            if binary_keys:
+                r_staking_address = get_staking_address_raw(r_address)
+                if r_staking_address is None:
+                    r_stake_address = None
+                    r_address_key = bytes(record['address_raw'])
+                else:
+                    r_stake_address, r_address_key = r_staking_address
+            else:
+                r_stake_address = get_staking_address(r_address)
+                r_address_key = r_stake_address or r_address
+
+            if r_stake_address is None:
+                # Get index of payment address if already existing in bidict
+                address_index = d_wallet_id_x_address.get(
+                    r_address_key,
+                )
+
+                # Add new row if can't find in bidict
+                if address_index is None:
+                    # Assign new index number,
+                    # update bidict and add to values
+                    # to insert new row in wallet table
+                    address_index = index_wallet.next()
+                    d_wallet_id_x_address.set(
+                        address_index, r_address_key,
+                    )
+                    r_address_type = 'ENTERPRISE'
+                    values_insert_wallet.append(
+                        (
+                            address_index, r_address,
+                            r_address_key if binary_keys else None,
+                            r_address_type,
+                        ),
+                    )
+
+            else:
+                # Get index of stake address if already existing in bidict
+                address_index = d_wallet_id_x_address.get(
+                    r_address_key,
+                )
+
+                # Add new row if can't find in bidict
+                if address_index is None:
+                    # Assign new index number,
+                    # update bidict and add to values
+                    # to insert new row in wallet table
+                    address_index = index_wallet.next()
+                    d_wallet_id_x_address.set(
+                        address_index, r_address_key,
+                    )
+                    r_address_type = 'STAKE'
+                    values_insert_wallet.append(
+                        (
+                            address_index, r_stake_address,
+                            r_address_key if binary_keys else None,
+                            r_address_type,
+                        ),
+                    )
+        else:
+            # Assign null value to address index,
+            # this is expected for burn tx (mint tx with negative quantity)
+            address_index = 'Null'
+
+        # Spent inputs only move the balance of the wallet they leave
+        if record['is_spent']:
+            asset_fingerprint_index = d_asset_id_x_fingerprint.get(
+                r_fingerprint_key,
+            )
+            if asset_fingerprint_index is None:
+                logger.warning(
+                    f"Spent asset {record['asset_fingerprint']} "
+                    f'is not in Pantasia DB, skipping its balance',
+                )
+            else:
+                balance_key = (address_index, asset_fingerprint_index)
+                d_balance_delta[balance_key] = \
+                    d_balance_delta.get(balance_key, 0) - record['quantity']
+                d_collection_x_asset[asset_fingerprint_index] = \
+                    d_collection_id_x_policy_id.get(r_policy_key)
+            continue
+
+        # Add policy id to collection table
+        # Get index of policy id if already existing in bidict
+        policy_index = d_collection_id_x_policy_id.get(
+            r_policy_key,
+        )
+
+        # Add new row if can't find in bidict
+        if policy_index is None:
+            # Assign new index number,
+            # update bidict and add to values
+            # to insert new row in collection table
+            policy_index = index_collection.next()
+            d_collection_id_x_policy_id.set(
+                policy_index, r_policy_key,
+            )
+            values_insert_collection.append(
+                (policy_index, r_policy_key),
+            )
+
+        # Process asset, asset_mint_tx and asset_tx
+        is_mint_tx = record['is_mint_tx']
+        # Get index of asset if already existing in bidict
+        asset_fingerprint_index = d_asset_id_x_fingerprint.get(
+            r_fingerprint_key,
+        )
+        r_new_asset = asset_fingerprint_index is None
+
+        # Process asset_mint_tx
+        if is_mint_tx is True:
+            # Get index of asset_mint_tx for a new row
+            asset_mint_tx_index = index_asset_mint_tx.next()
+
+            # Add new row if can't find in bidict
+            if asset_fingerprint_index is None:
+                # Assign new index number,
+                # update bidict and add to values
+                # to insert new row in asset table
+                asset_fingerprint_index = index_asset.next()
+                d_asset_id_x_fingerprint.set(
+                    asset_fingerprint_index,
+                    r_fingerprint_key,
+                )
+                values_insert_asset.append((
+                    asset_fingerprint_index,
+                    policy_index,
+                    r_asset_hash,
+                    hex_to_string(str(record['asset_name_hash'])),
+                    record['asset_fingerprint'],
+                    r_fingerprint_key if binary_keys else None,
+                    address_index,
+                ))
+
+            # Update latest_mint_tx_id in asset
+            # if it is a mint tx, except burn tx
+            if record['quantity'] > 0:
+                if d_asset_id_x_asset_ext.get(
+                        asset_fingerprint_index,
+                ) is not None:
+                    # Update asset entry with latest_mint_tx_id
+                    values_update_asset_ext_latest_mint_tx_id.append(
+                        (asset_fingerprint_index, asset_mint_tx_index),
+                    )
+                else:
+                    # Add to values to insert new row in asset_ext table
+                    values_insert_asset_ext.append(
+                        (
+                            asset_fingerprint_index,
+                            asset_fingerprint_index,
+                            asset_mint_tx_index,
+                            'Null',
+                        ),
+                    )
+                    d_asset_id_x_asset_ext.set(
+                        asset_fingerprint_index, asset_fingerprint_index,
+                    )
+
+            if d_metadata_id_x_hash is not None:
+                # Store each distinct metadata document once
+                r_metadata = record['metadata']
+                if r_metadata is None:
+                    metadata_index = 'Null'
+                else:
+                    # Hashed by the extraction query, without parsing the JSON
+                    r_metadata_hash = bytes(record['metadata_hash'])
+                    metadata_index = d_metadata_id_x_hash.get(r_metadata_hash)
+                    if metadata_index is None:
+                        metadata_index = index_metadata.next()
+                        d_metadata_id_x_hash.set(metadata_index, r_metadata_hash)
+                        values_insert_mint_metadata.append(
+                            (metadata_index, r_metadata_hash, r_metadata),
+                        )
+                r_metadata_values = (None, metadata_index, None)
+            else:
+                r_metadata_values = (
+                    record['image'],
+                    record['metadata'],
+                    record['files'],
+                )
+
+            # Add to values to insert new row in asset_mint_tx table
+            values_insert_asset_mint_tx.append(
+                (
+                    asset_mint_tx_index,
+                    asset_fingerprint_index,
+                    address_index,
+                    record['quantity'],
+                    r_tx_ref,
+                    record['tx_time'],
+                    *r_metadata_values,
+                ),
+            )
+
+        # Process asset_tx
+        else:
+            # Get index of asset_tx for a new row
+            asset_tx_index = index_asset_tx.next()
+
+            # Add new row if can't find in bidict
+            if asset_fingerprint_index is None:
+                # Assign new index number, update bidict
+                # and add to values to insert new row in asset table
+                asset_fingerprint_index = index_asset.next()
+                d_asset_id_x_fingerprint.set(
+                    asset_fingerprint_index, r_fingerprint_key,
+                )
+                values_insert_asset.append((
+                    asset_fingerprint_index, policy_index,
+                    r_asset_hash,
+                    hex_to_string(str(record['asset_name_hash'])),
+                    record['asset_fingerprint'],
+                    r_fingerprint_key if binary_keys else None,
+                    address_index,
+                ))
+            else:
+                # Update asset entry with current_wallet_id
+                values_update_asset_current_wallet_id.append(
+                    (asset_fingerprint_index, address_index),
+                )
+
+            if d_asset_id_x_asset_ext.get(
+                    asset_fingerprint_index,
+            ) is not None:
+                # Update asset entry with latest_tx_id
+                values_update_asset_ext_latest_tx_id.append(
+                    (asset_fingerprint_index, asset_tx_index),
+                )
+            else:
+                # Add to values to insert new row in asset_ext table
+                values_insert_asset_ext.append(
+                    (
+                        asset_fingerprint_index,
+                        asset_fingerprint_index,
+                        'Null',
+                        asset_tx_index,
+                    ),
+                )
+                d_asset_id_x_asset_ext.set(
+                    asset_fingerprint_index, asset_fingerprint_index,
+                )
+
+            # Add to values to insert new row in asset_tx table
+            values_insert_asset_tx.append(
+                (
+                    asset_tx_index,
+                    asset_fingerprint_index,
+                    address_index,
+                    record['quantity'],
+                    r_tx_ref,
+                    record['tx_time'],
+                ),
+            )
+
+        # Received assets add to the balance, burns leave through the inputs
+        if d_balance_delta is not None and address_index != 'Null':
+            balance_key = (address_index, asset_fingerprint_index)
+            d_balance_delta[balance_key] = \
+                d_balance_delta.get(balance_key, 0) + record['quantity']
+            d_collection_x_asset[asset_fingerprint_index] = policy_index
+
+        if d_collection_stats is not None:
+            stats = d_collection_stats.setdefault(
+                policy_index, [0, 0, 0, None, None],
+            )
+            if r_new_asset:
+                stats[0] = stats[0] + 1
+            if is_mint_tx is not True:
+                stats[2] = stats[2] + 1
+            elif record['quantity'] > 0:
+                stats[1] = stats[1] + 1
+            # Records are ordered by tx_time
+            if stats[3] is None:
+                stats[3] = record['tx_time']
+            stats[4] = record['tx_time']
+
+    if d_balance_delta is not None:
+        values_upsert_wallet_asset_balance = [
+            (wallet_id, asset_id, quantity, d_collection_x_asset[asset_id])
+            for (wallet_id, asset_id), quantity in d_balance_delta.items()
+            if quantity != 0
+        ]
+    else:
+        values_upsert_wallet_asset_balance = []
+
+    return {
+        'insert_wallet': values_insert_wallet,
+        'insert_collection': values_insert_collection,
+        'insert_asset_mint_tx': values_insert_asset_mint_tx,
+        'insert_asset_tx': values_insert_asset_tx,
+        'insert_asset': values_insert_asset,
+        'insert_asset_ext': values_insert_asset_ext,
+        'update_asset_ext_latest_mint_tx_id':
+            values_update_asset_ext_latest_mint_tx_id,
+        'update_asset_ext_latest_tx_id': values_update_asset_ext_latest_tx_id,
+        'update_asset_current_wallet_id': values_update_asset_current_wallet_id,
+        'insert_tx': values_insert_tx,
+        'insert_mint_metadata': values_insert_mint_metadata,
+        'upsert_wallet_asset_balance': values_upsert_wallet_asset_balance,
+        'upsert_collection_stats': d_collection_stats or {},
+    }
+
+
+def load_values(database: Db, values: dict) -> None:
+    # Batch insert values into tables, through the staging tables if enabled
+    if database.staging is not None:
+        database.staging.load(values)
+    else:
+        if len(values['insert_wallet']) > 0:
+            database.pantasia_insert_wallet(
+                values=values['insert_wallet'],
+            )
+        if len(values['insert_collection']) > 0:
+            database.pantasia_insert_collection(
+                values=values['insert_collection'],
+            )
+        if len(values['insert_tx']) > 0:
+            database.pantasia_insert_tx(
+                values=values['insert_tx'],
+            )
+        if len(values['insert_mint_metadata']) > 0:
+            database.pantasia_insert_mint_metadata(
+                values=values['insert_mint_metadata'],
+            )
+        if len(values['insert_asset']) > 0:
+            database.pantasia_insert_asset(
+                values=values['insert_asset'],
+            )
+        if len(values['insert_asset_mint_tx']) > 0 \
+                and 'asset_mint_tx' not in database.file_only_tables:
+            database.pantasia_insert_asset_mint_tx(
+                values=values['insert_asset_mint_tx'],
+            )
+        if len(values['insert_asset_tx']) > 0 \
+                and 'asset_tx' not in database.file_only_tables:
+            database.pantasia_insert_asset_tx(
+                values=values['insert_asset_tx'],
+            )
+        if len(values['insert_asset_ext']) > 0 \
+                and 'asset_ext' not in database.file_only_tables:
+            database.pantasia_insert_asset_ext(
+                values=values['insert_asset_ext'],
+            )
+    if len(values['update_asset_ext_latest_mint_tx_id']) > 0 \
+            and 'asset_ext' not in database.file_only_tables:
+        database.pantasia_update_asset_ext_latest_mint_tx_id(
+            values=values['update_asset_ext_latest_mint_tx_id'],
+        )
+    if len(values['update_asset_ext_latest_tx_id']) > 0 \
+            and 'asset_ext' not in database.file_only_tables:
+        database.pantasia_update_asset_ext_latest_tx_id(
+            values=values['update_asset_ext_latest_tx_id'],
+        )
+    if len(values['update_asset_current_wallet_id']) > 0:
+        database.pantasia_update_asset_current_wallet_id(
+            values=values['update_asset_current_wallet_id'],
+        )
+    holder_deltas = {}
+    if len(values['upsert_wallet_asset_balance']) > 0:
+        balances = database.pantasia_upsert_wallet_asset_balance(
+            values=values['upsert_wallet_asset_balance'],
+        )
+        if settings.collection_stats:
+            holder_deltas = load_collection_holders(
+                database, values['upsert_wallet_asset_balance'], balances,
+            )
+    if len(values['upsert_collection_stats']) > 0 or len(holder_deltas) > 0:
+        values_upsert_collection_stats = []
+        for collection_id in \
+                values['upsert_collection_stats'].keys() | holder_deltas.keys():
+            assets, mints, transfers, first_activity, last_activity = \
+                values['upsert_collection_stats'].get(
+                    collection_id, [0, 0, 0, None, None],
+                )
+            values_upsert_collection_stats.append(
+                (
+                    collection_id, assets, mints, transfers,
+                    holder_deltas.get(collection_id, 0),
+                    first_activity, last_activity,
+                ),
+            )
+        database.pantasia_upsert_collection_stats(
+            values=values_upsert_collection_stats,
+        )
+
+
+def get_positive_changes(deltas: dict, rows: list) -> dict:
+    # +1 for keys whose new value turned positive, -1 for keys that stopped
+    # being positive, given the deltas that were applied
+    changes = {}
+    for key, value in rows:
+        if (value > 0) != (value - deltas[key] > 0):
+            changes[key] = 1 if value > 0 else -1
+    return changes
+
+
+def load_collection_holders(database: Db, balances: list, rows: list) -> dict:
+    # Track the number of assets each wallet holds per collection, and return
+    # the change in distinct holders per collection
+    balance_changes = get_positive_changes(
+        {(wallet_id, asset_id): delta for wallet_id, asset_id, delta, _ in balances},
+        rows,
+    )
+    d_collection_x_asset = {
+        asset_id: collection_id for _, asset_id, _, collection_id in balances
+    }
+
+    asset_count_deltas = {}
+    for (wallet_id, asset_id), change in balance_changes.items():
+        holder_key = (d_collection_x_asset[asset_id], wallet_id)
+        asset_count_deltas[holder_key] = \
+            asset_count_deltas.get(holder_key, 0) + change
+    asset_count_deltas = {
+        key: delta for key, delta in asset_count_deltas.items() if delta != 0
+    }
+    if len(asset_count_deltas) == 0:
+        return {}
+
+    rows = database.pantasia_upsert_collection_holder(
+        values=[
+            (collection_id, wallet_id, delta)
+            for (collection_id, wallet_id), delta in asset_count_deltas.items()
+        ],
+    )
+    holder_deltas = {}
+    for (collection_id, _), change in get_positive_changes(
+            asset_count_deltas, rows,
+    ).items():
+        holder_deltas[collection_id] = holder_deltas.get(collection_id, 0) + change
+    return holder_deltas
+
+
+# Shortest period that is split further to stay under the soft memory limit
+MIN_SPLIT_PERIOD = timedelta(seconds=1)
+
+
+def split_period(from_datetime: datetime, to_datetime: datetime) -> list:
+    # Split a failed period in two halves so that it can be retried in parts
+    mid_datetime = from_datetime + (to_datetime - from_datetime) / 2
+    if from_datetime < mid_datetime < to_datetime:
+        return [from_datetime, mid_datetime]
+    else:
+        return [from_datetime]
+
+
+def create_indexes(database: Db) -> dict:
+    if settings.binary_keys:
+        wallet_key, asset_key = 'address_raw', 'fingerprint_raw'
+    else:
+        wallet_key, asset_key = 'address', 'fingerprint'
+    indexes = {
+        'asset': IdIndex('asset', asset_key, database),
+        'wallet': IdIndex('wallet', wallet_key, database),
+        'collection': IdIndex('collection', 'policy_id', database),
+        'asset_ext': IdIndex('asset_ext', 'asset_id', database),
+    }
+    if settings.dedup_metadata:
+        indexes['mint_metadata'] = IdIndex('mint_metadata', 'hash', database)
+    return indexes
+
+
+def create_counters(database: Db) -> dict:
+    counters = {
+        'asset': IdCounter('asset', database),
+        'asset_mint_tx': IdCounter('asset_mint_tx', database),
+        'asset_tx': IdCounter('asset_tx', database),
+        'collection': IdCounter('collection', database),
+        'wallet': IdCounter('wallet', database),
+    }
+    if settings.normalized_tx:
+        counters['tx'] = IdCounter('tx', database)
+    if settings.dedup_metadata:
+        counters['mint_metadata'] = IdCounter('mint_metadata', database)
+    return counters
+
+
+def split_large_periods(
+    period_list: list, memory: MemoryReport, indexes: dict, fetcher: RecordFetcher,
+) -> int:
+    # Split the upcoming periods that are expected to go over the soft memory
+    # limit, before they are fetched. Returns the number of periods added
+    added = 0
+    i = 0
+    while i < min(fetcher.window, len(period_list) - 1):
+        from_datetime, to_datetime = period_list[i], period_list[i + 1]
+        if to_datetime - from_datetime > MIN_SPLIT_PERIOD \
+                and not fetcher.scheduled(from_datetime, to_datetime) \
+                and memory.over_limit_estimate(indexes, from_datetime, to_datetime):
+            logger.info(
+                f'Period FROM: {from_datetime} TO: {to_datetime} is expected '
+                f'to go over the soft memory limit, splitting the period',
+            )
+            period_list[i:i + 1] = split_period(from_datetime, to_datetime)
+            added = added + 1
+            continue
+        i = i + 1
+    return added
+
+
+def run(database, stop: Event | None = None):
+    # Memory of indexes and period buffers, and the soft memory limit. Created
+    # first so that its baseline is taken before the indexes are loaded
+    memory = MemoryReport(settings, metrics)
 
-def run(database):
     # Initialize and load data from Pantasia DB
-    d_asset_id_x_fingerprint = IdIndex('asset', 'fingerprint', database)
-    d_wallet_id_x_address = IdIndex('wallet', 'address', database)
-    d_collection_id_x_policy_id = IdIndex('collection', 'policy_id', database)
-    d_asset_id_x_asset_ext = IdIndex('asset_ext', 'asset_id', database)
+    indexes = create_indexes(database)
 
     # Get latest index (id) numbers for each table
-    index_asset = database.pantasia_get_last_index('asset')
-    index_asset_mint_tx = database.pantasia_get_last_index('asset_mint_tx')
-    index_asset_tx = database.pantasia_get_last_index('asset_tx')
-    index_collection = database.pantasia_get_last_index('collection')
-    index_wallet = database.pantasia_get_last_index('wallet')
+    counters = create_counters(database)
+
+    # Indexes and counters are journaled and follow the Pantasia DB transaction
+    journaled = list(indexes.values()) + list(counters.values())
+
+    # Number of failed attempts per period start, for retries
+    period_retries = {}
+
+    # Extracts records of upcoming periods across Cardano DB replicas
+    fetcher = RecordFetcher(database)
+
+    # Summary of each committed period for downstream consumers
+    feed = ChangeFeed(database, settings)
+
+    # Profiling of upcoming periods on SIGUSR1, stack dumps on SIGUSR2
+    profiler = Profiler(settings, metrics)
+
+    # File sinks written along with (or instead of) the Pantasia DB tables
+    sinks = []
+    if 'parquet' in settings.sinks:
+        sinks.append(ParquetSink(database, settings))
+
+    # Set on shutdown, no new period is started once the running one is done
+    if stop is None:
+        stop = Event()
 
     from_datetime = None
     period_list = [database.pantasia_tip]
 
-    while True:
-        database.get_latest_cardano_tip()
-        database.get_latest_pantasia_tip()
+    while not stop.is_set():
+        try:
+            database.check_connections()
+            database.get_latest_cardano_tip()
+            database.get_latest_pantasia_tip()
+            fetcher.start_round()
+            metrics.set(
+                'pantasia_tip_lag_seconds',
+                (database.cardano_tip - database.pantasia_tip).total_seconds(),
+            )
+        except (OperationalError, InterfaceError):
+            logger.exception('Lost connection while reading database tips')
+            database.reconnect()
+            continue
 
         # Create periods of length $time_interval
         if database.cardano_tip != database.old_cardano_tip:
@@ -50,34 +671,26 @@ def run(database):
             database.old_cardano_tip = database.cardano_tip
         else:
             # Pause 10 seconds so that Postgres doesn't get spammed
-            sleep(10)
+            stop.wait(10)
 
         initial_len = len(period_list)
 
-        while len(period_list) > 1:
+        while len(period_list) > 1 and not stop.is_set():
             start_time = time()
 
             if settings.in_memory_index is False:
                 # Clear index dictionaries
-                d_asset_id_x_fingerprint.clear_index()
-                d_wallet_id_x_address.clear_index()
-                d_collection_id_x_policy_id.clear_index()
-                d_asset_id_x_asset_ext.clear_index()
-
-            # Init lists as containers for data values to be inserted to Pantasia DB
-            values_insert_wallet = []
-            values_insert_collection = []
-            values_insert_asset_mint_tx = []
-            values_insert_asset_tx = []
-            values_insert_asset = []
-            values_insert_asset_ext = []
-            values_update_asset_ext_latest_mint_tx_id = []
-            values_update_asset_ext_latest_tx_id = []
-            values_update_asset_current_wallet_id = []
+                for index in indexes.values():
+                    index.clear_index()
 
             # If new element from period_list not the same as the previous,
             # then move the index and get records
             if period_list[0] != from_datetime:
+                profiler.start_period()
+                initial_len = initial_len + split_large_periods(
+                    period_list, memory, indexes, fetcher,
+                )
+                fetcher.prefetch(period_list)
                 from_datetime = period_list.pop(0)
                 to_datetime = period_list[0]
 
@@ -89,295 +702,173 @@ def run(database):
                     f'| FROM: {from_datetime} | TO: {to_datetime}',
                 )
 
-                # Retrieve records from Cardano DB
-                time_started = time()
-                records = database.pantasia_get_records(to_datetime, from_datetime)
-                time_elapsed = time()
-                logger.debug(
-                    '{execute} running time is {s} seconds for retrieving {rows} rows.'
-                    .format(
-                        execute='main_query',
-                        s=round(time_elapsed - time_started, 4),
-                        rows=len(records),
-                    ),
-                )
-
-                logger.info(f'Processing {len(records)} rows......')
-
-                time_started = time()
-                # Loop through records and process them
-                for record in records:
-                    # Add address to wallet table
-                    r_address = record['address']
-
-                    if r_address is not None:
-                        # Get staking address from payment address if not return None
-                        r_stake_address = get_staking_address(r_address)
-
-                        if r_stake_address is None:
-                            # Get index of payment address if already existing in bidict
-                            address_index = d_wallet_id_x_address.get(
-                                r_address,
-                            )
-
-                            # Add new row if can't find in bidict
-                            if address_index is None:
-                                # Assign new index number,
-                                # update bidict and add to values
-                                # to insert new row in wallet table
-                                address_index = index_wallet
-                                d_wallet_id_x_address.set(
-                                    address_index, r_address,
-                                )
-                                r_address_type = 'ENTERPRISE'
-                                values_insert_wallet.append(
-                                    (address_index, r_address, r_address_type),
-                                )
-
-                                # Increment index number for next record
-                                index_wallet = index_wallet + 1
-
-                        else:
-                            # Get index of stake address if already existing in bidict
-                            address_index = d_wallet_id_x_address.get(
-                                r_stake_address,
-                            )
-
-                            # Add new row if can't find in bidict
-                            if address_index is None:
-                                # Assign new index number,
-                                # update bidict and add to values
-                                # to insert new row in wallet table
-                                address_index = index_wallet
-                                d_wallet_id_x_address.set(
-                                    address_index, r_stake_address,
-                                )
-                                r_address_type = 'STAKE'
-                                values_insert_wallet.append(
-                                    (address_index, r_stake_address, r_address_type),
-                                )
-
-                                # Increment index number for next record
-                                index_wallet = index_wallet + 1
-                    else:
-                        # Assign null value to address index,
-                        # this is expected for burn tx (mint tx with negative quantity)
-                        address_index = 'Null'
-
-                    # Add policy id to collection table
-                    r_policy_id = record['policy_id']
-
-                    # Get index of policy id if already existing in bidict
-                    policy_index = d_collection_id_x_policy_id.get(
-                        r_policy_id,
+                database.period = (from_datetime, to_datetime)
+                try:
+                    # Make sure the partitions for this period exist
+                    database.pantasia_create_partitions(from_datetime, to_datetime)
+
+                    # Retrieve records from Cardano DB
+                    time_started = time()
+                    records = fetcher.get(to_datetime, from_datetime)
+                    time_elapsed = time()
+                    metrics.observe(
+                        'pantasia_extract_seconds', time_elapsed - time_started,
                     )
-
-                    # Add new row if can't find in bidict
-                    if policy_index is None:
-                        # Assign new index number,
-                        # update bidict and add to values
-                        # to insert new row in collection table
-                        policy_index = index_collection
-                        d_collection_id_x_policy_id.set(
-                            policy_index, r_policy_id,
-                        )
-                        values_insert_collection.append(
-                            (policy_index, r_policy_id),
+                    metrics.inc('pantasia_rows_fetched_total', len(records))
+                    memory.observe(from_datetime, to_datetime, records)
+
+                    # Split the window rather than go over the soft memory limit
+                    if to_datetime - from_datetime > MIN_SPLIT_PERIOD \
+                            and memory.over_limit(indexes, records):
+                        logger.warning(
+                            f'{len(records)} records of period FROM: '
+                            f'{from_datetime} TO: {to_datetime} are over the '
+                            f'soft memory limit, splitting the period',
                         )
+                        retry_periods = split_period(from_datetime, to_datetime)
+                        period_list[0:0] = retry_periods
+                        initial_len = initial_len + len(retry_periods)
+                        from_datetime = None
+                        continue
+                    logger.debug(
+                        '{execute} running time is {s} seconds '
+                        'for retrieving {rows} rows.'
+                        .format(
+                            execute='main_query',
+                            s=round(time_elapsed - time_started, 4),
+                            rows=len(records),
+                        ),
+                    )
 
-                        # Increment index number for next record
-                        index_collection = index_collection + 1
+                    logger.info(f'Processing {len(records)} rows......')
 
-                    # Process asset, asset_mint_tx and asset_tx
-                    is_mint_tx = record['is_mint_tx']
-                    # Get index of asset if already existing in bidict
-                    asset_fingerprint_index = d_asset_id_x_fingerprint.get(
-                        record['asset_fingerprint'],
+                    time_started = time()
+                    # Loop through records and process them
+                    values = transform_records(records, indexes, counters)
+                    time_elapsed = time()
+                    metrics.observe(
+                        'pantasia_transform_seconds', time_elapsed - time_started,
                     )
 
-                    # Process asset_mint_tx
-                    if is_mint_tx is True:
-                        # Get index of asset_mint_tx for a new row
-                        asset_mint_tx_index = index_asset_mint_tx
-
-                        # Add new row if can't find in bidict
-                        if asset_fingerprint_index is None:
-                            # Assign new index number,
-                            # update bidict and add to values
-                            # to insert new row in asset table
-                            asset_fingerprint_index = index_asset
-                            d_asset_id_x_fingerprint.set(
-                                asset_fingerprint_index,
-                                record['asset_fingerprint'],
-                            )
-                            values_insert_asset.append((
-                                asset_fingerprint_index,
-                                policy_index,
-                                f"{record['policy_id']}."
-                                f"{str(record['asset_name_hash'])}",
-                                hex_to_string(str(record['asset_name_hash'])),
-                                record['asset_fingerprint'],
-                                address_index,
-                            ))
-
-                            # Increment index number for next record
-                            index_asset = index_asset + 1
-
-                        # Update latest_mint_tx_id in asset
-                        # if it is a mint tx, except burn tx
-                        if record['quantity'] > 0:
-                            if d_asset_id_x_asset_ext.get(
-                                    asset_fingerprint_index,
-                            ) is not None:
-                                # Update asset entry with latest_mint_tx_id
-                                values_update_asset_ext_latest_mint_tx_id.append(
-                                    (asset_fingerprint_index, asset_mint_tx_index),
-                                )
-                            else:
-                                # Add to values to insert new row in asset_ext table
-                                values_insert_asset_ext.append(
-                                    (
-                                        asset_fingerprint_index,
-                                        asset_fingerprint_index,
-                                        asset_mint_tx_index,
-                                        'Null',
-                                    ),
-                                )
-                                d_asset_id_x_asset_ext.set(
-                                    asset_fingerprint_index, asset_fingerprint_index,
-                                )
-
-                        # Add to values to insert new row in asset_mint_tx table
-                        values_insert_asset_mint_tx.append(
-                            (
-                                asset_mint_tx_index,
-                                asset_fingerprint_index,
-                                address_index,
-                                record['quantity'],
-                                record['tx_hash'],
-                                record['tx_time'],
-                                record['image'],
-                                Json(record['metadata']),
-                                Json(record['files']),
-                            ),
+                    if to_datetime - from_datetime > MIN_SPLIT_PERIOD \
+                            and memory.over_limit(indexes, records, values):
+                        logger.warning(
+                            f'Buffers of period FROM: {from_datetime} '
+                            f'TO: {to_datetime} are over the soft memory limit, '
+                            f'splitting the period',
                         )
+                        # Nothing has been written yet, only undo the indexes
+                        for journal in journaled:
+                            journal.rollback()
+                        retry_periods = split_period(from_datetime, to_datetime)
+                        period_list[0:0] = retry_periods
+                        initial_len = initial_len + len(retry_periods)
+                        from_datetime = None
+                        continue
+                    memory.report(indexes, records, values)
+                    logger.debug(
+                        '{execute} running time is {s} seconds '
+                        'for processing {rows} rows.'
+                        .format(
+                            execute='Processing',
+                            s=round(time_elapsed - time_started, 4),
+                            rows=len(records),
+                        ),
+                    )
 
-                        # Increment index number for next record
-                        index_asset_mint_tx = index_asset_mint_tx + 1
-
-                    # Process asset_tx
-                    else:
-                        # Get index of asset_tx for a new row
-                        asset_tx_index = index_asset_tx
-
-                        # Add new row if can't find in bidict
-                        if asset_fingerprint_index is None:
-                            # Assign new index number, update bidict
-                            # and add to values to insert new row in asset table
-                            asset_fingerprint_index = index_asset
-                            d_asset_id_x_fingerprint.set(
-                                asset_fingerprint_index, record['asset_fingerprint'],
-                            )
-                            values_insert_asset.append((
-                                asset_fingerprint_index, policy_index,
-                                f"{record['policy_id']}.{record['asset_name_hash']}",
-                                hex_to_string(str(record['asset_name_hash'])),
-                                record['asset_fingerprint'], address_index,
-                            ))
-
-                            # Increment index number for next record
-                            index_asset = index_asset + 1
-                        else:
-                            # Update asset entry with current_wallet_id
-                            values_update_asset_current_wallet_id.append(
-                                (asset_fingerprint_index, address_index),
-                            )
-
-                        if d_asset_id_x_asset_ext.get(
-                                asset_fingerprint_index,
-                        ) is not None:
-                            # Update asset entry with latest_tx_id
-                            values_update_asset_ext_latest_tx_id.append(
-                                (asset_fingerprint_index, asset_tx_index),
-                            )
-                        else:
-                            # Add to values to insert new row in asset_ext table
-                            values_insert_asset_ext.append(
-                                (
-                                    asset_fingerprint_index,
-                                    asset_fingerprint_index,
-                                    'Null',
-                                    asset_tx_index,
-                                ),
-                            )
-                            d_asset_id_x_asset_ext.set(
-                                asset_fingerprint_index, asset_fingerprint_index,
-                            )
-
-                        # Add to values to insert new row in asset_tx table
-                        values_insert_asset_tx.append(
-                            (
-                                asset_tx_index,
-                                asset_fingerprint_index,
-                                address_index,
-                                record['quantity'],
-                                record['tx_hash'],
-                                record['tx_time'],
-                            ),
-                        )
+                    # Batch insert values into tables
+                    load_values(database, values)
 
-                        # Increment index number for next record
-                        index_asset_tx = index_asset_tx + 1
-                time_elapsed = time()
-                logger.debug(
-                    '{execute} running time is {s} seconds for processing {rows} rows.'
-                    .format(
-                        execute='Processing',
-                        s=round(time_elapsed - time_started, 4),
-                        rows=len(records),
-                    ),
-                )
+                    feed.stage(to_datetime, values)
+                    for sink in sinks:
+                        sink.stage(from_datetime, to_datetime, values)
 
-                # Batch insert values into tables
-                if len(values_insert_wallet) > 0:
-                    database.pantasia_insert_wallet(
-                        values=values_insert_wallet,
+                    # Save sync position and next ids in the same transaction
+                    database.pantasia_save_checkpoint(
+                        to_datetime,
+                        {
+                            table_name: counter.value
+                            for table_name, counter in counters.items()
+                        },
                     )
-                if len(values_insert_collection) > 0:
-                    database.pantasia_insert_collection(
-                        values=values_insert_collection,
-                    )
-                if len(values_insert_asset) > 0:
-                    database.pantasia_insert_asset(
-                        values=values_insert_asset,
-                    )
-                if len(values_insert_asset_mint_tx) > 0:
-                    database.pantasia_insert_asset_mint_tx(
-                        values=values_insert_asset_mint_tx,
-                    )
-                if len(values_insert_asset_tx) > 0:
-                    database.pantasia_insert_asset_tx(
-                        values=values_insert_asset_tx,
+
+                    time_started = time()
+                    database.pantasia_commit()
+                    metrics.observe('pantasia_commit_seconds', time() - time_started)
+                except (OperationalError, InterfaceError):
+                    logger.exception(
+                        f'Lost connection while syncing period FROM: '
+                        f'{from_datetime} TO: {to_datetime}, reconnecting',
                     )
-                if len(values_insert_asset_ext) > 0:
-                    database.pantasia_insert_asset_ext(
-                        values=values_insert_asset_ext,
+                    fetcher.reset()
+                    database.reconnect()
+                    fetcher.start_round()
+
+                    # The checkpoint tells whether the commit went through
+                    # before the connection dropped
+                    if database.get_latest_pantasia_tip() < to_datetime:
+                        # Discard in-memory changes of the batch
+                        for journal in journaled:
+                            journal.rollback()
+                        for sink in sinks:
+                            sink.discard()
+
+                        # Re-issue the same period once connections are back
+                        period_list.insert(0, from_datetime)
+                        initial_len = initial_len + 1
+                        from_datetime = None
+                        continue
+                except (IntegrityError, DataError, InternalError):
+                    # Discard the failed batch, both in the database and in memory
+                    database.pantasia_rollback()
+                    for journal in journaled:
+                        journal.rollback()
+                    for sink in sinks:
+                        sink.discard()
+
+                    retries = period_retries.get(from_datetime, 0) + 1
+                    if retries > settings.max_period_retries:
+                        raise
+                    period_retries[from_datetime] = retries
+
+                    logger.exception(
+                        f'Failed to sync period FROM: {from_datetime} '
+                        f'TO: {to_datetime}, retrying in smaller periods '
+                        f'({retries}/{settings.max_period_retries})',
                     )
-                if len(values_update_asset_ext_latest_mint_tx_id) > 0:
-                    database.pantasia_update_asset_ext_latest_mint_tx_id(
-                        values=values_update_asset_ext_latest_mint_tx_id,
+
+                    # Put the period back in front of the list, split in two
+                    retry_periods = split_period(from_datetime, to_datetime)
+                    period_list[0:0] = retry_periods
+                    initial_len = initial_len + len(retry_periods)
+                    from_datetime = None
+                    continue
+
+                for journal in journaled:
+                    journal.commit()
+                feed.publish()
+                for sink in sinks:
+                    sink.publish()
+                period_retries.pop(from_datetime, None)
+
+                metrics.inc('pantasia_periods_total')
+                metrics.set(
+                    'pantasia_tip_lag_seconds',
+                    (database.cardano_tip - to_datetime).total_seconds(),
+                )
+                for table_name, index in indexes.items():
+                    metrics.set(
+                        'pantasia_index_size', len(index.id_index), table=table_name,
                     )
-                if len(values_update_asset_ext_latest_tx_id) > 0:
-                    database.pantasia_update_asset_ext_latest_tx_id(
-                        values=values_update_asset_ext_latest_tx_id,
+                    metrics.set(
+                        'pantasia_index_hits_total', index.hits,
+                        kind='counter', table=table_name,
                     )
-                if len(values_update_asset_current_wallet_id) > 0:
-                    database.pantasia_update_asset_current_wallet_id(
-                        values=values_update_asset_current_wallet_id,
+                    metrics.set(
+                        'pantasia_index_misses_total', index.misses,
+                        kind='counter', table=table_name,
                     )
 
-                database.pantasia_conn.commit()
-
                 logger.info(f'{len(records)} rows updated in database.')
 
                 time_difference = time() - start_time
@@ -386,17 +877,42 @@ def run(database):
                 logger.debug(
                     f'{round(proc_rate, 2):.2f} record(s)/s',
                 )
+                profiler.end_period()
+
+    # Wait for prefetches still running on the replicas
+    fetcher.close()
+    logger.info('Sync stopped, all started periods have been committed.')
 
 
 class GracefulKiller:
-    def __init__(self, func: Callable):
+    # The first SIGINT/SIGTERM drains: the running period may still commit
+    # within the timeout, then func aborts it. A second signal aborts at once
+    def __init__(self, func: Callable, timeout: int):
         self.func = func
+        self.timeout = timeout
+        self.stop = Event()
+        self.timer = None
         signal(SIGINT, self.exit_gracefully)
         signal(SIGTERM, self.exit_gracefully)
 
     def exit_gracefully(self, *args):
+        if self.stop.is_set():
+            self.abort()
+        logger.info(
+            f'Shutting down, waiting up to {self.timeout} seconds '
+            f'for the running period to commit......',
+        )
+        self.stop.set()
+        self.timer = Timer(self.timeout, self.abort)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def abort(self):
+        # The open transaction is rolled back by Postgres, the checkpoint
+        # still points to the last committed period
+        logger.warning('Aborting the running period')
         self.func()
-        quit()
+        os._exit(1)
 
 
 if __name__ == '__main__':
@@ -409,17 +925,27 @@ if __name__ == '__main__':
     log_config['loggers']['pantasia-db-sync']['level'] = settings.log_level
     logging.config.dictConfig(log_config)
 
-    # Create logger
-    logger = logging.getLogger('pantasia-db-sync')
-
     logger.info(f'pantasia-db-sync ({settings.environment}) is starting...')
 
     # Initialize Db connections to Cardano DB and Pantasia DB
-    db = Db(settings)
+    db = Db(settings, metrics=metrics)
+
+    # Optional HTTP endpoint for /metrics and /health
+    if settings.metrics_port:
+        MetricsServer(
+            metrics, settings.metrics_host, settings.metrics_port,
+            settings.health_max_lag,
+        ).start()
 
-    killer = GracefulKiller(db.close_connections)
+    killer = GracefulKiller(db.close_connections, settings.shutdown_timeout)
     try:
-        run(db)
-    except (IntegrityError, DataError, InternalError, TypeError, MemoryError, OSError):
+        # Only returns after a shutdown was requested
+        run(db, killer.stop)
+        killer.timer.cancel()
+        db.close_connections()
+    except (
+        IntegrityError, DataError, InternalError, OperationalError,
+        TypeError, MemoryError, OSError,
+    ):
         logger.exception(traceback.format_exc())
         db.close_connections()
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import logging
+import os
+import sys
+import tracemalloc
+from datetime import datetime
+from itertools import islice
+
+logger = logging.getLogger('pantasia-db-sync')
+
+# Number of items measured in full, larger containers are extrapolated
+SAMPLE_SIZE = 1000
+
+# Factor the learned rows per second decays by each period, so that a burst of
+# activity keeps later estimates high for a while instead of just one period
+RATE_DECAY = 0.9
+
+
+def _item_size(item: any) -> int:
+    # Size of an item and of the values it holds one level down
+    size = sys.getsizeof(item)
+    if isinstance(item, dict):
+        for key, value in item.items():
+            size = size + sys.getsizeof(key) + sys.getsizeof(value)
+    elif isinstance(item, (tuple, list)):
+        for value in item:
+            size = size + sys.getsizeof(value)
+    return size
+
+
+def approximate_size(container: dict | list) -> int:
+    # Approximate bytes used by a dict or list and its items, from a sample
+    count = len(container)
+    if count == 0:
+        return sys.getsizeof(container)
+    if isinstance(container, dict):
+        sample = islice(container.items(), SAMPLE_SIZE)
+        sample_size = sum(_item_size(key) + _item_size(value) for key, value in sample)
+    else:
+        sample = islice(container, SAMPLE_SIZE)
+        sample_size = sum(_item_size(item) for item in sample)
+    return sys.getsizeof(container) + sample_size * count // min(count, SAMPLE_SIZE)
+
+
+def get_rss() -> int | None:
+    # Resident set size of this process in bytes, None where not available
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+# Reports the approximate memory of indexes and period buffers once per period
+class MemoryReport:
+    def __init__(self, config, registry) -> None:
+        self.enabled = config.memory_report
+        self.limit = config.memory_soft_limit_mb * 1024 * 1024
+        self.top = config.memory_tracemalloc_top
+        self.registry = registry
+        if self.top > 0:
+            tracemalloc.start()
+        # Memory of the interpreter and libraries, taken before indexes load.
+        # Current RSS is not used in the limit as freed buffers stay resident
+        self.baseline = get_rss() or 0
+        # Learned from fetched periods, None until the first one
+        self.rows_per_second = 0.0
+        self.bytes_per_row = None
+        self.resident_warned = False
+
+    def batch_size(self, records: list, values: dict | None = None) -> int:
+        # Approximate bytes of the extracted batch and the pending buffers
+        size = approximate_size(records)
+        for buffer in (values or {}).values():
+            size = size + approximate_size(buffer)
+        return size
+
+    def resident_size(self, indexes: dict) -> int:
+        # Approximate bytes held across periods: baseline RSS and the indexes
+        return self.baseline + sum(
+            approximate_size(index.id_index) for index in indexes.values()
+        )
+
+    def observe(
+        self, from_datetime: datetime, to_datetime: datetime, records: list,
+    ) -> None:
+        # Learn the rows per second of chain time and the bytes per record
+        seconds = (to_datetime - from_datetime).total_seconds()
+        if seconds <= 0:
+            return
+        self.rows_per_second = max(
+            len(records) / seconds, self.rows_per_second * RATE_DECAY,
+        )
+        if records:
+            self.bytes_per_row = approximate_size(records) / len(records)
+
+    def estimate(self, from_datetime: datetime, to_datetime: datetime) -> int | None:
+        # Approximate bytes of the records of a period that is not fetched yet
+        if self.bytes_per_row is None:
+            return None
+        seconds = (to_datetime - from_datetime).total_seconds()
+        return int(self.rows_per_second * seconds * self.bytes_per_row)
+
+    def over_limit_estimate(
+        self, indexes: dict, from_datetime: datetime, to_datetime: datetime,
+    ) -> bool:
+        # Whether a period is expected to go over the limit once fetched
+        if self.limit == 0:
+            return False
+        estimate = self.estimate(from_datetime, to_datetime)
+        if estimate is None:
+            return False
+        return self._over_limit(indexes, estimate)
+
+    def over_limit(
+        self, indexes: dict, records: list, values: dict | None = None,
+    ) -> bool:
+        if self.limit == 0:
+            return False
+        return self._over_limit(indexes, self.batch_size(records, values))
+
+    def _over_limit(self, indexes: dict, size: int) -> bool:
+        resident = self.resident_size(indexes)
+        if resident >= self.limit:
+            # Smaller periods cannot help once the indexes fill the limit
+            if not self.resident_warned:
+                logger.warning(
+                    f'Indexes and baseline memory of {resident // 2 ** 20} MiB '
+                    f'are over the soft memory limit, periods are not split',
+                )
+                self.resident_warned = True
+            return False
+        self.resident_warned = False
+        return resident + size > self.limit
+
+    def report(self, indexes: dict, records: list, values: dict) -> None:
+        if not self.enabled and self.top == 0:
+            return
+        sizes = {
+            f'index_{table_name}': approximate_size(index.id_index)
+            for table_name, index in indexes.items()
+        }
+        sizes['records'] = approximate_size(records)
+        for name, buffer in values.items():
+            sizes[name] = approximate_size(buffer)
+        rss = get_rss()
+
+        for name, size in sizes.items():
+            self.registry.set('pantasia_memory_bytes', size, buffer=name)
+        if rss is not None:
+            self.registry.set('pantasia_rss_bytes', rss)
+        logger.debug(
+            f'Memory RSS {(rss or 0) // 2 ** 20} MiB, approximate sizes: '
+            + ', '.join(
+                f'{name} {size // 2 ** 10} KiB'
+                for name, size in sorted(sizes.items(), key=lambda x: -x[1])
+                if size >= 2 ** 10
+            ),
+        )
+
+        if self.top > 0:
+            snapshot = tracemalloc.take_snapshot()
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                logger.debug(f'tracemalloc {stat}')
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import logging
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from threading import Lock
+from threading import Thread
+
+logger = logging.getLogger('pantasia-db-sync')
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels(labels: dict, le: str | None = None) -> str:
+    parts = [f'{key}="{value}"' for key, value in sorted(labels.items())]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+# In-process registry of counters, gauges and histograms in Prometheus format
+class Metrics:
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._types = {}
+        self._values = {}
+        self._histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels: any) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types.setdefault(name, 'counter')
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, kind: str = 'gauge', **labels: any) -> None:
+        # kind='counter' publishes a total that is counted elsewhere
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types.setdefault(name, kind)
+            self._values[key] = value
+
+    def get(self, name: str, **labels: any) -> float | None:
+        return self._values.get((name, tuple(sorted(labels.items()))))
+
+    def observe(self, name: str, value: float, **labels: any) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types.setdefault(name, 'histogram')
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Bucket counts, sum and count
+                histogram = self._histograms[key] = [[0] * len(BUCKETS), 0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][i] = histogram[0][i] + 1
+            histogram[1] = histogram[1] + value
+            histogram[2] = histogram[2] + 1
+
+    def totals(self) -> dict:
+        # Sum of every histogram by name and labels, e.g. total seconds per stage
+        with self._lock:
+            return {
+                f'{name}{_labels(dict(labels))}': histogram[1]
+                for (name, labels), histogram in self._histograms.items()
+            }
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, kind in sorted(self._types.items()):
+                lines.append(f'# TYPE {name} {kind}')
+                if kind == 'histogram':
+                    for (key_name, labels), histogram in self._histograms.items():
+                        if key_name != name:
+                            continue
+                        labels = dict(labels)
+                        buckets, total, count = histogram
+                        for bound, bucket_count in zip(BUCKETS, buckets):
+                            lines.append(
+                                f'{name}_bucket{_labels(labels, bound)} '
+                                f'{bucket_count}',
+                            )
+                        lines.append(
+                            f'{name}_bucket{_labels(labels, "+Inf")} {count}',
+                        )
+                        lines.append(f'{name}_sum{_labels(labels)} {total}')
+                        lines.append(f'{name}_count{_labels(labels)} {count}')
+                else:
+                    for (key_name, labels), value in self._values.items():
+                        if key_name == name:
+                            lines.append(f'{name}{_labels(dict(labels))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the sync loop, served by MetricsServer when enabled
+metrics = Metrics()
+
+
+# HTTP endpoint serving /metrics and /health from a background thread
+class MetricsServer:
+    def __init__(self, registry: Metrics, host: str, port: int, max_lag: int) -> None:
+        self.registry = registry
+        self.max_lag = max_lag
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path == '/metrics':
+                    status, body = 200, server.registry.render()
+                elif self.path == '/health':
+                    status, body = server.health()
+                else:
+                    status, body = 404, 'not found\n'
+                content = body.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format: str, *args: any) -> None:
+                # Keep scrapes out of the application log
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = Thread(
+            target=self.httpd.serve_forever, name='metrics', daemon=True,
+        )
+
+    def health(self) -> tuple:
+        # Unhealthy until the first lag is known, or when the sync falls behind
+        lag = self.registry.get('pantasia_tip_lag_seconds')
+        if lag is None:
+            return 503, 'starting\n'
+        if lag > self.max_lag:
+            return 503, f'lagging {lag:.0f}s\n'
+        return 200, f'ok {lag:.0f}s\n'
+
+    def start(self) -> None:
+        logger.info(
+            f'Serving metrics on port {self.httpd.server_address[1]}',
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import traceback
+from datetime import datetime
+from signal import signal
+from signal import SIGUSR1
+from signal import SIGUSR2
+
+from metrics import Metrics
+
+logger = logging.getLogger('pantasia-db-sync')
+
+
+# Profiles the next periods on SIGUSR1 and dumps all thread stacks on SIGUSR2.
+# While idle the sync loop only checks one attribute per period
+class Profiler:
+    def __init__(self, config, registry: Metrics) -> None:
+        self.path = config.profile_dir
+        self.periods = config.profile_periods
+        self.registry = registry
+        self._requested = False
+        self._profile = None
+        self._remaining = 0
+        self._stage_totals = {}
+        signal(SIGUSR1, self.request)
+        signal(SIGUSR2, self.dump_stacks)
+
+    def request(self, *args: any) -> None:
+        self._requested = True
+
+    def start_period(self) -> None:
+        if not self._requested or self._profile is not None:
+            return
+        self._requested = False
+        logger.info(f'Profiling the next {self.periods} periods')
+        self._stage_totals = self.registry.totals()
+        self._remaining = self.periods
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def end_period(self) -> None:
+        if self._profile is None:
+            return
+        self._remaining = self._remaining - 1
+        if self._remaining > 0:
+            return
+        self._profile.disable()
+        self._write_profile()
+        self._profile = None
+
+    def _file_path(self, prefix: str, extension: str) -> str:
+        os.makedirs(self.path, exist_ok=True)
+        return os.path.join(
+            self.path, f'{prefix}-{datetime.now():%Y%m%dT%H%M%S}.{extension}',
+        )
+
+    def _write_profile(self) -> None:
+        # Raw profile for pstats/snakeviz, and a text summary with the time
+        # spent per sync stage while profiling
+        prof_path = self._file_path('profile', 'prof')
+        self._profile.dump_stats(prof_path)
+
+        summary = io.StringIO()
+        summary.write(f'Profile of {self.periods} periods\n\nStage totals:\n')
+        totals = self.registry.totals()
+        for name, total in sorted(totals.items()):
+            elapsed = total - self._stage_totals.get(name, 0)
+            if elapsed > 0:
+                summary.write(f'  {name:<70} {elapsed:10.3f}s\n')
+        summary.write('\n')
+        stats = pstats.Stats(self._profile, stream=summary)
+        stats.sort_stats('cumulative').print_stats(50)
+
+        text_path = prof_path[:-len('prof')] + 'txt'
+        with open(text_path, 'w') as text_file:
+            text_file.write(summary.getvalue())
+        logger.info(f'Profile written to {prof_path} and {text_path}')
+
+    def dump_stacks(self, *args: any) -> None:
+        # Current stack of every thread, e.g. to see where a stalled sync waits
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks_path = self._file_path('stacks', 'txt')
+        with open(stacks_path, 'w') as stacks_file:
+            for thread_id, frame in sys._current_frames().items():
+                stacks_file.write(
+                    f'Thread {names.get(thread_id, thread_id)}:\n'
+                    f'{"".join(traceback.format_stack(frame))}\n',
+                )
+        logger.info(f'Stacks written to {stacks_path}')
@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+import logging.config
+import os
+from pathlib import PurePath
+
+from db import Db
+from misc import read_yaml
+from settings import settings
+
+
+# Recompute collection_holder and collection_stats from the synced tables,
+# e.g. after a backfill. Stop the sync while this runs
+if __name__ == '__main__':
+    current_dir = PurePath(__file__).parent.parent
+    log_config_path = os.path.join(current_dir, 'logging.yaml')
+
+    log_config = read_yaml(log_config_path)
+    log_config['loggers']['pantasia-db-sync']['level'] = settings.log_level
+    logging.config.dictConfig(log_config)
+
+    logger = logging.getLogger('pantasia-db-sync')
+
+    if not settings.collection_stats:
+        raise RuntimeError('collection_stats is turned off, its tables do not exist')
+
+    db = Db(settings)
+    try:
+        logger.info('Rebuilding collection_stats...')
+        db.pantasia_rebuild_collection_stats()
+        logger.info('collection_stats rebuilt')
+    finally:
+        db.close_connections()
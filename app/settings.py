@@ -8,6 +8,29 @@ class Settings(BaseSettings):
     time_interval: int = 120
     in_memory_index: bool = True
     log_level: str = 'INFO'
+    # Port of the /metrics and /health endpoint, 0 to turn it off
+    metrics_host: str = '0.0.0.0'
+    metrics_port: int = 0
+    # /health fails when Pantasia is further behind the Cardano tip (seconds)
+    health_max_lag: int = 900
+    # Output of the SIGUSR1 profiler and SIGUSR2 stack dumps
+    profile_dir: str = 'profiles'
+    profile_periods: int = 10
+    # Save plans of statements slower than this (seconds), 0 to turn it off
+    slow_query_threshold: float = 0
+    # Share of statements that are explained (extraction is re-run to do so),
+    # explained statements pay the per-node timing of EXPLAIN ANALYZE
+    slow_query_sample_rate: float = 0.01
+    slow_query_log: str = 'slow_queries.jsonl'
+    # Log approximate memory of indexes and period buffers every period
+    memory_report: bool = False
+    # Log the top N allocation sites with tracemalloc, 0 to turn it off
+    memory_tracemalloc_top: int = 0
+    # Split periods expected to take memory over this size (MiB), 0 for none
+    memory_soft_limit_mb: int = 0
+    max_period_retries: int = 3
+    # Seconds to let the running period commit after SIGTERM before aborting it
+    shutdown_timeout: int = 60
 
     # Pantasia DB
     environment: str = 'dev'
@@ -17,6 +40,52 @@ class Settings(BaseSettings):
     db_pass: str = 'postgres'
     db_name: str = 'pantasia'
     db_echo: bool = False
+    # Engine that loads periods: psycopg2, or pipeline (psycopg 3 pipeline mode)
+    db_engine: str = 'psycopg2'
+    # Load inserts directly, or COPY them to staging tables in parallel (staging)
+    load_mode: str = 'direct'
+    staging_connections: int = 4
+    # Where periods are written: postgres, parquet or both. Without postgres,
+    # asset_tx, asset_mint_tx and asset_ext are only written to files
+    sinks: list[str] = ['postgres']
+    parquet_dir: str = 'exports'
+    # File format of the parquet sink (parquet or arrow)
+    parquet_format: str = 'parquet'
+    # Create asset_tx and asset_mint_tx partitioned by month of tx_time
+    partitioned_tables: bool = False
+    # Store addresses, hashes and policy ids as raw bytes (bytea)
+    binary_keys: bool = False
+    # Store each transaction once in a tx table referenced by the fact tables
+    normalized_tx: bool = False
+    # Store each distinct CIP-25 metadata document once in mint_metadata
+    dedup_metadata: bool = False
+    # Fetch metadata as text and write it as is, without parsing it
+    json_passthrough: bool = False
+    # Encoder for metadata that is not passed through (json or orjson)
+    json_encoder: str = 'json'
+    # Keep net quantities per wallet and asset in wallet_asset_balance
+    wallet_balances: bool = False
+    # Keep collection_stats up to date, requires wallet_balances
+    collection_stats: bool = False
+    # Change feed sinks written after each period (notify, table, jsonl)
+    change_feed: list[str] = []
+    change_feed_channel: str = 'pantasia_changes'
+    change_feed_path: str = 'changes.jsonl'
+
+    # Connection handling for both databases
+    db_connect_timeout: int = 10
+    db_keepalives_idle: int = 60
+    db_keepalives_interval: int = 10
+    db_keepalives_count: int = 5
+    db_health_check_interval: int = 30
+    db_reconnect_attempts: int = 0
+    db_reconnect_backoff_max: int = 60
+
+    # Server-side prepared statements for recurring queries
+    prepared_statements: bool = True
+    # Postgres plan_cache_mode (auto, force_custom_plan or force_generic_plan)
+    db_plan_cache_mode: str = 'auto'
+    cdb_plan_cache_mode: str = 'force_custom_plan'
 
     # Backup Config
     db_backup_path: str = './backups/'
@@ -28,6 +97,15 @@ class Settings(BaseSettings):
     cdb_pass: str = 'postgres'
     cdb_name: str = 'cexplorer'
     cdb_echo: bool = False
+    # Additional Cardano DB read replicas as host:port, same credentials
+    cdb_replicas: list[str] = []
+    # Directory of the local cache of extracted records, empty to turn it off
+    record_cache_dir: str = ''
+    # Policy ids (hex) to sync only, or to skip, empty means all policies
+    policy_include: list[str] = []
+    policy_exclude: list[str] = []
+    # Sync only assets minted with quantity 1 and CIP-25 metadata
+    nft_only: bool = False
 
     class Config:
         env_file = '.env'
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging.config
+import os
+import sys
+from datetime import datetime
+from pathlib import PurePath
+
+from db import Db
+from db.reconcile import Reconciler
+from db.reconcile import split_windows
+from main import create_counters
+from main import create_indexes
+from main import load_values
+from main import transform_records
+from misc import read_yaml
+from settings import settings
+
+logger = logging.getLogger('pantasia-db-sync')
+
+
+def resync(database: Db, windows: list) -> None:
+    # Delete and sync again the fact rows of each window, with new ids
+    if settings.wallet_balances:
+        raise RuntimeError(
+            'Windows cannot be synced again with wallet_balances, '
+            'the balance deltas of the deleted rows are not known',
+        )
+    indexes = create_indexes(database)
+    counters = create_counters(database)
+    journaled = list(indexes.values()) + list(counters.values())
+
+    for from_datetime, to_datetime in windows:
+        logger.info(f'Syncing again FROM: {from_datetime} TO: {to_datetime}')
+        try:
+            database.pantasia_create_partitions(from_datetime, to_datetime)
+            asset_ids = database.pantasia_delete_period(from_datetime, to_datetime)
+            records = database.pantasia_get_records(to_datetime, from_datetime)
+            values = transform_records(records, indexes, counters)
+            load_values(database, values)
+
+            # Rows of this window may be older than the latest rows of an asset
+            asset_ids.update(row[1] for row in values['insert_asset_tx'])
+            asset_ids.update(row[1] for row in values['insert_asset_mint_tx'])
+            database.pantasia_update_latest(asset_ids)
+
+            # The sync position is unchanged, next ids have moved on
+            database.pantasia_save_checkpoint(
+                database.pantasia_tip,
+                {
+                    table_name: counter.value
+                    for table_name, counter in counters.items()
+                },
+            )
+            database.pantasia_commit()
+        except Exception:
+            database.pantasia_rollback()
+            for journal in journaled:
+                journal.rollback()
+            raise
+        for journal in journaled:
+            journal.commit()
+        logger.info(f'{len(records)} rows synced again.')
+
+
+# Compare cardano-db-sync with asset_tx/asset_mint_tx window by window and
+# report the windows that differ, optionally syncing them again.
+# Stop the sync while this runs
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Verify Pantasia DB against cardano-db-sync',
+    )
+    parser.add_argument(
+        '--from', dest='from_datetime', type=datetime.fromisoformat,
+        default=datetime.fromisoformat('2021-03-01 00:00:00'),
+    )
+    parser.add_argument(
+        '--to', dest='to_datetime', type=datetime.fromisoformat,
+        help='defaults to the Pantasia tip',
+    )
+    parser.add_argument('--window', type=int, default=1440, help='window in minutes')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--output', help='write the differing windows as JSON')
+    parser.add_argument(
+        '--resync', action='store_true', help='sync the differing windows again',
+    )
+    args = parser.parse_args()
+
+    current_dir = PurePath(__file__).parent.parent
+    log_config_path = os.path.join(current_dir, 'logging.yaml')
+
+    log_config = read_yaml(log_config_path)
+    log_config['loggers']['pantasia-db-sync']['level'] = settings.log_level
+    logging.config.dictConfig(log_config)
+
+    # Read Cardano DB directly and load in a single transaction
+    settings.record_cache_dir = ''
+    settings.db_engine = 'psycopg2'
+    settings.load_mode = 'direct'
+
+    db = Db(settings)
+    reconciler = Reconciler(db, args.workers)
+    try:
+        windows = split_windows(
+            args.from_datetime, args.to_datetime or db.pantasia_tip, args.window,
+        )
+        logger.info(f'Verifying {len(windows)} windows......')
+        differences = reconciler.verify(windows)
+        for difference in differences:
+            logger.warning(
+                f'Window FROM: {difference["from"]} TO: {difference["to"]} '
+                f'differs: {json.dumps(difference["tables"])}',
+            )
+        logger.info(f'{len(differences)} of {len(windows)} windows differ')
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(differences, output_file, indent=2)
+
+        if args.resync and differences:
+            differing = [
+                (
+                    datetime.fromisoformat(difference['from']),
+                    datetime.fromisoformat(difference['to']),
+                )
+                for difference in differences
+            ]
+            resync(db, differing)
+            differences = reconciler.verify(differing)
+            logger.info(f'{len(differences)} windows still differ after syncing')
+    finally:
+        reconciler.close()
+        db.close_connections()
+    sys.exit(1 if differences else 0)
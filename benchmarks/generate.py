@@ -0,0 +1,275 @@
+from __future__ import annotations
+
+import argparse
+import json
+import random
+from datetime import datetime
+from datetime import timedelta
+from hashlib import blake2b
+
+import psycopg2
+from psycopg2.extras import execute_values
+from pycardano import Address
+from pycardano import Network
+from pycardano import VerificationKeyHash
+from pycardano.crypto.bech32 import encode
+
+# Subset of the cardano-db-sync schema read by the extraction query
+SCHEMA = """
+DROP TABLE IF EXISTS block, tx, tx_out, tx_in, ma_tx_out, ma_tx_mint,
+    multi_asset, stake_address, tx_metadata CASCADE;
+
+CREATE TABLE block (
+    id int8 PRIMARY KEY, block_no int4, time timestamp NOT NULL
+);
+CREATE TABLE tx (
+    id int8 PRIMARY KEY, hash bytea NOT NULL, block_id int8 NOT NULL,
+    valid_contract bool NOT NULL
+);
+CREATE TABLE stake_address (id int8 PRIMARY KEY, view varchar NOT NULL);
+CREATE TABLE tx_out (
+    id int8 PRIMARY KEY, tx_id int8 NOT NULL, index int2 NOT NULL,
+    address varchar NOT NULL, address_raw bytea NOT NULL, stake_address_id int8
+);
+CREATE TABLE tx_in (
+    id int8 PRIMARY KEY, tx_in_id int8 NOT NULL, tx_out_id int8 NOT NULL,
+    tx_out_index int2 NOT NULL
+);
+CREATE TABLE multi_asset (
+    id int8 PRIMARY KEY, policy bytea NOT NULL, name bytea NOT NULL,
+    fingerprint varchar NOT NULL
+);
+CREATE TABLE ma_tx_out (
+    id int8 PRIMARY KEY, ident int8 NOT NULL, quantity numeric (20,0) NOT NULL,
+    tx_out_id int8 NOT NULL
+);
+CREATE TABLE ma_tx_mint (
+    id int8 PRIMARY KEY, ident int8 NOT NULL, quantity numeric (20,0) NOT NULL,
+    tx_id int8 NOT NULL
+);
+CREATE TABLE tx_metadata (
+    id int8 PRIMARY KEY, key numeric (20,0) NOT NULL, json jsonb, tx_id int8 NOT NULL
+);
+"""
+
+# Indexes that cardano-db-sync creates on these tables
+INDEXES = """
+CREATE INDEX idx_block_time ON block (time);
+CREATE INDEX idx_block_block_no ON block (block_no);
+CREATE INDEX idx_tx_block_id ON tx (block_id);
+CREATE INDEX idx_tx_out_tx_id ON tx_out (tx_id);
+CREATE INDEX idx_tx_in_tx_in_id ON tx_in (tx_in_id);
+CREATE INDEX idx_tx_in_source_tx ON tx_in (tx_out_id);
+CREATE INDEX idx_ma_tx_out_tx_out_id ON ma_tx_out (tx_out_id);
+CREATE INDEX idx_ma_tx_mint_tx_id ON ma_tx_mint (tx_id);
+CREATE INDEX idx_ma_tx_mint_ident ON ma_tx_mint (ident);
+CREATE INDEX idx_tx_metadata_tx_id ON tx_metadata (tx_id);
+ANALYZE;
+"""
+
+# Rows per table in the order they are inserted
+TABLES = (
+    ('block', ('id', 'block_no', 'time')),
+    ('stake_address', ('id', 'view')),
+    ('tx', ('id', 'hash', 'block_id', 'valid_contract')),
+    ('tx_out', ('id', 'tx_id', 'index', 'address', 'address_raw', 'stake_address_id')),
+    ('tx_in', ('id', 'tx_in_id', 'tx_out_id', 'tx_out_index')),
+    ('multi_asset', ('id', 'policy', 'name', 'fingerprint')),
+    ('ma_tx_out', ('id', 'ident', 'quantity', 'tx_out_id')),
+    ('ma_tx_mint', ('id', 'ident', 'quantity', 'tx_id')),
+    ('tx_metadata', ('id', 'key', 'json', 'tx_id')),
+)
+
+# First block containing native assets, where the sync starts
+GENESIS = datetime.fromisoformat('2021-03-01 21:47:00')
+
+
+class Chain:
+    # Builds a synthetic chain in memory, holding the unspent outputs of assets
+    def __init__(self, seed: int, wallets: int) -> None:
+        self.random = random.Random(seed)
+        self.rows = {table_name: [] for table_name, _ in TABLES}
+        self.ids = {table_name: 0 for table_name, _ in TABLES}
+        self.time = GENESIS
+        self.block_id = None
+        # Unspent outputs as (tx_id, index, wallet, [(asset id, quantity)])
+        self.utxos = []
+        self.wallets = [self._wallet(i) for i in range(wallets)]
+
+    def _next_id(self, table_name: str) -> int:
+        self.ids[table_name] = self.ids[table_name] + 1
+        return self.ids[table_name]
+
+    def _hash(self, size: int) -> bytes:
+        return self.random.randbytes(size)
+
+    def _wallet(self, i: int) -> tuple:
+        # Mostly base addresses with a stake key, some enterprise addresses
+        payment = VerificationKeyHash(self._hash(28))
+        if i % 10 == 0:
+            address = Address(payment_part=payment, network=Network.MAINNET)
+            return str(address), address.to_primitive(), None
+        staking = VerificationKeyHash(self._hash(28))
+        address = Address(
+            payment_part=payment, staking_part=staking, network=Network.MAINNET,
+        )
+        stake_address_id = self._next_id('stake_address')
+        self.rows['stake_address'].append(
+            (
+                stake_address_id,
+                Address(staking_part=staking, network=Network.MAINNET).encode(),
+            ),
+        )
+        return str(address), address.to_primitive(), stake_address_id
+
+    def block(self, seconds: int = 20) -> None:
+        self.time = self.time + timedelta(seconds=seconds)
+        self.block_id = self._next_id('block')
+        self.rows['block'].append((self.block_id, self.block_id, self.time))
+
+    def _tx(self) -> int:
+        tx_id = self._next_id('tx')
+        self.rows['tx'].append((tx_id, self._hash(32), self.block_id, True))
+        return tx_id
+
+    def _output(self, tx_id: int, index: int, wallet: tuple, assets: list) -> None:
+        address, address_raw, stake_address_id = wallet
+        tx_out_id = self._next_id('tx_out')
+        self.rows['tx_out'].append(
+            (tx_out_id, tx_id, index, address, address_raw, stake_address_id),
+        )
+        for asset_id, quantity in assets:
+            self.rows['ma_tx_out'].append(
+                (self._next_id('ma_tx_out'), asset_id, quantity, tx_out_id),
+            )
+        self.utxos.append((tx_id, index, wallet, assets))
+
+    def mint(self, policy: bytes, names: list, quantity: int = 1) -> None:
+        # One transaction minting the assets to one wallet with CIP-25 metadata
+        tx_id = self._tx()
+        metadata = {policy.hex(): {}}
+        assets = []
+        for name in names:
+            asset_id = self._next_id('multi_asset')
+            fingerprint = encode(
+                'asset', blake2b(policy + name, digest_size=20).digest(),
+            )
+            self.rows['multi_asset'].append((asset_id, policy, name, fingerprint))
+            self.rows['ma_tx_mint'].append(
+                (self._next_id('ma_tx_mint'), asset_id, quantity, tx_id),
+            )
+            metadata[policy.hex()][name.decode()] = {
+                'name': name.decode(),
+                'image': f'ipfs://Qm{self._hash(22).hex()}',
+                'mediaType': 'image/png',
+                'files': [{'src': f'ipfs://Qm{self._hash(22).hex()}'}],
+                'attributes': {'rarity': self.random.choice(['common', 'rare'])},
+            }
+            assets.append((asset_id, quantity))
+        self.rows['tx_metadata'].append(
+            (self._next_id('tx_metadata'), 721, json.dumps(metadata), tx_id),
+        )
+        self._output(tx_id, 0, self.random.choice(self.wallets), assets)
+
+    def transfer(self) -> None:
+        # Spend a random output holding assets and send them to another wallet
+        if not self.utxos:
+            return
+        position = self.random.randrange(len(self.utxos))
+        self.utxos[position], self.utxos[-1] = self.utxos[-1], self.utxos[position]
+        out_tx_id, out_index, _, assets = self.utxos.pop()
+        tx_id = self._tx()
+        self.rows['tx_in'].append(
+            (self._next_id('tx_in'), tx_id, out_tx_id, out_index),
+        )
+        self._output(tx_id, 0, self.random.choice(self.wallets), assets)
+
+
+def generate(shape: str, blocks: int, seed: int) -> Chain:
+    chain = Chain(seed, wallets=max(100, blocks))
+    policies = [chain._hash(28) for _ in range(20)]
+    serial = 0
+
+    def names(count: int) -> list:
+        nonlocal serial
+        serial = serial + count
+        return [f'Item{i:06d}'.encode() for i in range(serial - count, serial)]
+
+    if shape == 'quiet':
+        # A few transactions per block, occasional small mints
+        for _ in range(blocks):
+            chain.block()
+            if chain.random.random() < 0.2:
+                chain.mint(chain.random.choice(policies), names(5))
+            for _ in range(chain.random.randint(0, 3)):
+                chain.transfer()
+    elif shape == 'mint-storm':
+        # 10k items of one policy minted in 100 transactions over 10 blocks
+        chain.block()
+        storm_policy = policies[0]
+        for block in range(10):
+            chain.block()
+            for _ in range(10):
+                chain.mint(storm_policy, names(100))
+        for _ in range(blocks):
+            chain.block()
+            chain.transfer()
+    elif shape == 'churn':
+        # Marketplace churn, many transfers of a fixed set of assets
+        chain.block()
+        for policy in policies:
+            chain.mint(policy, names(50))
+        for _ in range(blocks):
+            chain.block()
+            for _ in range(chain.random.randint(10, 40)):
+                chain.transfer()
+    else:
+        raise ValueError(f'Unknown shape {shape}')
+    return chain
+
+
+def load(chain: Chain, dsn: str) -> None:
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA)
+        for table_name, columns in TABLES:
+            execute_values(
+                cur,
+                f'INSERT INTO {table_name} ({", ".join(columns)}) VALUES %s',
+                chain.rows[table_name],
+                page_size=5000,
+            )
+        cur.execute(INDEXES)
+    conn.commit()
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fill a local Postgres with a synthetic cardano-db-sync chain',
+    )
+    parser.add_argument(
+        '--dsn', default='dbname=cardano_bench user=postgres host=localhost',
+        help='libpq connection string of the database to fill (tables are replaced)',
+    )
+    parser.add_argument(
+        '--shape', choices=('quiet', 'mint-storm', 'churn'), default='quiet',
+    )
+    parser.add_argument('--blocks', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    chain = generate(args.shape, args.blocks, args.seed)
+    load(chain, args.dsn)
+    print(
+        json.dumps(
+            {
+                'shape': args.shape,
+                'blocks': args.blocks,
+                'seed': args.seed,
+                'rows': {name: len(rows) for name, rows in chain.rows.items()},
+                'from': GENESIS.isoformat(),
+                'to': chain.time.isoformat(),
+            },
+        ),
+    )
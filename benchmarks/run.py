@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+from datetime import datetime
+from datetime import timedelta
+from statistics import median
+from time import time
+
+# Run against the modules of the app, as main.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'app'))
+
+import psycopg2  # noqa: E402
+from cardano import get_staking_address  # noqa: E402
+from db import Db  # noqa: E402
+from main import create_counters  # noqa: E402
+from main import create_indexes  # noqa: E402
+from main import load_values  # noqa: E402
+from main import transform_records  # noqa: E402
+from metrics import Metrics  # noqa: E402
+from settings import settings  # noqa: E402
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def reset_pantasia_db() -> None:
+    # Every run loads into an empty Pantasia DB so that results are comparable
+    conn = psycopg2.connect(
+        dbname=settings.db_name, user=settings.db_user, password=settings.db_pass,
+        host=settings.db_host, port=settings.db_port,
+    )
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public;')
+    conn.commit()
+    conn.close()
+
+
+def summary(timings: list, rows: int) -> dict:
+    total = sum(timings)
+    return {
+        'seconds': round(total, 6),
+        'median_seconds': round(median(timings), 6) if timings else None,
+        'rows': rows,
+        'rows_per_second': round(rows / total, 2) if total else None,
+    }
+
+
+def bench_extract(database: Db, periods: list, repeat: int) -> tuple:
+    # Best of repeated runs per period, the first run warms the Postgres cache
+    timings = []
+    records_per_period = []
+    for from_datetime, to_datetime in periods:
+        best = None
+        for _ in range(repeat):
+            time_started = time()
+            records = database.pantasia_get_records(to_datetime, from_datetime)
+            elapsed = time() - time_started
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append(best)
+        records_per_period.append(records)
+    rows = sum(len(records) for records in records_per_period)
+    return summary(timings, rows), records_per_period
+
+
+def bench_staking_address(records_per_period: list) -> dict:
+    addresses = {
+        record['address']
+        for records in records_per_period
+        for record in records
+        if record['address'] is not None
+    }
+    time_started = time()
+    for address in addresses:
+        get_staking_address(address)
+    return summary([time() - time_started], len(addresses))
+
+
+def bench_transform(database: Db, records_per_period: list) -> dict:
+    # Transform every period in order, keeping each period in the indexes and
+    # counters for the next as the sync loop does. Nothing is written, the
+    # next benchmark builds its indexes from the database again
+    indexes = create_indexes(database)
+    counters = create_counters(database)
+    timings = []
+    for records in records_per_period:
+        time_started = time()
+        transform_records(records, indexes, counters)
+        timings.append(time() - time_started)
+        for journal in list(indexes.values()) + list(counters.values()):
+            journal.commit()
+    rows = sum(len(records) for records in records_per_period)
+    return summary(timings, rows)
+
+
+def bench_end_to_end(database: Db, periods: list) -> dict:
+    # Extract, transform, load and commit every period like the sync loop
+    indexes = create_indexes(database)
+    counters = create_counters(database)
+    timings = []
+    rows = 0
+    for from_datetime, to_datetime in periods:
+        time_started = time()
+        records = database.pantasia_get_records(to_datetime, from_datetime)
+        values = transform_records(records, indexes, counters)
+        load_values(database, values)
+        database.pantasia_save_checkpoint(
+            to_datetime,
+            {table_name: counter.value for table_name, counter in counters.items()},
+        )
+        database.pantasia_commit()
+        for journal in list(indexes.values()) + list(counters.values()):
+            journal.commit()
+        timings.append(time() - time_started)
+        rows = rows + len(records)
+    return summary(timings, rows)
+
+
+def bench_id_index(database: Db) -> dict:
+    # Load the full indexes of the loaded Pantasia DB and look up every key
+    in_memory_index = settings.in_memory_index
+    settings.in_memory_index = True
+    results = {}
+    try:
+        time_started = time()
+        indexes = create_indexes(database)
+        results['load'] = summary(
+            [time() - time_started],
+            sum(len(index.id_index) for index in indexes.values()),
+        )
+        timings = []
+        keys = 0
+        for index in indexes.values():
+            reference_values = list(index.id_index)
+            time_started = time()
+            for reference_value in reference_values:
+                index.get(reference_value)
+            timings.append(time() - time_started)
+            keys = keys + len(reference_values)
+        results['get'] = summary(timings, keys)
+    finally:
+        settings.in_memory_index = in_memory_index
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sync stages against a generated Cardano DB',
+    )
+    parser.add_argument('--cardano-db', default='cardano_bench')
+    parser.add_argument(
+        '--pantasia-db', default='pantasia_bench',
+        help='Pantasia DB to load into, its public schema is dropped on every run',
+    )
+    parser.add_argument(
+        '--from', dest='from_datetime', type=datetime.fromisoformat,
+        default=datetime.fromisoformat('2021-03-01 21:47:00'),
+    )
+    parser.add_argument('--to', dest='to_datetime', type=datetime.fromisoformat)
+    parser.add_argument('--interval', type=int, default=60, help='period in minutes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--shape', help='label of the generated chain shape')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    settings.db_name = args.pantasia_db
+    settings.cdb_name = args.cardano_db
+    settings.record_cache_dir = ''
+    settings.slow_query_threshold = 0
+    reset_pantasia_db()
+
+    registry = Metrics()
+    database = Db(settings, metrics=registry)
+    to_datetime = args.to_datetime or database.cardano_tip
+    periods = []
+    from_datetime = args.from_datetime
+    while from_datetime < to_datetime:
+        period_end = min(from_datetime + timedelta(minutes=args.interval), to_datetime)
+        periods.append((from_datetime, period_end))
+        from_datetime = period_end
+
+    results = {}
+    results['extract'], records_per_period = bench_extract(
+        database, periods, args.repeat,
+    )
+    results['get_staking_address'] = bench_staking_address(records_per_period)
+    results['transform'] = bench_transform(database, records_per_period)
+    del records_per_period
+    results['end_to_end'] = bench_end_to_end(database, periods)
+    results['id_index'] = bench_id_index(database)
+
+    # Time spent in every pantasia_insert_* and upsert during the end-to-end run
+    results['load'] = {
+        key: round(seconds, 6) for key, seconds in registry.totals().items()
+    }
+    database.close_connections()
+
+    report = {
+        'commit': git_commit(),
+        'time': datetime.utcnow().isoformat(),
+        'shape': args.shape,
+        'cardano_db': args.cardano_db,
+        'periods': len(periods),
+        'interval_minutes': args.interval,
+        'settings': {
+            key: value
+            for key, value in settings.dict().items()
+            if not key.endswith('pass')
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2, default=str)
+    print(json.dumps(results['end_to_end']))
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+from datetime import datetime
+from types import SimpleNamespace
+
+import main
+import pytest
+from db import IdCounter
+from main import get_positive_changes
+from main import transform_records
+from settings import settings
+
+POLICY_ID = 'ab' * 28
+ASSET_NAME = '6e667431'
+FINGERPRINT = 'asset1test'
+
+
+class _Index:
+    # In-memory IdIndex without a database behind it
+    def __init__(self) -> None:
+        self.id_index = {}
+
+    def get(self, reference_value: any) -> int | None:
+        return self.id_index.get(reference_value)
+
+    def set(self, index_id: int, reference_value: any) -> None:
+        self.id_index[reference_value] = index_id
+
+
+@pytest.fixture
+def sync(monkeypatch: pytest.MonkeyPatch) -> tuple:
+    monkeypatch.setattr(
+        main, 'settings', settings.copy(update={'wallet_balances': True}),
+    )
+    database = SimpleNamespace(pantasia_get_last_index=lambda table_name: 1)
+    indexes = {
+        table_name: _Index()
+        for table_name in ('asset', 'wallet', 'collection', 'asset_ext')
+    }
+    counters = {
+        table_name: IdCounter(table_name, database)
+        for table_name in (
+            'asset', 'asset_mint_tx', 'asset_tx', 'collection', 'wallet',
+        )
+    }
+    return indexes, counters
+
+
+def _record(address: str, is_mint_tx: bool, is_spent: bool = False) -> dict:
+    return {
+        'policy_id': POLICY_ID,
+        'asset_name_hash': ASSET_NAME,
+        'asset_fingerprint': FINGERPRINT,
+        'tx_hash': 'cd' * 32,
+        'tx_time': datetime(2022, 1, 1),
+        'block_no': 1,
+        'address': address,
+        'quantity': 1,
+        'is_mint_tx': is_mint_tx,
+        'is_spent': is_spent,
+        'image': None,
+        'metadata': None,
+        'files': None,
+        'metadata_hash': None,
+    }
+
+
+def test_balance_deltas(sync: tuple) -> None:
+    indexes, counters = sync
+
+    # Mint to alice
+    values = transform_records([_record('Ae2alice', True)], indexes, counters)
+    alice = indexes['wallet'].get('Ae2alice')
+    asset = indexes['asset'].get(FINGERPRINT)
+    collection = indexes['collection'].get(POLICY_ID)
+    assert values['upsert_wallet_asset_balance'] == [(alice, asset, 1, collection)]
+
+    # Transfer from alice to bob: bob receives it, alice's input is spent
+    values = transform_records(
+        [
+            _record('Ae2bob', False),
+            _record('Ae2alice', False, is_spent=True),
+        ],
+        indexes, counters,
+    )
+    bob = indexes['wallet'].get('Ae2bob')
+    assert sorted(values['upsert_wallet_asset_balance']) == sorted([
+        (bob, asset, 1, collection),
+        (alice, asset, -1, collection),
+    ])
+
+
+def test_balance_deltas_cancel_out(sync: tuple) -> None:
+    indexes, counters = sync
+    transform_records([_record('Ae2alice', True)], indexes, counters)
+
+    # Sent back to the same wallet within one period
+    values = transform_records(
+        [
+            _record('Ae2alice', False),
+            _record('Ae2alice', False, is_spent=True),
+        ],
+        indexes, counters,
+    )
+    assert values['upsert_wallet_asset_balance'] == []
+
+
+def test_positive_changes() -> None:
+    deltas = {'minted': 1, 'received': 2, 'spent': -1, 'partly_spent': -1}
+    rows = [('minted', 1), ('received', 5), ('spent', 0), ('partly_spent', 2)]
+    assert get_positive_changes(deltas, rows) == {'minted': 1, 'spent': -1}
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from db.cache import RecordCache
+from settings import settings
+
+START = datetime(2022, 1, 1)
+
+
+def _record(minutes: int) -> dict:
+    return {
+        'policy_id': 'ab' * 28,
+        'asset_fingerprint': f'asset{minutes}',
+        'asset_name': f'Pantasia{minutes}',
+        'asset_name_hash': f'{minutes:04x}',
+        'tx_hash': f'{minutes:064x}',
+        'quantity': Decimal(1),
+        'address': 'addr1',
+        'address_raw': b'\x01',
+        'stake_address': None,
+        'is_mint_tx': False,
+        'is_spent': False,
+        'tx_time': START + timedelta(minutes=minutes),
+        'block_no': minutes,
+        'image': None,
+        'files': None,
+        'metadata': {'name': f'Pantasia{minutes}'} if minutes % 20 else None,
+        'metadata_hash': minutes.to_bytes(32, 'big') if minutes % 20 else None,
+    }
+
+
+def _minutes(records: list) -> list:
+    return [
+        int((record['tx_time'] - START).total_seconds() // 60)
+        for record in records
+    ]
+
+
+@pytest.fixture
+def cache(tmp_path: pytest.TempPathFactory) -> RecordCache:
+    pytest.importorskip('pyarrow')
+    config = settings.copy(
+        update={'record_cache_dir': str(tmp_path), 'json_passthrough': False},
+    )
+    cache = RecordCache(config, 'SELECT 1')
+    # Two cached periods of 2 hours, a record every 10 minutes
+    for hour in (0, 2):
+        minutes = range(hour * 60 + 10, hour * 60 + 121, 10)
+        cache.put(
+            START + timedelta(hours=hour),
+            START + timedelta(hours=hour + 2),
+            [_record(minute) for minute in minutes],
+        )
+    return cache
+
+
+def test_same_period_hits(cache: RecordCache) -> None:
+    records = cache.get(START, START + timedelta(hours=2))
+    assert _minutes(records) == list(range(10, 121, 10))
+    assert records[0]['metadata'] == {'name': 'Pantasia10'}
+    assert records[1]['metadata'] is None
+
+
+def test_split_period_hits(cache: RecordCache) -> None:
+    # A period split in halves, e.g. over the memory limit
+    first = cache.get(START, START + timedelta(hours=1))
+    second = cache.get(START + timedelta(hours=1), START + timedelta(hours=2))
+    assert _minutes(first) == list(range(10, 61, 10))
+    assert _minutes(second) == list(range(70, 121, 10))
+
+
+def test_shifted_period_hits(cache: RecordCache) -> None:
+    # A period across both cached files, rows at the bounds are not repeated
+    records = cache.get(
+        START + timedelta(minutes=95), START + timedelta(minutes=185),
+    )
+    assert _minutes(records) == list(range(100, 181, 10))
+    assert records == [_record(minute) for minute in range(100, 181, 10)]
+
+
+def test_cached_periods_found_after_restart(
+        cache: RecordCache,
+        tmp_path: pytest.TempPathFactory,
+) -> None:
+    config = settings.copy(
+        update={'record_cache_dir': str(tmp_path), 'json_passthrough': False},
+    )
+    restarted = RecordCache(config, 'SELECT 1')
+    records = restarted.get(
+        START + timedelta(minutes=30), START + timedelta(minutes=150),
+    )
+    assert _minutes(records) == list(range(40, 151, 10))
+
+
+def test_period_beyond_cache_misses(cache: RecordCache) -> None:
+    assert cache.get(
+        START + timedelta(hours=3), START + timedelta(hours=5),
+    ) is None
+    assert cache.get(START - timedelta(hours=1), START + timedelta(hours=1)) is None
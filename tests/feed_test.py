@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+import feed
+from feed import ChangeFeed
+from feed import get_changes
+from settings import settings
+
+TIP = datetime(2022, 1, 1, 12)
+
+
+def _values(**values: any) -> dict:
+    # Values of a period with nothing in them but the given batches
+    empty = {
+        'insert_wallet': [],
+        'insert_collection': [],
+        'insert_asset_mint_tx': [],
+        'insert_asset_tx': [],
+        'insert_asset': [],
+        'update_asset_ext_latest_mint_tx_id': [],
+        'update_asset_ext_latest_tx_id': [],
+        'update_asset_current_wallet_id': [],
+        'upsert_wallet_asset_balance': [],
+        'upsert_collection_stats': {},
+    }
+    return {**empty, **values}
+
+
+def test_changes_split_new_and_updated() -> None:
+    values = _values(
+        insert_wallet=[(5, 'addr_new', None, 'STAKE')],
+        insert_collection=[(9, 'ab' * 28)],
+        insert_asset=[(20, 9, 'ab.6e', 'n', 'asset1new', None, 5)],
+        update_asset_current_wallet_id=[(20, 5), (21, 4)],
+        update_asset_ext_latest_tx_id=[(22, 100)],
+        insert_asset_tx=[(100, 21, 4, 1, 'cd' * 32, TIP)],
+        insert_asset_mint_tx=[(200, 20, 5, 1, 'cd' * 32, TIP, None, None, None)],
+        upsert_wallet_asset_balance=[(3, 21, -1, 8)],
+        upsert_collection_stats={8: [0, 0, 1, TIP, TIP]},
+    )
+    assert get_changes(TIP, values) == {
+        'tip': '2022-01-01T12:00:00',
+        'asset': {'new': [20], 'updated': [21, 22]},
+        'wallet': {'new': [5], 'updated': [3, 4]},
+        'collection': {'new': [9], 'updated': [8]},
+    }
+
+
+def test_changes_skip_null_ids() -> None:
+    # Burns have no wallet
+    values = _values(
+        insert_asset_mint_tx=[(200, 20, 'Null', -1, 'cd' * 32, TIP, None, None, None)],
+    )
+    assert get_changes(TIP, values)['wallet'] == {'new': [], 'updated': []}
+
+
+def test_notify_payload_truncated(monkeypatch) -> None:
+    notified = []
+    database = SimpleNamespace(
+        pantasia_notify=lambda channel, payload: notified.append(payload),
+    )
+    config = settings.copy(update={'change_feed': ['notify']})
+    change_feed = ChangeFeed(database, config)
+
+    change_feed.stage(TIP, _values(insert_wallet=[(5, 'addr', None, 'STAKE')]))
+    assert json.loads(notified[-1])['wallet']['new'] == [5]
+
+    monkeypatch.setattr(feed, 'MAX_NOTIFY_PAYLOAD', 10)
+    change_feed.stage(TIP, _values())
+    assert json.loads(notified[-1]) == {
+        'tip': '2022-01-01T12:00:00', 'truncated': True,
+    }
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import pytest
+from db import IdCounter
+from db import IdIndex
+
+
+@pytest.fixture
+def database() -> SimpleNamespace:
+    # Minimal in-memory index with nothing to load from the Pantasia DB
+    return SimpleNamespace(
+        config=SimpleNamespace(in_memory_index=False),
+        pantasia_get_last_index=lambda table_name: 10,
+    )
+
+
+def test_index_rollback_restores_committed_entries(database) -> None:
+    index = IdIndex('wallet', 'address', database)
+    index.set(1, 'addr1')
+    index.set(2, 'addr2')
+    index.commit()
+
+    index.set(3, 'addr3')
+    index.set(20, 'addr1')
+    index.set(21, 'addr1')
+    index.rollback()
+    assert index.id_index == {'addr1': 1, 'addr2': 2}
+
+
+def test_index_rollback_removes_missing_keys(database) -> None:
+    index = IdIndex('wallet', 'address', database)
+    index.set(1, 'addr1')
+    index.set(2, 'addr1')
+    index.rollback()
+    assert index.id_index == {}
+
+
+def test_index_rollback_keeps_stored_none(database) -> None:
+    # A key mapped to None is restored, not removed like a missing key
+    index = IdIndex('wallet', 'address', database)
+    index.id_index['addr1'] = None
+    index.set(1, 'addr1')
+    index.rollback()
+    assert index.id_index == {'addr1': None}
+
+
+def test_index_commit_clears_journal(database) -> None:
+    index = IdIndex('wallet', 'address', database)
+    index.set(1, 'addr1')
+    index.commit()
+    index.rollback()
+    assert index.id_index == {'addr1': 1}
+
+
+def test_counter_rewinds_to_last_commit(database) -> None:
+    counter = IdCounter('tx', database)
+    assert [counter.next(), counter.next()] == [10, 11]
+    counter.commit()
+
+    assert counter.next() == 12
+    counter.rollback()
+    assert counter.next() == 12
+    counter.rollback()
+    assert counter.value == 12
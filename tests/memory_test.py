@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from datetime import datetime
+from datetime import timedelta
+from types import SimpleNamespace
+
+import memory
+from main import split_large_periods
+from memory import MemoryReport
+from settings import settings
+
+START = datetime(2022, 1, 1)
+
+
+class _Fetcher:
+    # Prefetches one period at a time, some of them already in flight
+    def __init__(self, scheduled: set | None = None) -> None:
+        self.window = 1
+        self._scheduled = scheduled or set()
+
+    def scheduled(self, from_datetime: datetime, to_datetime: datetime) -> bool:
+        return (from_datetime, to_datetime) in self._scheduled
+
+
+def _memory(limit_mb: int, monkeypatch) -> MemoryReport:
+    monkeypatch.setattr(memory, 'get_rss', lambda: 0)
+    config = settings.copy(update={'memory_soft_limit_mb': limit_mb})
+    return MemoryReport(config, registry=None)
+
+
+def _records(count: int) -> list:
+    return [{'tx_hash': f'{i:064x}', 'quantity': i} for i in range(count)]
+
+
+def _hours(*hours: int) -> list:
+    return [START + timedelta(hours=hour) for hour in hours]
+
+
+def test_estimate_from_previous_period(monkeypatch) -> None:
+    report = _memory(1, monkeypatch)
+    assert report.estimate(*_hours(0, 1)) is None
+
+    records = _records(3600)
+    report.observe(*_hours(0, 1), records)
+    assert report.rows_per_second == 1
+    estimate = report.estimate(*_hours(1, 3))
+    assert estimate == 2 * memory.approximate_size(records)
+
+
+def test_rate_decays_after_a_burst(monkeypatch) -> None:
+    report = _memory(1, monkeypatch)
+    report.observe(*_hours(0, 1), _records(3600))
+    report.observe(*_hours(1, 2), [])
+    assert report.rows_per_second == memory.RATE_DECAY
+
+
+def test_split_before_fetching(monkeypatch) -> None:
+    report = _memory(1, monkeypatch)
+    # About 1 MiB per hour of chain time
+    records = _records(4000)
+    report.observe(*_hours(0, 1), records)
+    assert memory.approximate_size(records) > 2 ** 20
+
+    period_list = _hours(1, 2)
+    added = split_large_periods(period_list, report, {}, _Fetcher())
+    assert added >= 1
+    assert len(period_list) == added + 2
+    assert period_list[0] == START + timedelta(hours=1)
+    assert period_list[-1] == START + timedelta(hours=2)
+    assert period_list == sorted(period_list)
+
+
+def test_no_split_when_in_flight_or_unlimited(monkeypatch) -> None:
+    report = _memory(1, monkeypatch)
+    report.observe(*_hours(0, 1), _records(4000))
+
+    period_list = _hours(1, 2)
+    fetcher = _Fetcher({tuple(period_list)})
+    assert split_large_periods(period_list, report, {}, fetcher) == 0
+
+    unlimited = _memory(0, monkeypatch)
+    unlimited.observe(*_hours(0, 1), _records(4000))
+    assert split_large_periods(_hours(1, 2), unlimited, {}, _Fetcher()) == 0
+
+
+def test_indexes_count_toward_limit(monkeypatch) -> None:
+    report = _memory(1, monkeypatch)
+    records = _records(100)
+    indexes = {'tx': SimpleNamespace(id_index={i: i for i in range(1000)})}
+    index_size = memory.approximate_size(indexes['tx'].id_index)
+    batch_size = memory.approximate_size(records)
+
+    report.limit = index_size + batch_size - 1
+    assert report.over_limit({}, records) is False
+    assert report.over_limit(indexes, records) is True
+
+    # Splitting cannot help once the indexes alone fill the limit
+    report.limit = index_size
+    assert report.over_limit(indexes, records) is False
+    assert report.resident_warned is True
@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import pytest
+from db import Db
+from db import pool
+from db.pool import ConnectionPool
+from db.replicas import CardanoReplica
+from psycopg2 import OperationalError
+from settings import settings
+
+
+@pytest.fixture
+def cardano_down(monkeypatch: pytest.MonkeyPatch) -> list:
+    # Every connection attempt fails, without waiting between attempts
+    attempts = []
+
+    def connect(**kwargs: any) -> None:
+        attempts.append(kwargs['host'])
+        raise OperationalError('could not connect to server')
+
+    monkeypatch.setattr(pool.psycopg2, 'connect', connect)
+    monkeypatch.setattr(pool, 'sleep', lambda seconds: None)
+    return attempts
+
+
+def _pool(host: str) -> ConnectionPool:
+    return ConnectionPool(
+        'cardano',
+        host=host,
+        port=5432,
+        dbname='cexplorer',
+        user='postgres',
+        password='',
+        config=settings.copy(update={'db_reconnect_attempts': 2}),
+    )
+
+
+def test_replica_down_is_skipped(cardano_down: list) -> None:
+    replica = CardanoReplica(_pool('replica'))
+    assert replica.connect(retry=False) is False
+    assert replica.conn is None and replica.cur is None
+    assert cardano_down == ['replica']
+
+
+def test_primary_down_past_reconnect_attempts(cardano_down: list) -> None:
+    database = Db.__new__(Db)
+    database.cardano_replicas = [
+        CardanoReplica(_pool('primary'), required=True),
+        CardanoReplica(_pool('replica')),
+    ]
+    with pytest.raises(OperationalError):
+        database.reconnect()
+    assert cardano_down == ['primary', 'primary']
+    assert database.cardano_conn is None and database.cardano_cur is None
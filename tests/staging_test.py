@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+from db.rows import RowLayout
+from db.staging import _copy_value
+from settings import settings
+
+TX_TIME = datetime(2022, 1, 1, 12, 30)
+
+
+def _layout(**config: any) -> RowLayout:
+    # Row layout of a Pantasia DB with the given settings, not partitioned
+    config = settings.copy(update=config)
+
+    def tx_columns() -> str:
+        return 'tx_id' if config.normalized_tx else 'tx_hash, tx_time'
+
+    return RowLayout(
+        SimpleNamespace(config=config, _tx_columns=tx_columns, _json_dumps=json.dumps),
+    )
+
+
+def test_copy_value_escapes_text_format() -> None:
+    assert _copy_value(None) == '\\N'
+    assert _copy_value('a\tb\nc\rd') == 'a\\tb\\nc\\rd'
+    assert _copy_value('back\\slash') == 'back\\\\slash'
+    assert _copy_value("it's") == "it's"
+    assert _copy_value(42) == '42'
+
+
+def test_copy_value_binary_and_time() -> None:
+    assert _copy_value(b'\x00\xab') == '\\\\x00ab'
+    assert _copy_value(memoryview(b'\x01')) == '\\\\x01'
+    assert _copy_value(TX_TIME) == '2022-01-01 12:30:00'
+
+
+def test_row_unescapes_asset_name_and_nulls() -> None:
+    layout = _layout()
+    assert layout.columns['asset'] == (
+        'id', 'collection_id', 'hash', 'name', 'fingerprint', 'current_wallet_id',
+    )
+    row = layout.row(
+        'asset', (1, 2, 'ab.6e', "it''s", 'asset1test', None, 'Null'),
+    )
+    assert row == (1, 2, 'ab.6e', "it's", 'asset1test', None)
+    assert layout.row('asset_ext', (1, 1, 'Null', 5)) == (1, 1, None, 5)
+
+
+def test_row_binary_keys() -> None:
+    layout = _layout(binary_keys=True)
+    assert layout.columns['wallet'] == ('id', 'address', 'address_raw', 'address_type')
+    row = (1, 'addr1', b'\x01', 'STAKE')
+    assert layout.row('wallet', row) == row
+    assert _layout().row('wallet', row) == (1, 'addr1', 'STAKE')
+
+
+def test_row_metadata_columns() -> None:
+    value = (1, 2, 'Null', 1, 'cd' * 32, TX_TIME, 'ipfs://x', {'name': 'x'}, None)
+    row = _layout().row('asset_mint_tx', value)
+    assert row == (
+        1, 2, None, 1, 'cd' * 32, TX_TIME, 'ipfs://x', '{"name": "x"}', 'null',
+    )
+
+    # Pass-through metadata is already JSON text
+    value = (1, 2, 3, 1, 'cd' * 32, TX_TIME, None, '{"name":"x"}', None)
+    row = _layout(json_passthrough=True).row('asset_mint_tx', value)
+    assert row[-2:] == ('{"name":"x"}', 'null')
+
+
+def test_row_normalized_tx_and_dedup_metadata() -> None:
+    layout = _layout(normalized_tx=True, dedup_metadata=True)
+    assert layout.columns['asset_mint_tx'] == (
+        'id', 'asset_id', 'wallet_id', 'quantity', 'tx_id', 'metadata_id',
+    )
+    value = (1, 2, 3, 1, 7, TX_TIME, None, 'Null', None)
+    assert layout.row('asset_mint_tx', value) == (1, 2, 3, 1, 7, None)
+    assert layout.row('asset_tx', (1, 2, 'Null', 1, 7, TX_TIME)) == (1, 2, None, 1, 7)